@@ -1,8 +1,10 @@
 print(f"Loading {__file__}...")
 
 #from __future__ import print_function
-import os,sys
+import os,sys,threading,time
 import numpy as np
+from ophyd.status import SubscriptionStatus
+from ophyd.utils import WaitTimeoutError
 from time import sleep
 from datetime import datetime
 
@@ -93,3 +95,253 @@ def setSignal(signal, value, readback_signal=None, poll_time=0.25, time_out=5, r
 def setSignal(signal, value):
     signal.set(value).wait()
     
+
+def setSignals(sig_vals, timeout=10):
+    """ sig_vals is a list of (signal, value)
+        all values are set at once, then wait for all of them, instead of one after another 
+    """
+    sts = [sig.set(v) for sig,v in sig_vals]
+    for st in sts:
+        st.wait(timeout)
+
+
+class TriggerEngine:
+    """ finishes a status when every watched signal reaches the count expected for it, e.g. 
+        Acquire going back to 0 (falling_edge=True) or the array counter of a detector
+        the CA monitor callbacks only update the counts and notify the condition variable, 
+        the engine thread finishes the statuses, or fails them after the timeout 
+        
+        e.g. eng.watch("pil1M", pil1M.cam.array_counter)
+             eng.add(status, n=1, timeout=5)    # after triggering 1 frame
+        the time from add() to done is kept in latency
+    """
+    def __init__(self, name="trigger_engine"):
+        self.name = name
+        self.cond = threading.Condition()
+        self.counts = {}
+        self.expected = {}
+        self.pending = []
+        self.latency = []
+        self._subs = []
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        
+    def watch(self, key, signal, falling_edge=False):
+        """ falling_edge=False: the signal value is the count
+        """
+        def cb(value, old_value=None, **kwargs):
+            with self.cond:
+                if not falling_edge:
+                    self.counts[key] = value
+                elif old_value==1 and value==0:
+                    self.counts[key] += 1
+                self.cond.notify_all()
+        with self.cond:
+            self.counts[key] = (0 if falling_edge else signal.get())
+            self.expected[key] = self.counts[key]
+        self._subs.append((signal, signal.subscribe(cb, run=False)))
+    
+    def clear(self):
+        """ stop watching, pending statuses are failed
+        """
+        for sig,cid in self._subs:
+            sig.unsubscribe(cid)
+        self._subs = []
+        with self.cond:
+            pending = self.pending
+            self.pending = []
+            self.counts = {}
+            self.expected = {}
+            self.latency = []
+        for st,targets,t0,deadline in pending:
+            st.set_exception(Exception(f"{self.name}: no longer watching for the trigger to complete."))
+        
+    def add(self, status, n=1, timeout=None):
+        """ the status is finished once every watched signal counts n more
+        """
+        t0 = time.time()
+        with self.cond:
+            for k in self.expected.keys():
+                self.expected[k] += n
+            self.pending.append((status, dict(self.expected), t0, 
+                                 None if timeout is None else t0+timeout))
+            self.cond.notify_all()
+        return status
+
+    def _check(self):
+        """ called with the condition acquired
+            returns the finished and failed statuses, and how long to wait for the next deadline
+        """
+        done,failed,pending = [],[],[]
+        t = time.time()
+        wait = None
+        for p in self.pending:
+            (st,targets,t0,deadline) = p
+            behind = [k for k,v in targets.items() if self.counts.get(k, 0)<v]
+            if len(behind)==0:
+                done.append(p)
+            elif deadline is not None and t>deadline:
+                failed.append((st, f"{self.name}: {', '.join(behind)} did not complete within {deadline-t0:.1f} s."))
+            else:
+                pending.append(p)
+                if deadline is not None:
+                    wait = (deadline-t if wait is None else min(wait, deadline-t))
+        self.pending = pending
+        return done,failed,wait
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                done,failed,wait = self._check()
+                while len(done)+len(failed)==0:
+                    self.cond.wait(wait)
+                    done,failed,wait = self._check()
+                t = time.time()
+                self.latency += [t-t0 for (st,targets,t0,deadline) in done]
+            # outside the lock, the callbacks on the status may trigger again
+            for (st,targets,t0,deadline) in done:
+                st._finished()
+            for st,msg in failed:
+                st.set_exception(Exception(msg))
+
+
+class FileWriterReadiness:
+    """ whether the file plugin (hdf) of an area detector is ready to capture, from CA monitors
+        the plugin can only open a file after it has received a frame, of the size and data type 
+        the detector now produces; warm up only if it has not, instead of whenever run_time==0
+        the config last captured with is kept per detector, for cams that do not report it
+        
+        e.g. rd = FileWriterReadiness(det.hdf)
+             rd.prepare(det.hdf.warmup)   # before staging the plugin
+             rd.set_capture(1)            # instead of det.hdf.capture.set(1).wait()
+        the time spent warming up and the warm-ups avoided are counted, see report()
+    """
+    good_config = {}            # by detector name
+    typical_warmup_time = 1.5   # the sleep-based warm-up, until one has been timed
+    
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.state = {}
+        self._subs = []
+        self.warmups = 0
+        self.warmup_time = 0
+        self.skipped = 0
+        
+    @property
+    def name(self):
+        # the detectors may be renamed after the plugin is created, e.g. in LiXDetectors
+        return self.plugin.parent.name
+        
+    def _signals(self):
+        hdf = self.plugin
+        cam = hdf.parent.cam
+        sigs = {"width": hdf.array_size.width, "height": hdf.array_size.height, 
+                "depth": hdf.array_size.depth, "data_type": hdf.data_type, "run_time": hdf.run_time}
+        if hasattr(cam, "array_size") and hasattr(cam, "data_type"):
+            sigs.update({"cam_width": cam.array_size.array_size_x, "cam_height": cam.array_size.array_size_y,
+                         "cam_depth": cam.array_size.array_size_z, "cam_data_type": cam.data_type})
+        return sigs
+        
+    def watch(self):
+        """ read everything once, then rely on the monitors
+        """
+        if len(self._subs)>0:
+            return
+        for key,sig in self._signals().items():
+            def cb(value, key=key, sig=sig, **kwargs):
+                if key.endswith("data_type") and not isinstance(value, str):
+                    value = sig.enum_strs[value]
+                self.state[key] = value
+            cb(sig.get())
+            self._subs.append((sig, sig.subscribe(cb, run=False)))
+    
+    def clear(self):
+        for sig,cid in self._subs:
+            sig.unsubscribe(cid)
+        self._subs = []
+        self.state = {}
+    
+    def plugin_config(self):
+        """ None if the plugin has not received a frame since the IOC started
+        """
+        cfg = tuple(self.state[k] for k in ["width", "height", "depth", "data_type"])
+        return None if cfg[0]==0 else cfg
+
+    def cam_config(self):
+        if "cam_width" not in self.state or self.state["cam_width"]==0:
+            return None
+        return tuple(self.state[k] for k in ["cam_width", "cam_height", "cam_depth", "cam_data_type"])
+        
+    def needs_warmup(self):
+        self.watch()
+        cfg = self.plugin_config()
+        if cfg is None:
+            return True
+        expected = self.cam_config() or self.good_config.get(self.name)
+        return expected is not None and cfg!=expected
+    
+    def prepare(self, warmup):
+        """ call warmup() if needed
+        """
+        if self.needs_warmup():
+            t0 = time.time()
+            warmup()
+            self.warmups += 1
+            self.warmup_time += time.time()-t0
+            if self.needs_warmup():
+                raise Exception(f"{self.name}: the file plugin is not ready after warming up, "
+                                f"{self.plugin_config()} vs {self.cam_config()}.")
+        elif self.state["run_time"]==0:
+            self.skipped += 1
+    
+    def warmup(self, sigs, busy_signal, timeout=10):
+        """ sigs: [(signal, value), ...] for the detector to collect a single frame, acquire last
+            waits for the frame to reach the plugin, and for busy_signal (e.g. Armed) to return 0, 
+            from the CA monitors; the other signals are then restored
+            the signals are set one at a time, in order, and restored in reverse order: they may
+            depend on each other, e.g. the Pilatus acquire_period must be at least acquire_time
+        """
+        hdf = self.plugin
+        hdf.enable.set(1).wait(timeout)
+        original_vals = [(sig, sig.get()) for sig,v in sigs[:-1]]
+        for sig,v in sigs[:-1]:
+            sig.set(v).wait(timeout)
+        n = hdf.array_counter.get()
+        st = SubscriptionStatus(hdf.array_counter, lambda value, **kwargs: value>n, run=False, timeout=timeout)
+        acq,v = sigs[-1]
+        acq.put(v)
+        try:
+            st.wait()
+            SubscriptionStatus(busy_signal, lambda value, **kwargs: value==0, run=True).wait(timeout)
+        except WaitTimeoutError:
+            acq.put(0)
+            raise Exception(f"{self.name}: no frame received by the file plugin within {timeout} s.")
+        finally:
+            for sig,v in original_vals[::-1]:
+                sig.set(v).wait(timeout)
+        
+    def set_capture(self, value, timeout=10):
+        """ in place of capture.set(value).wait(), which polls the readback
+            the config is remembered once a file is open
+        """
+        cap = self.plugin.capture
+        target = value
+        st = SubscriptionStatus(cap, lambda value, **kwargs: value==target, run=True, timeout=timeout)
+        cap.put(value)
+        try:
+            st.wait()
+        except WaitTimeoutError:
+            raise Exception(f"{self.name}: capture is not {value} after {timeout} s, "
+                            f"{self.plugin.write_message.get(as_string=True)}")
+        if value==1:
+            self.good_config[self.name] = self.plugin_config()
+    
+    def time_saved(self):
+        """ estimate, from the warm-ups timed in this session
+        """
+        t = (self.warmup_time/self.warmups if self.warmups>0 else self.typical_warmup_time)
+        return self.skipped*t
+    
+    def report(self):
+        print(f"{self.name}: {self.warmups} warm-ups ({self.warmup_time:.1f} s), {self.skipped} avoided, "
+              f"~{self.time_saved():.1f} s saved")
@@ -101,7 +101,7 @@ def plot_data(data, ys, xs1, xs2=None, thresh=0.8, take_diff=False, no_plot=Fals
 # this used to be part of 20-pilatus
 # moved here so that it can be used in 20-xspress3 as well
 
-from ophyd import Component,EpicsSignalRO
+from ophyd import Component,EpicsSignalRO,EpicsSignalWithRBV
 from ophyd.areadetector.filestore_mixins import FileStoreHDF5, FileStoreIterativeWrite
 from ophyd.areadetector.plugins import HDF5Plugin,register_plugin,PluginBase
 
@@ -116,6 +116,7 @@ class LiXFileStorePluginBase(FileStoreIterativeWrite):
                                 ])
         self._fn = None
         self._fp = None
+        self.readiness = FileWriterReadiness(self)
 
     def stage(self):
         # Make a filename.
@@ -123,7 +124,7 @@ class LiXFileStorePluginBase(FileStoreIterativeWrite):
 
         # Ensure we do not have an old file open.
         if self.file_write_mode != 'Single':
-            self.capture.set(0).wait()
+            self.readiness.set_capture(0)
         # These must be set before parent is staged (specifically
         # before capture mode is turned on. They will not be reset
         # on 'unstage' anyway.
@@ -132,6 +133,8 @@ class LiXFileStorePluginBase(FileStoreIterativeWrite):
         self.num_capture.set(self.parent._num_captures).wait()
         #self.file_number.set(0).wait()     # only reason to redefine the pluginbase
         super().stage()
+        # not in stage_sigs, set() would poll the readback while the IOC opens the file
+        self.readiness.set_capture(1)
 
         # AD does this same templating in C, but we can't access it
         # so we do it redundantly here in Python.
@@ -144,6 +147,10 @@ class LiXFileStorePluginBase(FileStoreIterativeWrite):
             raise IOError("Path %s does not exist on IOC server."
                           "" % self.file_path.get())
 
+    def unstage(self):
+        self.readiness.set_capture(0)
+        super().unstage()
+
 
 class LiXFileStoreHDF5(LiXFileStorePluginBase):
     def __init__(self, *args, **kwargs):
@@ -151,7 +158,7 @@ class LiXFileStoreHDF5(LiXFileStorePluginBase):
         self.filestore_spec = 'AD_HDF5'  # spec name stored in resource doc
         self.stage_sigs.update([('file_template', '%s%s_%6.6d.h5'),
                                 ('file_write_mode', 'Stream'),
-                                ('capture', 1)
+                                # capture is set in LiXFileStorePluginBase.stage()
                                 ])
 
     def stage(self):
@@ -162,7 +169,9 @@ class LiXFileStoreHDF5(LiXFileStorePluginBase):
 
 class LIXhdfPlugin(HDF5Plugin, LiXFileStoreHDF5):
     run_time = Component(EpicsSignalRO, "RunTime")
+    swmr_mode = Component(EpicsSignalWithRBV, "SWMRMode")
     sub_directory = None
+    swmr = False    # write the file in SWMR mode, so that the frames can be read during the scan
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -179,12 +188,14 @@ class LIXhdfPlugin(HDF5Plugin, LiXFileStoreHDF5):
 
         The plugin has to 'see' one acquisition before it is ready to capture.
         This sets the array size, etc.
+        
+        called from stage() through readiness.prepare(), only if the plugin has not seen a frame 
+        of the current size/data type 
         """
-        self.enable.set(1).wait()
+        print(f"{self.parent.name}: warming up the hdf plugin ...")
         if hasattr(self.parent.cam, 'armed'):
             armed = self.parent.cam.armed
-            sigs = OrderedDict(
-                [
+            sigs = [
                     (self.parent.cam.array_callbacks, 1),
                     (self.parent.cam.image_mode, "Single"),
                     (self.parent.cam.trigger_mode, "Internal"),
@@ -192,34 +203,30 @@ class LIXhdfPlugin(HDF5Plugin, LiXFileStoreHDF5):
                     (self.parent.cam.acquire_period, 0.105),
                     (self.parent.cam.acquire, 1),
                 ]
-            )
         elif hasattr(self.parent.cam, 'detector_state'): # Xspress3
             armed = self.parent.cam.detector_state
-            sigs = OrderedDict(
-                [
+            sigs = [
                     (self.parent.cam.array_callbacks, 1),
                     (self.parent.cam.image_mode, "Single"),
                     (self.parent.cam.trigger_mode, "Internal"),
                     (self.parent.cam.acquire_time, 0.1),
                     (self.parent.cam.acquire, 1),
                 ]
-            )
         else:
             raise Exception("don't know how to get detector armed status ...")
 
-        original_vals = {sig: sig.get() for sig in sigs}
+        # no sleeps: the frame and the detector going back to idle are seen on the CA monitors
+        self.readiness.warmup(sigs, armed)
 
-        for sig, val in sigs.items():
-            ttime.sleep(0.1)  # abundance of caution
-            sig.set(val).wait()
-
-        #ttime.sleep(2)  # wait for acquisition
-        while armed.get():
-            ttime.sleep(0.2)
-        
-        for sig, val in reversed(list(original_vals.items())):
-            ttime.sleep(0.1)
-            sig.set(val).wait()
+    def stage(self):
+        self.readiness.prepare(self.warmup)
+        # set before capture, see LiXFileStorePluginBase.stage(); restored in unstage()
+        if self.swmr:
+            self.stage_sigs.update([('swmr_mode', 'On'), ('num_frames_flush', 1)])
+        else:
+            self.stage_sigs.pop('swmr_mode', None)
+            self.stage_sigs.pop('num_frames_flush', None)
+        super().stage()
 
     def make_filename(self):
         ''' replaces FileStorePluginBase.make_filename()
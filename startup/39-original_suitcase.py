@@ -13,8 +13,12 @@ import numpy as np
 import warnings
 import h5py
 import json
-import copy, shutil
+import copy, shutil, time, glob, threading
 from databroker import Header
+try:
+    import hdf5plugin
+except ModuleNotFoundError:
+    hdf5plugin = None
 
 def conv_to_list(d): 
     if isinstance(d, float) or isinstance(d, int) or isinstance(d, str): 
@@ -40,6 +44,27 @@ def read_pilatus_hdf(fh5):
 def read_xspress3_hdf(fh5):
     pass
 
+# how long locate_h5_resource() waits for a file being copied by the staging service, in sec
+staging_wait_timeout = 300
+
+def partial_name(fn):
+    """ the temporary file for a copy to fn in progress, one for each copier
+    """
+    return f"{fn}.{os.getpid()}.{threading.get_ident()}.partial"
+
+def wait_for_staging(fn, timeout=staging_wait_timeout):
+    """ wait for the staging service (42-staging.py) to finish with fn, in this process through
+        the ResourceStager, in another process (e.g. the packing queue) by the temporary files
+    """
+    t0 = time.time()
+    stager = globals().get("resource_stager")
+    if stager is not None and not stager.wait_for(fn, timeout):
+        raise Exception(f"{fn} is still being staged after {timeout} sec.")
+    while len(glob.glob(glob.escape(fn)+".*.partial"))>0:
+        if time.time()-t0>timeout:
+            raise Exception(f"{fn} is still being copied after {timeout} sec.")
+        time.sleep(0.5)
+
 def locate_h5_resource(res, replace_res_path, debug=False):
     """ this is intended to move h5 file created by Pilatus
         these files are originally saved on PPU RAMDISK, but should be moved to the IOC data directory
@@ -51,6 +76,9 @@ def locate_h5_resource(res, replace_res_path, debug=False):
     if debug:
         print(f"resource locations: {fn_orig} -> {fn}")
     
+    if PurePath(fn_orig)!=PurePath(fn):
+        # the file may be in the process of being copied by the staging service
+        wait_for_staging(fn)
     if not(os.path.exists(fn_orig) or os.path.exists(fn)):
         print(f"could not locate the resource at either {fn} or {fn_orig} ...")
         raise Exception
@@ -64,10 +92,17 @@ def locate_h5_resource(res, replace_res_path, debug=False):
                 makedirs(fdir, mode=0o2775)
             if debug:
                 print(f"copying {fn_orig} to {fdir}")
-            tfn = fn+"_partial"
-            shutil.copy(fn_orig, tfn)
-            os.rename(tfn, fn)
-            os.remove(fn_orig)
+            tfn = partial_name(fn)
+            try:
+                shutil.copy(fn_orig, tfn)
+                os.rename(tfn, fn)
+            finally:
+                if os.path.exists(tfn):
+                    os.remove(tfn)
+            try:
+                os.remove(fn_orig)
+            except FileNotFoundError:
+                pass # removed by the staging service
     
     hf5 = h5py.File(fn, "r")
     ## different format for pilatus and xspress3
@@ -94,9 +129,53 @@ def locate_h5_resource(res, replace_res_path, debug=False):
     return hf5,data,timestamps
 
 
+compression_profiles = ["gzip", "lz4", "zstd", "none"]
+
+def h5_compression_opts(profile):
+    """ keyword arguments for h5py create_dataset() 
+        "gzip": the original default, slow, but can be read anywhere
+        "lz4": bitshuffle+LZ4, fast enough to keep up with the detectors
+        "zstd": Blosc/Zstd with byte shuffle, better compression than lz4, still much faster than gzip
+        "none": no compression, e.g. for scratch files
+        hdf5plugin is required for lz4 and zstd, also for reading the data back
+    """
+    if profile=="gzip":
+        return {"compression": "gzip", "fletcher32": True}
+    elif profile in ["none", None]:
+        return {}
+    elif profile in ["lz4", "zstd"]:
+        if hdf5plugin is None:
+            raise Exception(f"hdf5plugin is required for compression profile {profile}.")
+        if profile=="lz4":
+            return dict(hdf5plugin.Bitshuffle(cname='lz4'))
+        return dict(hdf5plugin.Blosc(cname='zstd', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise Exception(f"unknown compression profile: {profile}, valid options are {compression_profiles}.")
+
+def plan_chunks(shape, dtype, access="frame", target_size=1024*1024):
+    """ chunk shape for a dataset of the given shape, the first axis is the event/frame index
+        access="frame": each chunk contains whole frames, several of them if the frames are small
+        access="pixel": each chunk contains a 32x32 tile of pixels for as many frames as fit in 
+                        target_size, for reading the time series of a pixel or a small ROI
+    """
+    if access not in ["frame", "pixel"]:
+        raise Exception(f"unknown access pattern: {access}, valid options are frame and pixel.")
+    shape = tuple(shape)
+    n = max(shape[0], 1)
+    frame = list(shape[1:])
+    itemsize = np.dtype(dtype).itemsize
+    if access=="pixel" and len(frame)>0:
+        frame[-2:] = [min(d, 32) for d in frame[-2:]]
+    fsize = max(int(np.prod(frame))*itemsize, 1)
+    nf = int(max(1, min(n, target_size//fsize)))
+    return (nf, *[max(d, 1) for d in frame])
+
+def _field_compression(key, compression, field_compression):
+    return h5_compression_opts(field_compression.get(key, compression))
+
 def hdf5_export(headers, filename, debug=False,
            stream_name=None, fields=None, bulk_h5_res=True,
-           save_timestamps=True, use_uid=True, db=None, replace_res_path={}):
+           save_timestamps=True, use_uid=True, db=None, replace_res_path={}, batch_size=None, link_mode="copy",
+           compression="gzip", field_compression={}, chunk_access="frame"):
     """
     Create hdf5 file to preserve the structure of databroker.
 
@@ -123,6 +202,21 @@ def hdf5_export(headers, filename, debug=False,
         db should be included in hdr.
     replace_res_path: in case the resource has been moved, specify how the path should be updated
         e.g. replace_res_path = {"exp_path/hdf": "nsls2/xf16id1/data/2022-1"}
+    batch_size : int, optional
+        if specified, the events are read from the databroker and appended to the hdf5 file 
+        this many at a time, instead of loading all events of the stream into memory first
+        The default is None.
+    link_mode : string, optional
+        how the data in AD_HDF5 resources are included in the file, "copy", "vds" or "external"
+        see _copy_h5_resource(). The default is "copy".
+    compression : string, optional
+        compression profile for the numerical data, see h5_compression_opts(). The default is "gzip".
+    field_compression : dict, optional
+        per-field profiles that override compression, e.g. {"pil1M_image": "lz4"}
+        the detector data copied from AD_HDF5 resources keep the compression used by the IOC, 
+        unless a profile is specified for the field here
+    chunk_access : string, optional
+        expected access pattern for the detector images, "frame" or "pixel", see plan_chunks()
         
     Revision 2021 May
         Now that the resource is a h5 file, copy data directly from the file 
@@ -130,6 +224,11 @@ def hdf5_export(headers, filename, debug=False,
     """
     if isinstance(headers, Header):
         headers = [headers]
+    if link_mode not in ["copy", "vds", "external"]:
+        raise Exception(f"invalid link_mode: {link_mode}, valid options are copy, vds and external.")
+    for p in [compression]+list(field_compression.values()):
+        h5_compression_opts(p)   # fail before anything is written
+    copts = h5_compression_opts(compression)
 
     with h5py.File(filename, "w") as f:
         #f.swmr_mode = True # Unable to start swmr writing (file superblock version - should be at least 3)
@@ -175,10 +274,19 @@ def hdf5_export(headers, filename, debug=False,
                 else:
                     desc_group = group.create_group(descriptor['name'])
 
-                data_keys = descriptor['data_keys']
-
                 _safe_attrs_assignment(desc_group, descriptor)
 
+                if batch_size is not None:
+                    _export_stream_in_batches(header, descriptor, desc_group, res_docs, batch_size, 
+                                              fields=fields, bulk_h5_res=bulk_h5_res, 
+                                              save_timestamps=save_timestamps, link_mode=link_mode,
+                                              replace_res_path=replace_res_path, compression=compression,
+                                              field_compression=field_compression, 
+                                              chunk_access=chunk_access, debug=debug)
+                    continue
+
+                data_keys = descriptor['data_keys']
+
                 # fill can be bool or list
                 events = list(header.events(stream_name=descriptor['name'], fill=False))
 
@@ -197,8 +305,7 @@ def hdf5_export(headers, filename, debug=False,
                     print("res_dict:\n", res_dict)
 
                 event_times = [e['time'] for e in events]
-                desc_group.create_dataset('time', data=event_times,
-                                          compression='gzip', fletcher32=True)
+                desc_group.create_dataset('time', data=event_times, **copts)
                 data_group = desc_group.create_group('data')
                 if save_timestamps:
                     ts_group = desc_group.create_group('timestamps')
@@ -217,34 +324,16 @@ def hdf5_export(headers, filename, debug=False,
                         res = res_docs[res_dict[key][0]]
                         print(f"processing resource ...\n", res)
 
-                        # pilatus data, change the path from ramdisk to IOC data directory
-                        if key in ["pil1M_image", "pilW2_image", "xsp3_image"]:
-                            if len(replace_res_path)>0:
-                                rp = replace_res_path
-                            else:
-                                rp = {pilatus_data_dir: data_destination}
-
                         if res['spec'] == "AD_HDF5" and bulk_h5_res:
                             rawdata = None
-                            N = len(res_dict[key])
-                            print(f"copying data from source h5 file(s) directly, N={N} ...")
-                            if N==1:
-                                hf5,data,timestamps = locate_h5_resource(res_docs[res_dict[key][0]], replace_res_path=rp, debug=debug)
-                                data_group.copy(data, key)
-                                hf5.close()
-                                dataset = data_group[key]
-                            else: # ideally this should never happen, only 1 hdf5 file/resource per scan
-                                for i in range(N):
-                                    hf5,data,ts = locate_h5_resource(res_docs[res_dict[key][i]])
-                                    if i==0:
-                                        dataset = data_group.create_dataset(
-                                                key, shape=(N, *data.shape), 
-                                                compression=data.compression,
-                                                chunks=(1, *data.chunks))
-                                        timestamps = np.zeros(shape=(N, ts.shape))
-                                    dataset[i,:] = data
-                                    timestamps[i,:] = ts
-                                    hf5.close()
+                            rp = _res_path_map(replace_res_path)
+                            opts = None
+                            if key in field_compression.keys():
+                                opts = h5_compression_opts(field_compression[key])
+                            dataset,timestamps = _copy_h5_resource(data_group, key, 
+                                                                   [res_docs[ru] for ru in res_dict[key]], 
+                                                                   rp, link_mode=link_mode, opts=opts,
+                                                                   chunk_access=chunk_access, debug=debug)
                         else:
                             print(f"getting resource data using handlers ...")
                             rawdata = header.table(stream_name=descriptor['name'], 
@@ -254,63 +343,292 @@ def hdf5_export(headers, filename, debug=False,
                         rawdata = [e['data'][key] for e in events]
 
                     if save_timestamps:
-                        ts_group.create_dataset(key, data=timestamps,
-                                                compression='gzip',
-                                                fletcher32=True)
+                        ts_group.create_dataset(key, data=timestamps, **copts)
                         
                     if rawdata is not None:
-                        data = np.array(rawdata, dtype="object")
-
-                        if value['dtype'].lower() == 'string':  # 1D of string
-                            data_len = len(data[0])
-                            data = data.astype('|S'+str(data_len))
-                            dataset = data_group.create_dataset(
-                                key, data=data, compression='gzip')
-                        elif data.dtype.kind in ['S', 'U']:
-                            # 2D of string, we can't tell from dytpe, they are shown as array only.
-                            if data.ndim == 2:
-                                data_len = 1
-                                for v in data[0]:
-                                    data_len = max(data_len, len(v))
-                                data = data.astype('|S'+str(data_len))
-                                dataset = data_group.create_dataset(
-                                    key, data=data, compression='gzip')
-                            else:
-                                raise ValueError(f'Array of str with ndim >= 3 can not be saved: {key}')
-                        else:  # save numerical data
-                            try:
-                                if isinstance(rawdata, list):
-                                    blk = rawdata[0]
-                                else:
-                                    blk = rawdata[1]
-                                if isinstance(blk, np.ndarray): # detector image
-                                    data = np.vstack(rawdata)
-                                    chunks = np.ones(len(data.shape), dtype=int)
-                                    n = len(blk.shape)
-                                    if chunks[-1]<10:
-                                        chunks[-3:] = data.shape[-3:]
-                                    else:
-                                        chunks[-2:] = data.shape[-2:]
-                                    chunks = tuple(chunks)
-                                    print("data shape: ", data.shape, "     chunks: ", chunks)
-                                    dataset = data_group.create_dataset(
-                                        key, data=data,
-                                        compression='gzip', fletcher32=True, chunks=chunks)
-                                else: # motor positions etc.
-                                    data = np.array(conv_to_list(rawdata)) # issue with list of lists
-                                    chunks = False
-                                    dataset = data_group.create_dataset(
-                                        key, data=data,
-                                        compression='gzip', fletcher32=True)
-                            except:
-                                raise
-                            #    print("failed to convert data: ")
-                            #    print(np.array(conv_to_list(rawdata)))
-                            #    continue
+                        dataset = _create_dataset_from_rawdata(data_group, key, value, rawdata, 
+                                        opts=_field_compression(key, compression, field_compression),
+                                        chunk_access=chunk_access)
                     
                     # Put contents of this data key (source, etc.)
                     # into an attribute on the associated data set.
-                    _safe_attrs_assignment(dataset, dict(value))
+                    if dataset is not None:
+                        _safe_attrs_assignment(dataset, dict(value))
+                    elif key in data_group:
+                        # external link, the target in the IOC file cannot be modified
+                        # kept on the group instead, h5_materialize() moves them to the dataset
+                        data_group.attrs[f"{key}.attrs"] = json.dumps(_clean_dict(dict(value)))
+
+
+def _res_path_map(replace_res_path):
+    """ pilatus data, change the path from ramdisk to IOC data directory
+    """
+    if len(replace_res_path)>0:
+        return replace_res_path
+    return {pilatus_data_dir: data_destination}
+
+
+def _copy_h5_resource(data_group, key, resources, replace_res_path, link_mode="copy", 
+                      opts=None, chunk_access="frame", debug=False):
+    """ copy data directly from the source h5 file(s) into data_group[key]
+        return the dataset and the timestamps found in the source file(s)
+        
+        opts: if None, the data are copied as they are, compression included; otherwise the 
+              data are re-written using these create_dataset() arguments, see h5_compression_opts()
+        
+        link_mode:
+            "copy": the data are copied into the packed file
+            "vds": a virtual dataset is created, mapped onto the data in the source file(s)
+            "external": an external link to the source file is created, 1 resource only;
+                        the returned dataset is None since it is read-only, the attributes for
+                        the data_key are saved as json in data_group.attrs[f"{key}.attrs"]
+        for "vds" and "external", the source files must stay where they are,
+        use h5_materialize() to convert the packed file into a self-contained one
+    """
+    N = len(resources)
+    if link_mode=="external" and N>1:
+        print(f"cannot use an external link for {N} resources, using vds instead ...")
+        link_mode = "vds"
+    print(f"{link_mode}: data from source h5 file(s) directly, N={N} ...")
+    if N==1:
+        hf5,data,timestamps = locate_h5_resource(resources[0], replace_res_path=replace_res_path, debug=debug)
+        if link_mode=="copy" and opts is None:
+            data_group.copy(data, key)
+            dataset = data_group[key]
+        elif link_mode=="copy":
+            dataset = _recompress_dataset(data_group, key, data, opts, chunk_access)
+        elif link_mode=="vds":
+            layout = h5py.VirtualLayout(shape=data.shape, dtype=data.dtype)
+            layout[...] = h5py.VirtualSource(hf5.filename, data.name, shape=data.shape)
+            dataset = data_group.create_virtual_dataset(key, layout, fillvalue=0)
+        else:
+            data_group[key] = h5py.ExternalLink(hf5.filename, data.name)
+            dataset = None
+        hf5.close()
+    else: # ideally this should never happen, only 1 hdf5 file/resource per scan
+        for i in range(N):
+            hf5,data,ts = locate_h5_resource(resources[i], replace_res_path=replace_res_path, debug=debug)
+            if i==0:
+                if link_mode=="vds":
+                    layout = h5py.VirtualLayout(shape=(N, *data.shape), dtype=data.dtype)
+                elif opts is None:
+                    dataset = data_group.create_dataset(
+                            key, shape=(N, *data.shape), 
+                            compression=data.compression,
+                            chunks=(1, *data.chunks))
+                else:
+                    dataset = data_group.create_dataset(
+                            key, shape=(N, *data.shape), dtype=data.dtype, 
+                            chunks=(1, *plan_chunks(data.shape, data.dtype, chunk_access)), **opts)
+                timestamps = np.zeros(shape=(N, *ts.shape))
+            if link_mode=="vds":
+                layout[i] = h5py.VirtualSource(hf5.filename, data.name, shape=data.shape)
+            else:
+                dataset[i,:] = data
+            timestamps[i,:] = ts
+            hf5.close()
+        if link_mode=="vds":
+            dataset = data_group.create_virtual_dataset(key, layout, fillvalue=0)
+    
+    return dataset,timestamps
+
+
+def _recompress_dataset(data_group, key, data, opts, chunk_access="frame", max_block_size=256*1024*1024):
+    """ write the source dataset data into data_group[key], using the given compression 
+        and the chunks from plan_chunks(); the data are read in blocks of whole chunks along the 
+        first axis, as long as that is less than max_block_size
+    """
+    chunks = plan_chunks(data.shape, data.dtype, chunk_access)
+    dataset = data_group.create_dataset(key, shape=data.shape, dtype=data.dtype, chunks=chunks, **opts)
+    fsize = int(np.prod(data.shape[1:]))*data.dtype.itemsize
+    nb = chunks[0]*max(1, int(max_block_size/(chunks[0]*fsize)))
+    if chunks[0]*fsize>max_block_size:
+        nb = max(1, int(max_block_size/fsize))
+    for i in range(0, data.shape[0], nb):
+        dataset[i:i+nb] = data[i:i+nb]
+    return dataset
+
+
+def _create_dataset_from_rawdata(data_group, key, value, rawdata, opts=None, chunk_access="frame"):
+    """ value is the data_key in the descriptor
+        rawdata is either a list of values from the events, or the column of a table
+        opts are the compression arguments for numerical data, see h5_compression_opts()
+    """
+    if opts is None:
+        opts = h5_compression_opts("gzip")
+    data = np.array(rawdata, dtype="object")
+
+    if value['dtype'].lower() == 'string':  # 1D of string
+        data_len = len(data[0])
+        data = data.astype('|S'+str(data_len))
+        dataset = data_group.create_dataset(
+            key, data=data, compression='gzip')
+    elif data.dtype.kind in ['S', 'U']:
+        # 2D of string, we can't tell from dytpe, they are shown as array only.
+        if data.ndim == 2:
+            data_len = 1
+            for v in data[0]:
+                data_len = max(data_len, len(v))
+            data = data.astype('|S'+str(data_len))
+            dataset = data_group.create_dataset(
+                key, data=data, compression='gzip')
+        else:
+            raise ValueError(f'Array of str with ndim >= 3 can not be saved: {key}')
+    else:  # save numerical data
+        try:
+            if isinstance(rawdata, list):
+                blk = rawdata[0]
+            else:
+                blk = rawdata[1]
+            if isinstance(blk, np.ndarray): # detector image
+                data = np.vstack(rawdata)
+                chunks = plan_chunks(data.shape, data.dtype, chunk_access)
+                print("data shape: ", data.shape, "     chunks: ", chunks)
+                dataset = data_group.create_dataset(
+                    key, data=data, chunks=chunks, **opts)
+            else: # motor positions etc.
+                data = np.array(conv_to_list(rawdata)) # issue with list of lists
+                chunks = False
+                dataset = data_group.create_dataset(
+                    key, data=data, **opts)
+        except:
+            raise
+        #    print("failed to convert data: ")
+        #    print(np.array(conv_to_list(rawdata)))
+        #    continue
+    
+    return dataset
+
+
+def _iter_event_batches(header, stream_name, batch_size):
+    """ yield the events in the stream as lists of no more than batch_size events
+        header.events() is a generator, so only one batch is held in memory at a time 
+    """
+    batch = []
+    for ev in header.events(stream_name=stream_name, fill=False):
+        batch.append(ev)
+        if len(batch)>=batch_size:
+            yield batch
+            batch = []
+    if len(batch)>0:
+        yield batch
+
+
+def _append_to_dataset(grp, key, data, chunk_len, chunk_access="frame", **kwargs):
+    """ create a resizable dataset the first time, extend it along the first axis afterwards
+    """
+    data = np.asarray(data)
+    if key not in grp.keys():
+        if data.ndim>2:  # detector image
+            chunks = plan_chunks((chunk_len, *data.shape[1:]), data.dtype, chunk_access)
+        else:
+            chunks = (min(chunk_len, max(len(data),1)), *data.shape[1:])
+        return grp.create_dataset(key, data=data, maxshape=(None, *data.shape[1:]), 
+                                  chunks=chunks, **kwargs)
+    dataset = grp[key]
+    n = dataset.shape[0]
+    dataset.resize(n+len(data), axis=0)
+    dataset[n:] = data
+    return dataset
+
+
+def _export_stream_in_batches(header, descriptor, desc_group, res_docs, batch_size, fields=None, 
+                              bulk_h5_res=True, save_timestamps=True, replace_res_path={}, 
+                              link_mode="copy", compression="gzip", field_compression={}, 
+                              chunk_access="frame", debug=False):
+    """ same output as the per-descriptor part of hdf5_export(), but the events are processed
+        batch_size at a time and appended to resizable datasets as they are read
+        
+        only small items are kept until the end: the resource uids for each key, the event
+        timestamps of the resource keys, and the string values (fixed-length strings require 
+        the maximum length to be known before the dataset is created)
+    """
+    data_keys = descriptor['data_keys']
+    keys = [k for k in data_keys.keys() if fields is None or k in fields]
+    copts = h5_compression_opts(compression)
+    if debug:
+        print(f"streaming {descriptor['name']} in batches of {batch_size}, keys: {keys}")
+
+    data_group = desc_group.create_group('data')
+    if save_timestamps:
+        ts_group = desc_group.create_group('timestamps')
+
+    res_dict = None
+    res_ts = {}
+    str_data = {}
+    nev = 0
+    for batch in _iter_event_batches(header, descriptor['name'], batch_size):
+        if res_dict is None:
+            # resource keys can be identified from the first event
+            res_dict = {}
+            for k in keys:
+                v = batch[0]['data'][k]
+                if isinstance(v, str) and v.split('/')[0] in res_docs.keys():
+                    res_dict[k] = []
+                    res_ts[k] = []
+                elif data_keys[k]['dtype'].lower()=='string' or np.asarray(v).dtype.kind in ['S', 'U']:
+                    str_data[k] = []
+            if debug:
+                print("string keys: ", list(str_data.keys()))
+
+        _append_to_dataset(desc_group, 'time', [e['time'] for e in batch], batch_size, **copts)
+        for key in keys:
+            if save_timestamps and key not in res_dict.keys():
+                _append_to_dataset(ts_group, key, [e['timestamps'][key] for e in batch], batch_size, **copts)
+            if key in res_dict.keys():
+                for ev in batch:
+                    res_uid = ev['data'][key].split("/")[0]
+                    if not res_uid in res_dict[key]:
+                        res_dict[key].append(res_uid)
+                res_ts[key] += [e['timestamps'][key] for e in batch]
+            elif key in str_data.keys():
+                str_data[key] += [e['data'][key] for e in batch]
+            else:
+                rawdata = [e['data'][key] for e in batch]
+                if isinstance(rawdata[0], np.ndarray):
+                    data = np.vstack(rawdata)
+                else:
+                    data = np.array(conv_to_list(rawdata)) # issue with list of lists
+                _append_to_dataset(data_group, key, data, batch_size, chunk_access=chunk_access,
+                                   **_field_compression(key, compression, field_compression))
+        nev += len(batch)
+    
+    if res_dict is None:
+        print(f"no events found in stream {descriptor['name']}.")
+        return
+    print(f"{nev} events processed in stream {descriptor['name']} ...")
+    if debug:
+        print("res_dict:\n", res_dict)
+    
+    for key in keys:
+        value = data_keys[key]
+        if key in res_dict.keys():
+            res = res_docs[res_dict[key][0]]
+            print(f"processing resource ...\n", res)
+            timestamps = res_ts.pop(key)
+            if res['spec'] == "AD_HDF5" and bulk_h5_res:
+                rp = _res_path_map(replace_res_path)
+                opts = None
+                if key in field_compression.keys():
+                    opts = h5_compression_opts(field_compression[key])
+                dataset,timestamps = _copy_h5_resource(data_group, key, 
+                                                       [res_docs[ru] for ru in res_dict[key]], 
+                                                       rp, link_mode=link_mode, opts=opts,
+                                                       chunk_access=chunk_access, debug=debug)
+            else:
+                print(f"getting resource data using handlers ...")
+                rawdata = header.table(stream_name=descriptor['name'], fields=[key], fill=True)[key]
+                dataset = _create_dataset_from_rawdata(data_group, key, value, rawdata, 
+                                                       opts=_field_compression(key, compression, field_compression),
+                                                       chunk_access=chunk_access)
+            if save_timestamps:
+                ts_group.create_dataset(key, data=timestamps, **copts)
+        elif key in str_data.keys():
+            dataset = _create_dataset_from_rawdata(data_group, key, value, str_data.pop(key))
+        else:
+            dataset = data_group[key]
+        if dataset is not None:
+            _safe_attrs_assignment(dataset, dict(value))
 
 
 def _clean_dict(d):
@@ -1,10 +1,18 @@
 print(f"Loading {__file__}...")
 
-import h5py,json,os
+import h5py,json,os,time,inspect
 import threading
 import numpy as np
 import epics,socket
 from collections import deque
+import multiprocessing,sys,tempfile
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
+
+# the worker processes of pack_h5_shards() are spawned, they import h5_shard_worker from components/
+components_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "components")
+if components_dir not in sys.path:
+    sys.path.append(components_dir)
+import h5_shard_worker
 
 global proc_path
 
@@ -30,18 +38,227 @@ def h5_fix_sample_name(fn_h5):
             f.move(g, sn)
     f.close()
 
-# maximum process allowed to be packing hdf5 files (may use a lot of memory)
-max_packing_processes = 3
-pack_h5_lock = threading.Semaphore(max_packing_processes)
+def h5_materialize(fn_h5, compression='gzip'):
+    """ replace the virtual datasets and external links created by pack_h5(link_mode="vds"/"external")
+        and pack_h5_shards(merge="external") with actual copies of the data, so that the file no 
+        longer depends on the IOC data files or the shards
+    """
+    f = h5py.File(fn_h5, "r+")
+    links = []
+    def visit(grp):
+        for k in list(grp.keys()):
+            lnk = grp.get(k, getlink=True)
+            if isinstance(lnk, h5py.ExternalLink):
+                links.append((grp, k))
+            elif isinstance(grp[k], h5py.Group):
+                visit(grp[k])
+            elif grp[k].is_virtual:
+                links.append((grp, k))
+    visit(f)
+    
+    n = 0
+    while len(links)>0:
+        grp,k = links.pop(0)
+        print(f"materializing {grp.name.rstrip('/')}/{k} ...")
+        src = grp[k]
+        if isinstance(src, h5py.Group):
+            # e.g. a sample from a shard, copied as it is; links within it are handled next
+            grp.copy(src, k+"_materialized")
+            del grp[k]
+            grp.move(k+"_materialized", k)
+            visit(grp[k])
+            continue
+        attrs = dict(src.attrs)
+        key_attrs = {}
+        if f"{k}.attrs" in grp.attrs.keys():   # see _copy_h5_resource(link_mode="external")
+            key_attrs = json.loads(grp.attrs[f"{k}.attrs"])
+            del grp.attrs[f"{k}.attrs"]
+        chunks = (1, *src.shape[1:]) if len(src.shape)>1 else None
+        tmp = grp.create_dataset(k+"_materialized", shape=src.shape, dtype=src.dtype, 
+                                 chunks=chunks, compression=compression)
+        for i in range(src.shape[0]):  # one frame at a time to limit memory use
+            tmp[i] = src[i]
+        del grp[k]
+        grp.move(k+"_materialized", k)
+        for ak,av in attrs.items():
+            grp[k].attrs[ak] = av
+        _safe_attrs_assignment(grp[k], key_attrs)
+        n += 1
+    f.close()
+    print(f"{n} dataset(s) materialized in {fn_h5}.")
+
+# number of events read from the databroker at a time by hdf5_export(), None to read all at once
+pack_h5_batch_size = 1000
+# number of worker processes used by pack_h5() to export the headers for multi/sol holders
+pack_h5_nproc = 4
+# the databroker the pack_h5_shards() workers connect to
+pack_h5_broker = 'lix'
+# default compression profile for pack_h5(), see h5_compression_opts()
+pack_h5_compression = "gzip"
+# total memory that the packing jobs running at the same time are allowed to use
+pack_h5_mem_budget = 24*1024**3
+pack_h5_mem_log = os.path.expanduser("~/.lix_packing_mem.jsonl")
+
+def _rss():
+    """ resident memory of this process, in bytes
+    """
+    with open("/proc/self/statm") as fh:
+        return int(fh.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
 
-def pack_h5_with_lock(*args, **kwargs):
-    pack_h5_lock.acquire()
+class PackingAdmission:
+    """ packing jobs are admitted as long as their estimated memory use fits in the budget,
+        instead of allowing a fixed number of jobs; a job larger than the budget runs by itself
+        
+        the estimate is based on the descriptor shapes and the event counts in the stop document,
+        see estimate(), then scaled by a factor calibrated against the peak RSS measured for 
+        previous jobs. The jobs run as threads in the same process, so the measured peak (the
+        increase in RSS over the duration of the job) is only approximate when jobs overlap.
+    """
+    def __init__(self, budget=pack_h5_mem_budget, log_file=pack_h5_mem_log, 
+                 event_overhead=1000, base=200*1024**2):
+        self.budget = budget
+        self.log_file = log_file
+        self.event_overhead = event_overhead  # bytes per value, for events held as dicts
+        self.base = base
+        self.scale = 1.
+        self.in_use = 0
+        self.running = 0
+        self.waiting = deque()
+        self.cv = threading.Condition()
+        self.history = deque(maxlen=200)
+        if log_file and os.path.exists(log_file):
+            with open(log_file) as fh:
+                for line in fh:
+                    self.history.append(json.loads(line))
+            self.calibrate()
+    
+    def estimate_header(self, h, fields=None, batch_size=pack_h5_batch_size):
+        """ the databroker events of a stream are held in memory either all at once, or 
+            batch_size at a time; the detector frames in AD_HDF5 files are copied by hdf5 
+            one chunk at a time, so only a few frames count 
+        """
+        nevents = h.stop.get('num_events', {}) if h.stop else {}
+        nbytes = 0
+        for desc in h.descriptors:
+            n = nevents.get(desc['name'], 0)
+            rows = n if batch_size is None else min(n, batch_size)
+            for k,dk in desc['data_keys'].items():
+                if fields is not None and k not in fields:
+                    continue
+                size = int(np.prod([d for d in dk.get('shape', []) if d>0]))*8
+                if dk.get('external'):
+                    nbytes += 4*size + rows*self.event_overhead
+                else:
+                    nbytes += rows*(2*size+self.event_overhead)
+        return nbytes
+    
+    def estimate(self, uids, fields=None, batch_size=pack_h5_batch_size, nproc=1, raw=False):
+        if not isinstance(uids, list):
+            uids = [uids]
+        est = [self.estimate_header(db[u], fields, batch_size) for u in uids]
+        if nproc>1 and len(est)>1: # the headers are exported in parallel
+            nbytes = np.sum(sorted(est)[-nproc:])
+        else:
+            nbytes = np.max(est)
+        nbytes = int(self.base + nbytes)
+        if raw:
+            return nbytes
+        return int(nbytes*self.scale)
+        
+    def acquire(self, nbytes):
+        """ the jobs are admitted in the order they arrive, so that a large job is not 
+            held back indefinitely by a stream of small ones
+        """
+        ticket = object()
+        with self.cv:
+            self.waiting.append(ticket)
+            while self.waiting[0] is not ticket or (self.running>0 and self.in_use+nbytes>self.budget):
+                self.cv.wait()
+            self.waiting.popleft()
+            self.in_use += nbytes
+            self.running += 1
+            self.cv.notify_all()
+    
+    def release(self, nbytes):
+        with self.cv:
+            self.in_use -= nbytes
+            self.running -= 1
+            self.cv.notify_all()
+    
+    def record(self, uids, est, peak, dt):
+        rec = {'uid': uids if isinstance(uids, str) else uids[0], 'n': 1 if isinstance(uids, str) else len(uids), 
+               'estimate': est, 'peak': peak, 'time': dt}
+        self.history.append(rec)
+        if self.log_file:
+            try:
+                with open(self.log_file, "a") as fh:
+                    fh.write(json.dumps(rec)+"\n")
+            except OSError:
+                pass
+        self.calibrate()
+        
+    def calibrate(self):
+        """ scale the estimates so that ~90% of the recent jobs stay within the estimate
+        """
+        r = [rec['peak']/rec['estimate'] for rec in self.history if rec['estimate']>0 and rec['peak']>0]
+        if len(r)>=5:
+            self.scale = max(0.1, np.percentile(r, 90))
+        return self.scale
+
+
+class _PeakRSS:
+    """ sample the RSS of this process while the job runs
+    """
+    def __init__(self, interval=0.2):
+        self.interval = interval
+    
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+    
+    def __enter__(self):
+        self.rss0 = self.peak = _rss()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+    
+    def __exit__(self, *args):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, _rss())
+        self.delta = self.peak-self.rss0
+
+
+pack_h5_admission = PackingAdmission()
+
+def pack_h5_with_lock(uids, *args, **kwargs):
+    """ run pack_h5() once the estimated memory footprint fits in the budget, see PackingAdmission
+    """
+    nproc = kwargs.get('nproc', 1)
+    try:
+        fields = kwargs.get('fields', inspect.signature(pack_h5).parameters['fields'].default)
+        raw = pack_h5_admission.estimate(uids, fields=fields, nproc=nproc, raw=True,
+                                         batch_size=kwargs.get('batch_size', pack_h5_batch_size))
+    except Exception as e:
+        print(f"could not estimate the memory needed for packing: {e}")
+        raw = pack_h5_admission.base
+    est = int(raw*pack_h5_admission.scale)
+    pack_h5_admission.acquire(est)
+    print(f"packing admitted, estimated memory use {est/1024**2:.0f} MB, "
+          f"{pack_h5_admission.in_use/1024**2:.0f} MB of {pack_h5_admission.budget/1024**2:.0f} MB committed.")
+    t0 = time.time()
     try:
-        ret = pack_h5(*args, **kwargs)
+        with _PeakRSS() as mon:
+            ret = pack_h5(uids, *args, **kwargs)
     except Exception as e:
         print(f"An error occured when packing h5: {e}")
         ret = None
-    pack_h5_lock.release()    
+    finally:
+        pack_h5_admission.release(est)
+    # the child processes of a sharded export are not measured
+    if ret is not None and (nproc==1 or isinstance(uids, str)):
+        pack_h5_admission.record(uids, raw, mon.delta, time.time()-t0)
     return ret
 
 
@@ -57,7 +274,11 @@ def compile_replace_res_path(h):
             md['pilatus']['ramdisk'] specifies where the Pilatus data are originally saved
                 e.g. /exp_path/hdf
     """
-    md = h.start
+    return replace_res_path_from_md(h.start)
+
+def replace_res_path_from_md(md):
+    """ see compile_replace_res_path(), md is the start document
+    """
     ret = {}
     dpath = md['data_path']
     try:
@@ -73,10 +294,20 @@ def pack_h5(uids, dest_dir='', fn=None, fix_sample_name=True, stream_name=None,
             fields=['em1_sum_all_mean_value', 'em2_sum_all_mean_value', 'em2_ts_SumAll', 'em1_ts_SumAll',
                     'xsp3_spectrum_array_data', 'xsp3_image', "pilatus_trigger_time",
                     'pil1M_image', 'pilW1_image', 'pilW2_image', 
-                    'pil1M_ext_image', 'pilW1_ext_image', 'pilW2_ext_image'], replace_res_path={}):
+                    'pil1M_ext_image', 'pilW1_ext_image', 'pilW2_ext_image'], replace_res_path={},
+            batch_size=pack_h5_batch_size, link_mode="copy", nproc=1, merge_shards="copy",
+            compression=pack_h5_compression, field_compression={}, chunk_access="frame"):
     """ if only 1 uid is given, use the sample name as the file name
         any metadata associated with each uid will be retained (e.g. sample vs buffer)
         
+        link_mode="vds" or "external" creates links to the detector data in the IOC files, 
+        instead of copying the data; run h5_materialize() on the file before archiving
+        
+        for a list of uids, nproc>1 exports the headers in parallel, see pack_h5_shards()
+        
+        compression, field_compression and chunk_access are passed to hdf5_export(),
+        e.g. compression="lz4" for fast packing, see h5_compression_opts() and plan_chunks()
+        
         to avoid multiple processed requesting packaging, only 1 process is allowed at a given time
         this is i
     """
@@ -127,8 +358,16 @@ def pack_h5(uids, dest_dir='', fn=None, fix_sample_name=True, stream_name=None,
             pass
         
     print(fds)
-    hdf5_export(headers, fn, fields=fds, stream_name=stream_name, use_uid=False, 
-                replace_res_path=replace_res_path, debug=debug) #, mds= db.mds, use_uid=False) 
+    if len(headers)>1 and nproc>1:
+        pack_h5_shards([h.start['uid'] for h in headers], fn, fields=fds, stream_name=stream_name, 
+                       replace_res_path=replace_res_path, batch_size=batch_size, link_mode=link_mode, 
+                       compression=compression, field_compression=field_compression, chunk_access=chunk_access,
+                       nproc=nproc, merge=merge_shards, debug=debug)
+    else:
+        hdf5_export(headers, fn, fields=fds, stream_name=stream_name, use_uid=False, 
+                    replace_res_path=replace_res_path, batch_size=batch_size, link_mode=link_mode, 
+                    compression=compression, field_compression=field_compression, chunk_access=chunk_access,
+                    debug=debug) #, mds= db.mds, use_uid=False) 
     
     # by default the groups in the hdf5 file are named after the scan IDs
     if fix_sample_name:
@@ -144,6 +383,51 @@ def pack_h5(uids, dest_dir='', fn=None, fix_sample_name=True, stream_name=None,
     print(f"finished packing {fn} ...")
     return fn
 
+def pack_h5_shards(uids, fn, nproc=pack_h5_nproc, merge="copy", debug=False, **kwargs):
+    """ export each header into a separate file (shard) using a pool of worker processes,
+        then assemble the shards into fn, in the order of the uids
+        kwargs are passed to hdf5_export()
+        
+        merge="copy": the top-level groups are copied into fn, without decompressing the data; 
+                      the shards are deleted afterwards
+        merge="external": fn contains external links to the top-level groups in the shards,
+                      the shards are kept in a directory of their own next to fn, fn.XXXXXXXX.shards,
+                      since fn may be reused, e.g. tmp.h5 in pack_and_process()
+        the workers are spawned, see h5_shard_worker.py
+    """
+    if merge not in ["copy", "external"]:
+        raise Exception(f"invalid merge option: {merge}, valid options are copy and external.")
+    t0 = time.time()
+    shard_dir = tempfile.mkdtemp(prefix=os.path.basename(fn)+".", suffix=".shards", 
+                                 dir=os.path.dirname(os.path.abspath(fn)))
+    fn_shards = [f"{shard_dir}/{i:03d}_{uid[:8]}.h5" for i,uid in enumerate(uids)]
+    
+    variables = {k: globals()[k] for k in ["data_destination", "pilatus_data_dir"] if k in globals()}
+    with ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=h5_shard_worker.init, initargs=(pack_h5_broker, variables)) as pool:
+        futures = [pool.submit(h5_shard_worker.export_shard, uid, fs, dict(kwargs, debug=debug)) 
+                   for uid,fs in zip(uids, fn_shards)]
+        for fut in futures:
+            fs,dt = fut.result()
+            if debug:
+                print(f"{fs} exported in {dt:.1f} sec")
+    print(f"{len(uids)} headers exported using {nproc} processes in {time.time()-t0:.1f} sec ...")
+    
+    with h5py.File(fn, "w") as f:
+        for fs in fn_shards:
+            with h5py.File(fs, "r") as fsh:
+                for g in fsh.keys():
+                    if merge=="copy":
+                        f.copy(fsh[g], g)
+                    else:
+                        f[g] = h5py.ExternalLink(os.path.relpath(fs, os.path.dirname(os.path.abspath(fn))), g)
+    
+    if merge=="copy":
+        for fs in fn_shards:
+            os.remove(fs)
+        os.rmdir(shard_dir)
+    print(f"shards merged into {fn}, total time {time.time()-t0:.1f} sec ...")
+
 def h5_attach_hplc(fn):
     pass
 
@@ -204,8 +488,10 @@ from lixtools.hdf import h5sol_HPLC,h5sol_HT
 from lixtools.sol.atsas import gen_report
 import json
 
-import socket
+import socket,asyncio
 packing_queue_sock_port = 9999
+# number of worker threads used by process_packing_queue()
+packing_queue_nworkers = 3
 
 # process locally
 def send_to_packing_queue(uid, data_type): #, froot=data_file_path.gpfs, move_first=False):
@@ -229,26 +515,108 @@ def send_to_packing_queue(uid, data_type): #, froot=data_file_path.gpfs, move_fi
             print(f"scan {uid} was not successful.")
             return 
 
-    pack_and_process(data_type,uid,proc_path)
+    fn = pack_and_process(data_type,uid,proc_path)
     #threading.Thread(target=pack_and_process, args=(data_type,uid,proc_path,)).start()
     #threading.Thread(target=pack_and_process, args=(data_type,uid,proc_path,move_first,)).start() 
     print("processing thread started ...")                    
+    return fn
         
 
-def send_to_packing_queue_remote(uid, datatype, froot=data_file_path.gpfs, move_first=False):
+def send_to_packing_queue_remote(uid, datatype, froot=data_file_path.gpfs, move_first=False, host='xf16id-srv1'):
     """ data_type must be one of ["scan", "flyscan", "HPLC", "sol", "multi", "mscan"]
         single uid only for "scan", "flyscan", "HPLC"
         uids must be concatenated using '|' for "multi" and "sol"
         if move_first is True, move the files from RAMDISK to GPFS first, otherwise the RAMDISK
             may fill up since only one pack_h5 process is allow
+        returns the job id, see check_packing()
     """
     if datatype not in ["scan", "flyscan", "HPLC", "multi", "sol", "mscan", "mfscan"]:
         raise Exception("invalid data type: {datatype}, valid options are scan and HPLC.")
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-    s.connect(('xf16id-srv1', packing_queue_sock_port))
-    msg = f"{datatype}::{uid}::{proc_path}::{froot.name}::{move_first}"
-    s.send(msg.encode('ascii'))
-    s.close()
+    job_id = get_packing_queue_client(host).submit(datatype, uid, proc_path, 
+                                                   froot=froot.name, move_first=move_first)
+    print(f"submitted to the packing queue on {host} as job #{job_id}.")
+    return job_id
+
+class MapPackingJob:
+    """ a map collected in segments (separate scans) is packed as a single logical job
+        each segment is packed as soon as it is submitted, while the next one is collected:
+        either locally, one segment at a time in a background thread, or by the packing queue 
+        server (pack_remote=True)
+        finish() returns immediately; once all segments are packed, they are merged into a single
+        file named after the map, with the top-level groups in the order of the segments, and 
+        the segment files are deleted; attrs are saved as attributes of the file (as json)
+        
+        e.g. job = MapPackingJob("map1"); job.submit(db[-1].start['uid']); ...; job.finish()
+             job.result() waits and returns the file name 
+    """
+    def __init__(self, sname, data_type="flyscan", pack_remote=False, host='xf16id-srv1', 
+                 dest_dir=None, attrs={}):
+        self.sname = sname
+        self.data_type = data_type
+        self.pack_remote = pack_remote
+        self.host = host
+        self.dest_dir = proc_path if dest_dir is None else dest_dir
+        self.attrs = dict(attrs)
+        self.uids = []
+        self.job_ids = []
+        self.futures = []
+        # a single thread, so that the merging is done after all segments are packed
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.fn = None
+        self._merged = None
+        
+    def submit(self, uid):
+        self.uids.append(uid)
+        if self.pack_remote:
+            self.job_ids.append(send_to_packing_queue_remote(uid, self.data_type, host=self.host))
+        else:
+            self.futures.append(self.executor.submit(send_to_packing_queue, uid, self.data_type))
+        print(f"{self.sname}: segment #{len(self.uids)-1} submitted for packing ...")
+    
+    def segment_files(self):
+        """ wait for all submitted segments to be packed, returns the file names, None if failed
+        """
+        if self.pack_remote:
+            ret = get_packing_queue_client(self.host).wait(self.job_ids)
+            return [ret[job_id][1] if ret[job_id][0]=='done' else None for job_id in self.job_ids]
+        return [fut.result() for fut in self.futures]
+    
+    def merge(self):
+        fns = self.segment_files()
+        if None in fns:
+            raise Exception(f"{fns.count(None)} of {len(fns)} segment(s) of {self.sname} not packed, not merging ...")
+        fn = os.path.join(self.dest_dir, self.sname+".h5")
+        t0 = time.time()
+        with h5py.File(fn, "w") as f:
+            groups = []
+            for fs in fns:
+                with h5py.File(fs, "r") as fsh:
+                    for g in fsh.keys():
+                        f.copy(fsh[g], g)
+                        groups.append(g)
+            f.attrs['segments'] = json.dumps(groups)
+            for k,v in self.attrs.items():
+                f.attrs[k] = json.dumps(v)
+        for fs in fns:
+            os.remove(fs)
+        print(f"{len(fns)} segment(s) merged into {fn} in {time.time()-t0:.1f} sec ...")
+        self.fn = fn
+        return fn
+    
+    def finish(self):
+        self._merged = self.executor.submit(self.merge)
+        self.executor.shutdown(wait=False)
+        
+    def result(self, timeout=None):
+        """ the name of the merged file
+        """
+        if self._merged is None:
+            raise Exception("finish() has not been called.")
+        return self._merged.result(timeout)
+        
+    def done(self):
+        return self._merged is not None and self._merged.done()
+    
 
 def pack_and_process(data_type, uid, dest_dir):
     # useful for moving files from RAM disk to GPFS during fly scans
@@ -278,11 +646,13 @@ def pack_and_process(data_type, uid, dest_dir):
         else:
             dir_name = db[uids[0]].start['holderName']
             fh5_name = dir_name+'.h5'
-        fn = pack_h5_with_lock(uids, dest_dir, fn="tmp.h5")
+        fn = pack_h5_with_lock(uids, dest_dir, fn="tmp.h5", nproc=pack_h5_nproc)
         #fn = pack_h5(uids, fn=fh5_name)
+        if fn is None:
+            return None # packing unsuccessful
         if fh5_name != "tmp.h5":  # temporary fix, for some reason other processes cannot open the packed file
             os.system(f"cd {dest_dir} ; cp tmp.h5 {fh5_name} ; rm tmp.h5")
-        fn = fh5_name
+        fn = os.path.join(dest_dir, fh5_name)
         if fn is not None and dt_exp is not None and data_type!="mscan":
             print('processing ...')
             if data_type=="sol":    
@@ -324,42 +694,27 @@ def pack_and_process(data_type, uid, dest_dir):
     if fn is None:
         return # packing unsuccessful, 
     print(f"{time.asctime()}: finished packing/processing, total time lapsed: {time.time()-t0:.1f} sec ...")
+    return os.path.abspath(fn)
 
             
-def process_packing_queue():
+def process_packing_queue(nworkers=packing_queue_nworkers, loopback=False):
     """ this should only run on xf16idc-gpu1, moved to srv1 Mar 2022
         needed for HPLC run and microbeam mapping
+        
+        the requests are journaled in a PackingQueue and processed by nworkers threads
+        loopback=True listens on localhost instead, for testing away from xf16id-srv1
     """    
-    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
     host = socket.gethostname()                           
-    if host!='xf16id-srv1' and host!="xf16id-srv1.nsls2.bnl.local":
+    if loopback:
+        host = 'localhost'
+    elif host!='xf16id-srv1' and host!="xf16id-srv1.nsls2.bnl.local":
         raise Exception(f"this function can only run on xf16id-srv1, not {host}.")
-    serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    serversocket.bind(('xf16id-srv1', packing_queue_sock_port))  
-    serversocket.listen(5)
-    print('listening ...')
+    else:
+        host = 'xf16id-srv1'
     
-    while True:
-        clientsocket,addr = serversocket.accept()      
-        print(f"{time.asctime()}: got a connection from {addr} ...")
-        msg = clientsocket.recv(8192).decode()
-        print(msg)
-        clientsocket.close()
-        data_type,uid,path,frn,t = msg.split("::") 
-        if t is True:
-            move_first = True
-        else:
-            move_first = False
-        
-        if data_type not in ["multi", "sol", "mscan", "mfscan"]: # single UID
-            if 'exit_status' not in db[uid].stop.keys():
-                print(f"in complete header for {uid}.")
-                return
-            if db[uid].stop['exit_status'] != 'success': # the scan actually finished
-                print(f"scan {uid} was not successful.")
-                return 
-
-        threading.Thread(target=pack_and_process, args=(data_type,uid,path,)).start() 
-        print("processing thread started ...")            
-
-
+    pq = PackingQueue(nworkers=nworkers)
+    pq.start()
+    try:
+        asyncio.run(serve_packing_queue(pq, host, packing_queue_sock_port))
+    finally:
+        pq.stop()
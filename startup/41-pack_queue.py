@@ -0,0 +1,417 @@
+print(f"Loading {__file__}...")
+
+import sqlite3,threading,time,os
+import numpy as np
+
+# lower number runs first; HPLC data are needed for processing while the run is still going
+packing_priorities = {"HPLC": 0, "sol": 1, "multi": 1,
+                      "scan": 2, "mscan": 2, "flyscan": 3, "mfscan": 3}
+packing_queue_db = os.path.expanduser("~/.lix_packing_queue.sqlite")
+
+def packing_skip_reason(data_type, uid):
+    """ only scans that finished successfully are packed, checked for single uid requests
+        returns None if the job should go ahead
+    """
+    if data_type in ["multi", "sol", "mscan", "mfscan"]:
+        return None
+    stop = db[uid].stop
+    if stop is None or 'exit_status' not in stop.keys():
+        return f"incomplete header for {uid}"
+    if stop['exit_status']!='success':
+        return f"scan {uid} was not successful"
+    return None
+
+class PackingQueue:
+    """ packing requests journaled in sqlite, so that nothing is lost if the server restarts
+        jobs are processed by a fixed number of worker threads, in the order of priority,
+        then submission time
+
+        a job that fails (pack_and_process() returns None or raises) is re-queued until it
+        has been attempted max_attempts times, after retry_delay sec, doubled every time
+        a job is skipped if check_func() gives a reason, e.g. the scan was aborted
+
+        e.g. for testing without xf16id-srv1:
+            pq = PackingQueue(db_file="/tmp/pq.sqlite", nworkers=2)
+            pq.start()
+            pq.submit("scan", db[-1].start['uid'], "/tmp")
+            pq.stats()
+    """
+    def __init__(self, db_file=packing_queue_db, nworkers=3, max_attempts=3, retry_delay=30,
+                 priorities=packing_priorities, process_func=None, check_func=packing_skip_reason,
+                 poll_interval=0.5):
+        self.db_file = db_file
+        self.nworkers = nworkers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.check_func = check_func
+        self.priorities = priorities
+        # pack_and_process() is defined in 40-hdf5.py
+        self.process_func = process_func if process_func else pack_and_process
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.job_ready = threading.Event()
+        self.workers = []
+        self.running = False
+        self.t0 = time.time()
+
+        with self.lock:
+            conn = self.connect()
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                data_type TEXT, uid TEXT, dest_dir TEXT,
+                                priority INTEGER, state TEXT, attempts INTEGER DEFAULT 0,
+                                t_submit REAL, t_start REAL, t_finish REAL,
+                                fn TEXT, error TEXT, t_retry REAL DEFAULT 0)""")
+            if "t_retry" not in [r[1] for r in conn.execute("PRAGMA table_info(jobs)")]:
+                conn.execute("ALTER TABLE jobs ADD COLUMN t_retry REAL DEFAULT 0")
+            # jobs that were running when the server went down start over
+            n = conn.execute("UPDATE jobs SET state='queued' WHERE state='running'").rowcount
+            conn.commit()
+            conn.close()
+        if n>0:
+            print(f"{n} interrupted packing job(s) re-queued.")
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def submit(self, data_type, uid, dest_dir, priority=None):
+        """ returns the job id
+            if the same request is already queued or running, the id of that job is returned,
+            so that a request re-sent by the client (e.g. after a reconnect) is not packed twice
+        """
+        if priority is None:
+            priority = self.priorities.get(data_type, max(self.priorities.values())+1)
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute("""SELECT id FROM jobs WHERE data_type=? AND uid=? AND dest_dir=?
+                                  AND state IN ('queued','running') ORDER BY id LIMIT 1""",
+                               (data_type, uid, dest_dir)).fetchone()
+            if row is not None:
+                conn.close()
+                return row[0]
+            cur = conn.execute("INSERT INTO jobs (data_type,uid,dest_dir,priority,state,t_submit) VALUES (?,?,?,?,?,?)",
+                               (data_type, uid, dest_dir, priority, 'queued', time.time()))
+            conn.commit()
+            job_id = cur.lastrowid
+            conn.close()
+        self.job_ready.set()
+        return job_id
+
+    def claim(self):
+        """ mark the next job as running and return (id, data_type, uid, dest_dir), None if the queue is empty
+            jobs to be retried are left in the queue until their retry time
+        """
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute("""SELECT id,data_type,uid,dest_dir FROM jobs WHERE state='queued'
+                                  AND (t_retry IS NULL OR t_retry<=?)
+                                  ORDER BY priority,id LIMIT 1""", (time.time(),)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET state='running', attempts=attempts+1, t_start=? WHERE id=?",
+                             (time.time(), row[0]))
+                conn.commit()
+            conn.close()
+        return row
+
+    def finish(self, job_id, fn=None, error=None, skipped=False):
+        with self.lock:
+            conn = self.connect()
+            attempts, = conn.execute("SELECT attempts FROM jobs WHERE id=?", (job_id,)).fetchone()
+            t_retry = 0
+            if skipped:
+                state = 'skipped'
+            elif fn is not None:
+                state = 'done'
+            elif attempts<self.max_attempts:
+                state = 'queued'
+                t_retry = time.time()+self.retry_delay*2**(attempts-1)
+            else:
+                state = 'failed'
+            conn.execute("UPDATE jobs SET state=?, t_finish=?, fn=?, error=?, t_retry=? WHERE id=?",
+                         (state, time.time(), fn, error, t_retry, job_id))
+            conn.commit()
+            conn.close()
+        return state
+
+    def worker(self):
+        while self.running:
+            job = self.claim()
+            if job is None:
+                self.job_ready.wait(self.poll_interval)
+                self.job_ready.clear()
+                continue
+            job_id,data_type,uid,dest_dir = job
+            print(f"{time.asctime()}: starting job #{job_id}, {data_type}::{uid[:80]} ...")
+            fn = None
+            error = None
+            skipped = False
+            try:
+                if self.check_func is not None:
+                    error = self.check_func(data_type, uid)
+                    skipped = error is not None
+                if not skipped:
+                    fn = self.process_func(data_type, uid, dest_dir)
+                    if fn is None:
+                        error = "packing unsuccessful"
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            state = self.finish(job_id, fn=fn, error=error, skipped=skipped)
+            print(f"{time.asctime()}: job #{job_id} {state}" + (f", {error}" if error else ""))
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.t0 = time.time()
+        self.workers = [threading.Thread(target=self.worker, daemon=True) for i in range(self.nworkers)]
+        for w in self.workers:
+            w.start()
+
+    def stop(self, wait=True):
+        """ running jobs are allowed to finish
+        """
+        self.running = False
+        self.job_ready.set()
+        if wait:
+            for w in self.workers:
+                w.join()
+        self.workers = []
+
+    def depth(self):
+        """ number of jobs waiting to be processed
+        """
+        with self.lock:
+            conn = self.connect()
+            n, = conn.execute("SELECT COUNT(*) FROM jobs WHERE state='queued'").fetchone()
+            conn.close()
+        return n
+
+    def job_state(self, job_id):
+        """ returns (state, fn, error)
+        """
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute("SELECT state,fn,error FROM jobs WHERE id=?", (job_id,)).fetchone()
+            conn.close()
+        return row
+
+    def stats(self, since=None):
+        """ queue depth, latency (submission to completion) and throughput (jobs per hour)
+            for the jobs completed since the queue was started, or since the given time
+        """
+        if since is None:
+            since = self.t0
+        with self.lock:
+            conn = self.connect()
+            count = dict(conn.execute("SELECT state,COUNT(*) FROM jobs GROUP BY state").fetchall())
+            rows = conn.execute("""SELECT t_start-t_submit,t_finish-t_submit FROM jobs
+                                   WHERE state='done' AND t_finish>?""", (since,)).fetchall()
+            conn.close()
+        ret = {'depth': count.get('queued', 0),
+               'running': count.get('running', 0),
+               'done': count.get('done', 0),
+               'failed': count.get('failed', 0),
+               'skipped': count.get('skipped', 0),
+               'completed': len(rows)}
+        if len(rows)>0:
+            wait,latency = np.asarray(rows).T
+            ret['mean_wait'] = np.mean(wait)
+            ret['mean_latency'] = np.mean(latency)
+            ret['max_latency'] = np.max(latency)
+        dt = time.time()-since
+        ret['throughput'] = len(rows)/dt*3600 if dt>0 else 0
+        return ret
+
+
+# the packing queue server and its clients exchange JSON messages, each preceded by its length
+# as a 4-byte big-endian integer, over connections that are kept open between requests
+#     {"cmd": "submit", "data_type": ..., "uid": ..., "dest_dir": ...} -> {"ok": True, "job_id": ...}
+#     {"cmd": "status", "job_id": ...} -> {"ok": True, "state": ..., "fn": ..., "error": ...}
+#     {"cmd": "stats"} -> {"ok": True, "stats": {...}}
+# errors are returned as {"ok": False, "error": ...}
+# a "seq" in the request is returned in the reply
+# submit is idempotent while the job is queued or running, see PackingQueue.submit()
+import asyncio,json,struct,concurrent.futures
+
+packing_queue_max_frame = 64*1024*1024
+
+async def read_frame(reader):
+    """ returns None when the connection is closed
+    """
+    try:
+        hdr = await reader.readexactly(4)
+    except asyncio.IncompleteReadError:
+        return None
+    n, = struct.unpack(">I", hdr)
+    if n>packing_queue_max_frame:
+        raise Exception(f"frame too large: {n} bytes")
+    return json.loads((await reader.readexactly(n)).decode())
+
+async def write_frame(writer, msg):
+    data = json.dumps(msg).encode()
+    writer.write(struct.pack(">I", len(data))+data)
+    await writer.drain()
+
+async def serve_packing_queue(pq, host, port=packing_queue_sock_port):
+    """ pq is a PackingQueue
+        the sqlite calls are run in the default executor so that a busy journal does not block
+        the other connections
+    """
+    loop = asyncio.get_running_loop()
+
+    def handle(msg):
+        cmd = msg.get("cmd")
+        if cmd=="submit":
+            job_id = pq.submit(msg['data_type'], msg['uid'], msg['dest_dir'], priority=msg.get('priority'))
+            print(f"{time.asctime()}: job #{job_id} queued, {msg['data_type']}::{msg['uid'][:80]}")
+            return {"ok": True, "job_id": job_id}
+        elif cmd=="status":
+            row = pq.job_state(msg['job_id'])
+            if row is None:
+                return {"ok": False, "error": f"unknown job id {msg['job_id']}"}
+            state,fn,error = row
+            return {"ok": True, "job_id": msg['job_id'], "state": state, "fn": fn, "error": error}
+        elif cmd=="stats":
+            return {"ok": True, "stats": pq.stats()}
+        return {"ok": False, "error": f"unknown command: {cmd}"}
+
+    async def client_connected(reader, writer):
+        addr = writer.get_extra_info('peername')
+        print(f"{time.asctime()}: got a connection from {addr} ...")
+        try:
+            while True:
+                msg = await read_frame(reader)
+                if msg is None:
+                    break
+                try:
+                    ret = await loop.run_in_executor(None, handle, msg)
+                except Exception as e:
+                    ret = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                if 'seq' in msg:
+                    ret['seq'] = msg['seq']
+                await write_frame(writer, ret)
+        except Exception as e:
+            print(f"{time.asctime()}: dropping connection from {addr}: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(client_connected, host, port, reuse_address=True)
+    print(f'listening on {host}:{port} ...')
+    async with server:
+        await server.serve_forever()
+
+
+class PackingQueueClient:
+    """ keeps a connection open to the packing queue server
+        the asyncio loop runs in its own thread, so that the blocking methods can be called from
+        plans and from the IPython prompt alike
+    """
+    def __init__(self, host='xf16id-srv1', port=packing_queue_sock_port, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.seq = 0
+        self.loop = asyncio.new_event_loop()
+        self.lock = None
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    async def _connect(self):
+        self.reader,self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def _request(self, msg):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:  # one outstanding request per connection
+            for retry in range(2):
+                if self.writer is None:
+                    await self._connect()
+                self.seq += 1
+                msg['seq'] = self.seq
+                try:
+                    await write_frame(self.writer, msg)
+                    ret = await read_frame(self.reader)
+                    if ret is None:
+                        raise ConnectionError("connection closed by server")
+                    if ret.get('seq')!=msg['seq']:
+                        raise ConnectionError(f"reply to request #{ret.get('seq')} received for #{msg['seq']}")
+                    break
+                except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+                    # the server may have been restarted, e.g. in the middle of a reply, reconnect once
+                    # re-sending is safe, submit is idempotent on the server
+                    self.writer.close()
+                    self.writer = None
+                    if retry>0:
+                        raise
+                except asyncio.CancelledError:
+                    # timed out in request(), the reply may still come, the connection cannot be reused
+                    self.writer.close()
+                    self.writer = None
+                    raise
+        if not ret.pop('ok', False):
+            raise Exception(f"packing queue request failed: {ret.get('error')}")
+        return ret
+
+    def request(self, msg):
+        fut = asyncio.run_coroutine_threadsafe(self._request(msg), self.loop)
+        try:
+            return fut.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            fut.cancel()    # _request() drops the connection
+            raise
+
+    def submit(self, data_type, uid, dest_dir, priority=None, **kwargs):
+        """ returns the job id
+        """
+        msg = {"cmd": "submit", "data_type": data_type, "uid": uid, "dest_dir": dest_dir, "priority": priority}
+        msg.update(kwargs)
+        return self.request(msg)['job_id']
+
+    def status(self, job_id):
+        """ returns (state, fn, error)
+        """
+        ret = self.request({"cmd": "status", "job_id": job_id})
+        return ret['state'],ret['fn'],ret['error']
+
+    def stats(self):
+        return self.request({"cmd": "stats"})['stats']
+
+    def wait(self, job_ids, timeout=None, poll_interval=2):
+        """ wait for the jobs to either finish, fail or be skipped, return {job_id: (state, fn, error)}
+            returns early if timeout (in sec) is reached
+        """
+        t0 = time.time()
+        ret = {}
+        while True:
+            ret = {job_id: self.status(job_id) for job_id in job_ids}
+            if all([s[0] in ['done', 'failed', 'skipped'] for s in ret.values()]):
+                break
+            if timeout is not None and time.time()-t0>timeout:
+                break
+            time.sleep(poll_interval)
+        return ret
+
+    def close(self):
+        if self.writer is not None:
+            self.loop.call_soon_threadsafe(self.writer.close)
+            self.writer = None
+
+
+packing_queue_clients = {}
+
+def get_packing_queue_client(host='xf16id-srv1'):
+    """ one persistent connection per server
+    """
+    if host not in packing_queue_clients.keys():
+        packing_queue_clients[host] = PackingQueueClient(host)
+    return packing_queue_clients[host]
+
+def check_packing(job_ids, host='xf16id-srv1', timeout=0):
+    """ print the state of the packing jobs submitted using send_to_packing_queue_remote()
+        return True if all have been packed successfully
+    """
+    ret = get_packing_queue_client(host).wait(job_ids, timeout=timeout)
+    for job_id,(state,fn,error) in ret.items():
+        print(f"job #{job_id}: {state}", f"{fn}" if fn else "", f"{error}" if error else "")
+    return all([s[0]=='done' for s in ret.values()])
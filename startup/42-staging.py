@@ -0,0 +1,198 @@
+print(f"Loading {__file__}...")
+
+import os,time,threading,zlib
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+
+class ResourceStager:
+    """ move the detector files from the RAMDISK to the IOC data directory while the data
+        collection continues, instead of when the data are packed
+
+        subscribed to RE, the AD_HDF5 resources of each run are recorded as they are emitted,
+        and queued for copying once the stop document is received (the IOC closes the files
+        when the detectors are unstaged). Up to nworkers files are copied at the same time.
+        The copy is made to a temporary file of its own (see partial_name()), created before
+        waiting for the original to settle, verified against a re-read of the original using
+        CRC32, then renamed, before the original is removed.
+        locate_h5_resource() waits for the file in progress through wait_for().
+
+        the destination is determined from the start document, as in compile_replace_res_path()
+    """
+    def __init__(self, nworkers=2, block_size=16*1024*1024, settle_time=1.0, max_attempts=2):
+        self.nworkers = nworkers
+        self.block_size = block_size
+        self.settle_time = settle_time
+        self.max_attempts = max_attempts
+        self.executor = ThreadPoolExecutor(max_workers=nworkers, thread_name_prefix="staging")
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.pending = 0
+        self.active = 0
+        self.nfiles = 0
+        self.nfailed = 0
+        self.nbytes = 0
+        self.recent = deque()  # (time finished, bytes), for the recent transfer rate
+        self.subid = None
+        self.inflight = {}     # fn -> Future, files queued or being copied
+
+    def __call__(self, name, doc):
+        if name=="start":
+            try:
+                rp = replace_res_path_from_md(doc)
+            except Exception as e:
+                print(f"staging: could not determine the data destination: {e}")
+                rp = {}
+            self.runs[doc['uid']] = (rp, [])
+        elif name=="resource":
+            if doc['spec']!="AD_HDF5" or doc['run_start'] not in self.runs.keys():
+                return
+            self.runs[doc['run_start']][1].append(doc)
+        elif name=="stop":
+            if doc['run_start'] not in self.runs.keys():
+                return
+            rp,resources = self.runs.pop(doc['run_start'])
+            for res in resources:
+                fn_orig = str(Path(res["root"]) / Path(res["resource_path"]))
+                fn = update_res_path(fn_orig, rp)
+                if fn!=fn_orig:
+                    self.submit(fn_orig, fn)
+
+    def submit(self, fn_orig, fn):
+        with self.lock:
+            if fn in self.inflight.keys():
+                return self.inflight[fn]
+            self.pending += 1
+            fut = self.executor.submit(self.stage, fn_orig, fn)
+            self.inflight[fn] = fut
+        fut.add_done_callback(lambda f: self._done(fn, f))
+        return fut
+
+    def _done(self, fn, fut):
+        with self.lock:
+            if self.inflight.get(fn) is fut:
+                del self.inflight[fn]
+
+    def wait_for(self, fn, timeout=None):
+        """ wait for the file to be staged, if it is queued or being copied
+            returns False if it is still in progress after timeout
+        """
+        with self.lock:
+            fut = self.inflight.get(fn)
+        if fut is None:
+            return True
+        done,_ = concurrent.futures.wait([fut], timeout=timeout)
+        return len(done)>0
+
+    def wait_for_settle(self, fn, timeout=30):
+        """ the file is considered complete when its size stops changing
+        """
+        t0 = time.time()
+        size = os.path.getsize(fn)
+        while time.time()-t0<timeout:
+            time.sleep(self.settle_time)
+            s = os.path.getsize(fn)
+            if s==size:
+                return
+            size = s
+        raise Exception(f"{fn} is still changing after {timeout} sec.")
+
+    def copy_with_crc(self, src, dest):
+        crc = 0
+        with open(src, "rb") as fs, open(dest, "wb") as fd:
+            while True:
+                buf = fs.read(self.block_size)
+                if not buf:
+                    break
+                crc = zlib.crc32(buf, crc)
+                fd.write(buf)
+        return crc
+
+    def file_crc(self, fn):
+        crc = 0
+        with open(fn, "rb") as fh:
+            while True:
+                buf = fh.read(self.block_size)
+                if not buf:
+                    break
+                crc = zlib.crc32(buf, crc)
+        return crc
+
+    def stage(self, fn_orig, fn):
+        tfn = partial_name(fn)
+        with self.lock:
+            self.pending -= 1
+            self.active += 1
+        try:
+            if not os.path.exists(fn_orig) or os.path.exists(fn):
+                return # already moved, e.g. by locate_h5_resource()
+            fdir = os.path.dirname(fn)
+            if not os.path.exists(fdir):
+                makedirs(fdir, mode=0o2775)
+            # created before waiting for the file to settle, so that wait_for_staging() in
+            # another process sees the copy in progress
+            open(tfn, "wb").close()
+            self.wait_for_settle(fn_orig)
+            if os.path.exists(fn):
+                return # copied by another process in the meantime
+            for i in range(self.max_attempts):
+                crc = self.copy_with_crc(fn_orig, tfn)
+                if self.file_crc(tfn)==crc and self.file_crc(fn_orig)==crc:
+                    break
+                print(f"staging: checksum mismatch for {tfn} ...")
+            else:
+                raise Exception(f"failed to copy {fn_orig} after {self.max_attempts} attempts.")
+            nbytes = os.path.getsize(tfn)
+            # the file is always at one of the locations, at both briefly
+            os.rename(tfn, fn)
+            try:
+                os.remove(fn_orig)
+            except FileNotFoundError:
+                pass # removed by another copier
+            with self.lock:
+                self.nfiles += 1
+                self.nbytes += nbytes
+                self.recent.append((time.time(), nbytes))
+        except Exception as e:
+            print(f"staging: {fn_orig} left in place, {e}")
+            with self.lock:
+                self.nfailed += 1
+        finally:
+            if os.path.exists(tfn):
+                os.remove(tfn)
+            with self.lock:
+                self.active -= 1
+
+    def stats(self, window=60):
+        """ queue depth and the transfer rate over the last window sec
+        """
+        t = time.time()
+        with self.lock:
+            while len(self.recent)>0 and self.recent[0][0]<t-window:
+                self.recent.popleft()
+            nb = sum([b for ts,b in self.recent])
+            return {'depth': self.pending, 'active': self.active,
+                    'files': self.nfiles, 'failed': self.nfailed, 'bytes': self.nbytes,
+                    'bytes_per_sec': nb/window}
+
+
+def start_staging(nworkers=2):
+    """ subscribe a ResourceStager to RE
+    """
+    global resource_stager
+    stop_staging()
+    resource_stager = ResourceStager(nworkers=nworkers)
+    resource_stager.subid = RE.subscribe(resource_stager)
+    return resource_stager
+
+def stop_staging():
+    global resource_stager
+    if resource_stager is not None:
+        if resource_stager.subid is not None:
+            RE.unsubscribe(resource_stager.subid)
+        resource_stager.executor.shutdown(wait=False)
+    resource_stager = None
+
+resource_stager = None
+start_staging()
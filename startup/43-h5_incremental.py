@@ -0,0 +1,276 @@
+print(f"Loading {__file__}...")
+
+import h5py,time,threading,queue,os
+import numpy as np
+from pathlib import Path
+
+def descriptor_dtype(dk):
+    """ numpy dtype of a data_key in the descriptor, dtype_numpy if given, otherwise from the json type
+    """
+    if dk.get('dtype_numpy'):
+        return np.dtype(dk['dtype_numpy'])
+    return {'integer': np.int64, 'boolean': bool}.get(dk['dtype'], float)
+
+class IncrementalH5Packer:
+    """ write the data into an hdf5 file as the documents are emitted, so that the file can be
+        read (in SWMR mode) while the data collection is still in progress, e.g. by h5sol_HPLC
+
+        subscribe to RE, see start_incremental_packing(), call stop() once the scan is done
+        the layout is the same as that of pack_h5(): /{sample_name}/{stream_name}/data/{key} etc.
+
+        in SWMR mode no datasets can be added once writing starts, the datasets are therefore
+        created at the first event in stream_name (normally "primary"), for all the streams
+        described by then. Streams described later, as well as string data, are left out.
+        The detector frames are copied from the AD_HDF5 files, which must be written by the IOC
+        in SWMR mode to be read before the scan ends (LIXhdfPlugin.swmr, see pil.use_swmr());
+        otherwise only the scalar data are live and the frames are copied at the end.
+
+        the file is a preview; the packed file produced by the packing queue at the end of the
+        scan is still the one to keep
+    """
+    def __init__(self, fn, fields=None, stream_name="primary", flush_interval=2.0,
+                 compression=pack_h5_compression, replace_res_path=None):
+        self.fn = fn
+        self.fields = fields
+        self.stream_name = stream_name
+        self.flush_interval = flush_interval
+        self.opts = h5_compression_opts(compression)
+        self.replace_res_path = replace_res_path
+        self.docs = queue.Queue()
+        self.subid = None
+        self.thread = threading.Thread(target=self.process_docs, daemon=True)
+        self.thread.start()
+        self.reset()
+
+    def reset(self):
+        self.fh5 = None
+        self.start = None
+        self.descriptors = {}
+        self.resources = {}
+        self.buffered = []     # events received before the file is ready
+        self.pending = {}      # descriptor uid -> events not yet written
+        self.res_keys = {}     # descriptor uid -> {key: resource uid}
+        self.frames = {}       # (descriptor uid, key) -> number of frames written
+        self.nevents = {}      # descriptor uid -> number of events written
+        self.sources = {}      # resource uid -> (h5py.File, dataset)
+        self.skipped = set()   # (descriptor uid, key) that could not be written
+        self.t_flush = 0
+
+    def __call__(self, name, doc):
+        # the RE thread only queues the documents
+        self.docs.put((name, doc))
+
+    def stop(self, timeout=600):
+        """ unsubscribe from RE, then wait for the queued documents to be processed
+        """
+        if self.subid is not None:
+            RE.unsubscribe(self.subid)
+            self.subid = None
+        self.docs.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print(f"incremental packing of {self.fn}: documents still being processed after {timeout} s.")
+
+    def process_docs(self):
+        while True:
+            item = self.docs.get()
+            if item is None:
+                break
+            name,doc = item
+            try:
+                getattr(self, f"on_{name}", lambda doc: None)(doc)
+            except Exception as e:
+                print(f"incremental packing of {self.fn}: error processing {name} document, {e}")
+
+    def on_start(self, doc):
+        self.reset()
+        self.start = doc
+        if self.replace_res_path is None:
+            try:
+                self.rp = _res_path_map(replace_res_path_from_md(doc))
+            except Exception:
+                self.rp = _res_path_map({})
+        else:
+            self.rp = _res_path_map(self.replace_res_path)
+
+    def on_descriptor(self, doc):
+        if self.fh5 is not None:
+            print(f"incremental packing: stream {doc['name']} described after writing started, skipped.")
+            return
+        self.descriptors[doc['uid']] = doc
+
+    def on_resource(self, doc):
+        self.resources[doc['uid']] = doc
+
+    def on_event(self, doc):
+        if doc['descriptor'] not in self.descriptors.keys():
+            return
+        if self.fh5 is None:
+            self.buffered.append(doc)
+            if self.descriptors[doc['descriptor']]['name']!=self.stream_name:
+                return
+            self.open()
+            for ev in self.buffered:
+                self.pending[ev['descriptor']].append(ev)
+            self.buffered = []
+        else:
+            self.pending[doc['descriptor']].append(doc)
+        if time.time()-self.t_flush>self.flush_interval:
+            self.flush()
+
+    def on_stop(self, doc):
+        if self.fh5 is None:
+            print(f"incremental packing: no data written to {self.fn}.")
+            return
+        self.flush(final=True)
+        for hf,dset in self.sources.values():
+            hf.close()
+        self.fh5.close()
+        # attributes cannot be modified in SWMR mode
+        with h5py.File(self.fn, "r+") as f:
+            _safe_attrs_assignment(f[self.group_name],
+                                   {'stop': doc, 'descriptors': list(self.descriptors.values())})
+        print(f"incremental packing: {self.fn} completed.")
+        self.fh5 = None
+
+    def keys(self, desc):
+        return [k for k in desc['data_keys'].keys() if self.fields is None or k in self.fields]
+
+    def open_source(self, res_uid, swmr=True):
+        """ returns the dataset in the AD_HDF5 file, None if the file cannot be read yet
+        """
+        if res_uid in self.sources.keys():
+            return self.sources[res_uid][1]
+        res = self.resources[res_uid]
+        fn_orig = str(Path(res["root"]) / Path(res["resource_path"]))
+        fn = update_res_path(fn_orig, self.rp)
+        if not os.path.exists(fn):  # not moved yet
+            fn = fn_orig
+        try:
+            if swmr:
+                hf = h5py.File(fn, "r", libver='latest', swmr=True)
+            else:
+                hf = h5py.File(fn, "r")
+        except OSError:
+            return None
+        if "data" in hf["/entry"].keys():
+            dset = hf["/entry/data/data"]
+        else:
+            dset = hf["/entry/instrument/detector/data"]
+        self.sources[res_uid] = (hf, dset)
+        return dset
+
+    def frame_per_point(self, res_uid):
+        return self.resources[res_uid].get('resource_kwargs', {}).get('frame_per_point', 1)
+
+    def open(self):
+        """ create all datasets, then switch to SWMR mode
+        """
+        self.group_name = self.start.get('sample_name', f"data_{self.start['scan_id']}")
+        self.fh5 = h5py.File(self.fn, "w", libver='latest')
+        grp = self.fh5.create_group(self.group_name)
+        _safe_attrs_assignment(grp, {'start': self.start})
+        for desc_uid,desc in self.descriptors.items():
+            self.pending[desc_uid] = []
+            self.res_keys[desc_uid] = {}
+            self.nevents[desc_uid] = 0
+            ev = next((e for e in self.buffered if e['descriptor']==desc_uid), None)
+            dgrp = grp.create_group(desc['name'])
+            _safe_attrs_assignment(dgrp, desc)
+            dgrp.create_dataset('time', shape=(0,), maxshape=(None,), dtype=float, chunks=(1024,), **self.opts)
+            data_group = dgrp.create_group('data')
+            ts_group = dgrp.create_group('timestamps')
+            for k in self.keys(desc):
+                dk = desc['data_keys'][k]
+                if dk['dtype']=='string':
+                    continue
+                # from the descriptor, the values in the first event may not be representative,
+                # e.g. a float that happens to be an integer
+                shape = [d for d in dk.get('shape', []) if d>0]
+                dtype = descriptor_dtype(dk)
+                if ev is not None:
+                    v = ev['data'][k]
+                    if isinstance(v, str) and v.split('/')[0] in self.resources.keys():
+                        self.res_keys[desc_uid][k] = v.split('/')[0]
+                        src = self.open_source(self.res_keys[desc_uid][k])
+                        # the frames are copied as they are in the source, as in _copy_h5_resource()
+                        fpp = self.frame_per_point(self.res_keys[desc_uid][k])
+                        if src is not None:
+                            shape,dtype = src.shape[1:],src.dtype
+                        else:
+                            if fpp>1 and len(shape)>0 and shape[0]==fpp:
+                                shape = shape[1:]
+                            if not dk.get('dtype_numpy'):
+                                dtype = np.int32
+                    elif isinstance(v, str):
+                        continue
+                    elif len(shape)==0 and dk['dtype']=='array':    # shape not in the descriptor
+                        shape = np.asarray(v).shape
+                elif dk.get('external'):
+                    continue
+                chunks = plan_chunks((1024, *shape), dtype) if len(shape)>1 else (1024, *shape)
+                data_group.create_dataset(k, shape=(0, *shape), maxshape=(None, *shape), dtype=dtype,
+                                          chunks=chunks, **self.opts)
+                ts_group.create_dataset(k, shape=(0,), maxshape=(None,), dtype=float, chunks=(1024,), **self.opts)
+                if k in self.res_keys[desc_uid].keys():
+                    self.frames[(desc_uid, k)] = 0
+        self.fh5.swmr_mode = True
+        print(f"incremental packing: writing to {self.fn} in SWMR mode ...")
+
+    def append(self, dset, data):
+        data = np.asarray(data)
+        if data.shape[1:]!=dset.shape[1:]:
+            raise Exception(f"expected shape {dset.shape[1:]}, got {data.shape[1:]}")
+        n = dset.shape[0]
+        dset.resize(n+len(data), axis=0)
+        dset[n:] = data
+
+    def flush(self, final=False):
+        for desc_uid,evs in self.pending.items():
+            dgrp = self.fh5[self.group_name][self.descriptors[desc_uid]['name']]
+            if len(evs)>0:
+                self.append(dgrp['time'], [e['time'] for e in evs])
+                for k in dgrp['data'].keys():
+                    if (desc_uid, k) in self.skipped:
+                        continue
+                    try:
+                        if k not in self.res_keys[desc_uid].keys():
+                            self.append(dgrp['data'][k], [e['data'][k] for e in evs])
+                        self.append(dgrp['timestamps'][k], [e['timestamps'][k] for e in evs])
+                    except Exception as e:
+                        print(f"incremental packing: cannot write {k}, skipped: {e}")
+                        self.skipped.add((desc_uid, k))
+                self.nevents[desc_uid] += len(evs)
+                self.pending[desc_uid] = []
+            for k,res_uid in self.res_keys[desc_uid].items():
+                if k in dgrp['data'].keys():
+                    self.copy_frames(desc_uid, k, res_uid, dgrp['data'][k], final)
+        self.fh5.flush()
+        self.t_flush = time.time()
+
+    def copy_frames(self, desc_uid, k, res_uid, dset, final=False):
+        """ copy the frames that are available in the source file, up to the number of events
+            times the frames per event
+        """
+        if final and res_uid not in self.sources.keys():
+            src = self.open_source(res_uid, swmr=False)
+        else:
+            src = self.open_source(res_uid)
+        if src is None:
+            return
+        if src.file.swmr_mode:
+            src.refresh()
+        n0 = self.frames[(desc_uid, k)]
+        n1 = min(src.shape[0], self.nevents[desc_uid]*self.frame_per_point(res_uid))
+        if n1>n0:
+            self.append(dset, src[n0:n1])
+            self.frames[(desc_uid, k)] = n1
+
+
+def start_incremental_packing(fn, **kwargs):
+    """ returns the packer, call packer.stop() once the scan is done
+        kwargs are passed to IncrementalH5Packer
+    """
+    packer = IncrementalH5Packer(fn, **kwargs)
+    packer.subid = RE.subscribe(packer)
+    return packer
@@ -38,6 +38,7 @@ if BSconfig in ["solution", "scanning", "generic", "vacuum"]:
     reload_macros("components/30-traj.py")
     reload_macros("components/31-raster.py")
     reload_macros("components/31-scans.py")
+    reload_macros("components/32-map.py")
 
     reload_macros("utils/60-utils.py")
     reload_macros("utils/90-settings.py")
@@ -72,6 +72,7 @@ class ZebraPositionCapture(Device):
     dir = Cpt(EpicsSignalWithRBV, "PC_DIR")
     tspre = Cpt(EpicsSignalWithRBV, "PC_TSPRE")
     trig_source = Cpt(EpicsSignalWithRBV, "PC_ARM_SEL")
+    arm_input = Cpt(EpicsSignalWithRBV, "PC_ARM_INP")
     arm = Cpt(EpicsSignal, "PC_ARM")
     disarm = Cpt(EpicsSignal, "PC_DISARM")
     armed = Cpt(EpicsSignalRO, "PC_ARM_OUT")
@@ -259,3 +260,31 @@ zebra.or1.use1.put(1)
 zebra.or1.use2.put(1)
 zebra.output1.ttl.addr.put(ZA.OR1)
 
+
+def set_zebra_line_gate(z, nlines, t_line, t_period):
+    """ pass the trajectory pulses from the XPS (PULSE1) on to the detectors only during the lines 
+        of a serpentine raster, see raster(..., serpentine=True)
+        the PC gate is time-based, armed by the first pulse; nlines gates of t_line, every t_period 
+    """
+    z.pc.disarm.put(1)
+    # the units of the gate parameters depend on the source and time units, set these first
+    setSignals([(z.pc.trig_source, "External"),
+                (z.pc.arm_input, ZA.IN3_OC),
+                (z.pc.tspre, "s"),
+                (z.pc.gate_source, "Time"),
+                (z.and1.input_source1, ZA.PULSE1),
+                (z.and1.input_source2, ZA.PC_GATE),
+                (z.and1.use1, 1), (z.and1.use2, 1), (z.and1.use3, 0), (z.and1.use4, 0)])
+    setSignals([(z.pc.gate_start, 0),
+                (z.pc.gate_width, t_line),
+                (z.pc.gate_step, t_period),
+                (z.pc.gate_num, nlines),
+                (z.or1.input_source1, ZA.AND1)])
+    z.pc.arm.put(1)
+
+def clear_zebra_line_gate(z):
+    """ back to every XPS pulse triggering the detectors
+    """
+    z.pc.disarm.put(1)
+    setSignals([(z.or1.input_source1, ZA.PULSE1),
+                (z.pc.trig_source, "Soft")])
@@ -9,6 +9,8 @@ from ophyd.sim import NullStatus
 from ophyd import DynamicDeviceComponent as DDCpt
 from collections import OrderedDict
 from nslsii.ad33 import QuadEMV33
+from ophyd.areadetector.filestore_mixins import resource_factory
+import threading,os,h5py
 
 class Best(Device):
     x_mean  = Cpt(EpicsSignal, ':BPM0:PosX_Mean')
@@ -44,6 +46,7 @@ class TimeSeries(Device):
     acquire = ADCpt(EpicsSignal, "TSAcquire", kind='omitted')
     acquire_mode = ADCpt(EpicsSignal, "TSAcquireMode", string=True, kind='config')
     acquiring = ADCpt(EpicsSignalRO, "TSAcquiring", kind='omitted')
+    read_arrays = ADCpt(EpicsSignal, "TSRead", kind='omitted')
 
     time_axis = ADCpt(EpicsSignalRO, "TSTimeAxis", kind='config')
     read_rate = ADCpt(EpicsSignal, "TSRead.SCAN", string=True, kind='config')
@@ -52,6 +55,186 @@ class TimeSeries(Device):
     current_point = ADCpt(EpicsSignalRO, "TSCurrentPoint", kind="omitted")
 
 
+class TimeSeriesCapture:
+    """ reads back the time series of the sum and all four channels, for LiXTetrAMMext in the
+        "channels" capture mode
+        the TS buffer is used in the fixed length mode, each buffer is read back as soon as
+        TSAcquiring goes to Done, the arrays are taken from the monitors, and the next buffer
+        is started right away, until all points are read back
+        the points that come in while a buffer is read back are lost, a buffer therefore holds whole
+        lines if possible, no triggers come in between lines
+        each buffer is placed at the number of points acquired (NumAcquired) before it started,
+        relative to start(), see _buffer_offset(); the lost points are left as NaN
+    """
+    channels = ["SumAll", "current1", "current2", "current3", "current4"]
+    max_points = 2048       # the size of the time series arrays in the IOC
+    read_timeout = 5
+
+    def __init__(self, ts, num_acquired):
+        self.ts = ts
+        self.num_acquired = num_acquired
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._acquiring = None
+        self._arrays = {}
+        self.nbuffers = 0
+
+    def _acquiring_changed(self, value=None, **kwargs):
+        with self._cond:
+            if self._acquiring==0 and value==1:
+                self._nstarted += 1
+            elif self._acquiring==1 and value==0:
+                self._nfinished += 1
+            self._acquiring = value
+            self._cond.notify_all()
+
+    def _array_posted(self, value=None, obj=None, **kwargs):
+        with self._cond:
+            self._arrays[obj.attr_name] = np.asarray(value)
+            self._cond.notify_all()
+
+    def _wait_for(self, cond, timeout, msg):
+        with self._cond:
+            if not self._cond.wait_for(cond, timeout):
+                raise Exception(f"{self.ts.name}: timed out waiting for {msg} ...")
+
+    def buffer_size(self, npts, nlines):
+        if npts>self.max_points:
+            return self.max_points
+        return npts*min(nlines, self.max_points//npts)
+
+    def clear(self):
+        self.ts.acquiring.clear_sub(self._acquiring_changed)
+        for ch in self.channels:
+            getattr(self.ts, ch).clear_sub(self._array_posted)
+
+    def start(self, npts, nlines):
+        """ start the first buffer, returns once TSAcquiring is 1
+        """
+        self.expected = npts*nlines
+        self.buf_size = self.buffer_size(npts, nlines)
+        self.data = []      # (offset, {channel: array}) for each buffer, offset is None if unknown
+        self.offsets = []
+        self.npts_read = 0
+        self.npts_placed = 0
+        self._next = 0      # where the next buffer starts
+        self.nbuffers = 0
+        self._stopping = False
+        self._error = None
+        self._nstarted = 0
+        self._nfinished = 0
+        self._num_points = self.ts.num_points.get()
+        self.ts.acquiring.subscribe(self._acquiring_changed)
+        for ch in self.channels:
+            getattr(self.ts, ch).subscribe(self._array_posted, run=False)
+        if self.ts.acquiring.get(use_monitor=False)==1:   # e.g. left running by start_monitor()
+            self.ts.acquire.put(0, wait=True)
+            self._wait_for(lambda: self._acquiring==0, self.read_timeout, "TSAcquiring to be Done")
+            self._nfinished = 0
+        # no triggers before the first buffer is started
+        self.base = self.num_acquired.get(use_monitor=False)
+        self._arm()
+        self._thread = threading.Thread(target=self._read_buffers, daemon=True)
+        self._thread.start()
+
+    def _arm(self):
+        n0 = self.num_acquired.get(use_monitor=False)-self.base
+        n = min(self.buf_size, self.expected-n0)
+        if n!=self._num_points:
+            self.ts.num_points.put(n, wait=True)
+            self._num_points = n
+        self.ts.acquire.put(1, wait=True)
+        k = self.nbuffers
+        self._wait_for(lambda: self._nstarted>k, self.read_timeout, "TSAcquiring")
+        offset = self._buffer_offset()
+        self._next = (n0 if offset is None else offset)
+        self.offsets.append(offset)
+
+    def _buffer_offset(self, ntries=10):
+        """ the number of points acquired before the current buffer started, i.e. NumAcquired minus
+            TSCurrentPoint, which stays the same while the buffer fills; NumAcquired is read before
+            and after TSCurrentPoint, each reading narrows down the possible values
+            None if the value is still ambiguous after ntries
+        """
+        candidates = None
+        for i in range(ntries):
+            n0 = self.num_acquired.get(use_monitor=False)
+            cp = self.ts.current_point.get(use_monitor=False)
+            n1 = self.num_acquired.get(use_monitor=False)
+            c = set(range(n0-cp, n1-cp+1))
+            candidates = (c if candidates is None else candidates&c)
+            if len(candidates)==1:
+                return candidates.pop()-self.base
+            if len(candidates)==0:
+                break
+        return None
+
+    def _read_buffers(self):
+        try:
+            while True:
+                k = self.nbuffers
+                self._wait_for(lambda: self._nfinished>k, None, "TSAcquiring to be Done")
+                if self._stopping:
+                    n = self.ts.current_point.get(use_monitor=False)
+                else:   # full
+                    n = self._num_points
+                with self._cond:
+                    self._arrays = {}
+                self.ts.read_arrays.put(1)
+                self._wait_for(lambda: len(self._arrays)==len(self.channels), self.read_timeout, "the arrays")
+                self.data.append((self.offsets[self.nbuffers], {ch: self._arrays[ch][:n] for ch in self.channels}))
+                self.npts_read += n
+                self.nbuffers += 1
+                with self._lock:
+                    if self._stopping or self._next+n>=self.expected:
+                        break
+                    self._arm()
+        except Exception as e:
+            self._error = e
+
+    def stop(self):
+        """ end the current buffer, it is still read back
+        """
+        with self._lock:
+            self._stopping = True
+            self.ts.acquire.put(0, wait=True)
+
+    def wait(self, timeout):
+        """ wait for the last buffer, stop acquiring if the points are not all in within timeout
+            returns the points for each channel, each buffer at its offset, NaN for the lost points
+            raises if the buffers overlap or go past the expected number of points
+        """
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print(f"{self.ts.name}: {self.npts_read+self.ts.current_point.get(use_monitor=False)} of "
+                  f"{self.expected} points received, stopping ...")
+            self.stop()
+            self._thread.join(self.read_timeout)
+        self.clear()
+        if self._error is not None:
+            raise self._error
+        if self._thread.is_alive():
+            raise Exception(f"{self.ts.name}: the time series could not be read back ...")
+        ret = {ch: np.full(self.expected, np.nan) for ch in self.channels}
+        end = 0
+        for offset,arrays in self.data:
+            n = len(arrays[self.channels[0]])
+            if offset is None:
+                print(f"{self.ts.name}: {n} points could not be placed, left as NaN")
+                continue
+            if offset<end or offset+n>self.expected:
+                raise Exception(f"{self.ts.name}: {n} points at {offset} do not fit, "
+                                f"{end} points placed, {self.expected} expected")
+            for ch in self.channels:
+                ret[ch][offset:offset+n] = arrays[ch]
+            end = offset+n
+            self.npts_placed += n
+        if self.npts_placed<self.expected:
+            print(f"{self.ts.name}: {self.expected-self.npts_placed} of {self.expected} points lost, left as NaN")
+        return ret
+
+
 class LiX_EM(QuadEM):
     ts = ADCpt(TimeSeries, "TS:")
     x_position = ADCpt(EpicsSignalRO, "PosX:MeanValue_RBV", kind='normal')
@@ -94,6 +277,13 @@ class LiXTetrAMMext(QuadEM):
         super().__init__(*args, **kwargs)
         self._fstatus = None
         self.rep = 1
+        self.nlines = 1     # number of lines per kickoff/complete, >1 for serpentine rasters
+        # "sum": SumAll only, from the circular buffer, read back once per kickoff/complete
+        # "channels": the sum and all four currents, saved to file, see TimeSeriesCapture
+        self.capture_mode = "sum"
+        self.capture = TimeSeriesCapture(self.ts, self.num_acquired)
+        self._asset_docs_cache = []
+        self._h5 = None
         self.stage_sigs.update([('acquire_mode', 0), # continuous 
                                 ('trigger_mode', 1), # ext trigger
                                 ('ts.acquire_mode', 1), # circular buffer
@@ -111,18 +301,68 @@ class LiXTetrAMMext(QuadEM):
     def stage(self):
         self.stage_sigs.update([('averaging_time', self.avg_time.get()),
                                 ('ts.averaging_time', self.avg_time.get()),
-                                ('ts.num_points', self.npoints.get()),
                                ])
+        if self.capture_mode=="channels":
+            self.stage_sigs.pop('ts.num_points', None)  # set for each buffer
+            self.stage_sigs.update([('ts.acquire_mode', 0)]) # fixed length
+        elif self.capture_mode=="sum":
+            if self.npoints.get()*self.nlines>self.capture.max_points:
+                raise Exception(f"{self.name}: {self.npoints.get()}x{self.nlines} points do not fit in the "
+                                f"time series buffer ({self.capture.max_points}), use capture_mode='channels'")
+            self.stage_sigs.update([('ts.acquire_mode', 1),
+                                    ('ts.num_points', self.npoints.get()*self.nlines),
+                                   ])
+        else:
+            raise Exception(f"unknown capture mode for {self.name}: {self.capture_mode}")
         super().stage()
         self.read_back = {'data': [], 'ts': []}
+        if self.capture_mode=="channels":
+            self.open_file()
     
+    def unstage(self):
+        super().unstage()
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+
+    def open_file(self):
+        """ one file per scan, /entry/data/data holds a frame for each line, the sum and current1-4
+            the resource is for the AD_HDF5 handler, with all lines as a single point
+            the time of each line is saved as NDAttributes, as in the areaDetector files, so that
+            locate_h5_resource() can read the file
+        """
+        path = get_IOC_datapath(self.name)
+        os.makedirs(path, exist_ok=True)
+        fn = f"{path}{current_sample}_{self.name}_ts_{time.strftime('%y%m%d-%H%M%S')}.h5"
+        self._h5 = h5py.File(fn, "w")
+        dset = self._h5.create_dataset("/entry/data/data", 
+                                       (self.rep, len(self.capture.channels), self.npoints.get()),
+                                       dtype=float, fillvalue=np.nan)
+        dset.attrs['channels'] = self.capture.channels
+        for k in ["NDArrayEpicsTSSec", "NDArrayEpicsTSnSec"]:
+            self._h5.create_dataset(f"/entry/instrument/NDAttributes/{k}", (self.rep,), dtype=float)
+        self._nlines_saved = 0
+        
+        resource, datum_factory = resource_factory(spec='AD_HDF5', root='/', 
+                                                   resource_path=os.path.relpath(fn, '/'),
+                                                   resource_kwargs={'frame_per_point': self.rep},
+                                                   path_semantics='posix')
+        datum = datum_factory({'point_number': 0})
+        self._datum_id = datum['datum_id']
+        self._asset_docs_cache = [('resource', resource), ('datum', datum)]
+
     def kickoff(self):
         print("kicking off emext ...")
         self._fstatus = DeviceStatus(self)
 
-        self.ts.acquire.set(1).wait()
-        time.sleep(0.1)
-        self.acquire.set(1).wait()
+        if self.capture_mode=="channels":
+            # acquiring first, NumAcquired may be reset when Acquire is set to 1
+            self.acquire.set(1).wait()
+            self.capture.start(self.npoints.get(), self.nlines)
+        else:
+            self.ts.acquire.set(1).wait()
+            time.sleep(0.1)
+            self.acquire.set(1).wait()
        
         print("emext kicked off ...")
         return self._fstatus
@@ -133,35 +373,81 @@ class LiXTetrAMMext(QuadEM):
         if self._fstatus is None:
             raise RuntimeError("must call kickoff() before complete()")
 
+        if self.capture_mode=="channels":
+            self.complete_channels()
+            self._fstatus._finished()
+            return self._fstatus
+
         self.ts.acquire.set(0).wait()
         caput(self.ts.prefix+"TSRead", 1)
         time.sleep(0.2)
         em2d = self.ts.SumAll.read()[f'{self.name}_ts_SumAll']
         #self.read_back['data'].extend(em2d['value'][:self.npoints.get()])  
-        self.read_back['data'].append(np.asarray(em2d['value'][:self.npoints.get()]))  
-        self.read_back['ts'].append(em2d['timestamp'])        
+        npts = self.npoints.get()
+        data = np.asarray(em2d['value'][:npts*self.nlines])
+        for i in range(self.nlines):
+            self.read_back['data'].append(data[i*npts:(i+1)*npts])  
+            self.read_back['ts'].append(em2d['timestamp'])        
 
         self._fstatus._finished()
         print("emext compelte done")
         return self._fstatus
         #return NullStatus()
     
+    def complete_channels(self):
+        """ the last point comes in one averaging time after the last trigger
+            missing points are left as NaN 
+        """
+        data = self.capture.wait(timeout=2*self.avg_time.get()+1)
+        npts = self.npoints.get()
+        ts = time.time()
+        dset = self._h5["/entry/data/data"]
+        for i in range(self.nlines):
+            line = np.full((len(self.capture.channels), npts), np.nan)
+            for j,ch in enumerate(self.capture.channels):
+                v = data[ch][i*npts:(i+1)*npts]
+                line[j, :len(v)] = v
+            if self._nlines_saved<self.rep:
+                dset[self._nlines_saved] = line
+                # EPICS epoch, locate_h5_resource() adds 631152000.3
+                t = ts-631152000.3
+                self._h5["/entry/instrument/NDAttributes/NDArrayEpicsTSSec"][self._nlines_saved] = np.floor(t)
+                self._h5["/entry/instrument/NDAttributes/NDArrayEpicsTSnSec"][self._nlines_saved] = (t-np.floor(t))*1e9
+                self._nlines_saved += 1
+            self.read_back['data'].append(line[0])
+            self.read_back['ts'].append(ts)
+        self._h5.flush()
+        print(f"emext compelte done, {self.capture.npts_placed} points in {self.capture.nbuffers} buffer(s)")
+        
     def collect(self):
         print("in em collect ...")
         k = self.ts.SumAll.name
-        yield  {'time': time.time(),
-                'data': {k: np.array(self.read_back['data'])},
-                'timestamps': {k: self.read_back['ts']},
-                }   
+        ret = {'time': time.time(),
+               'data': {k: np.array(self.read_back['data'])},
+               'timestamps': {k: self.read_back['ts']},
+              }
+        if self.capture_mode=="channels":
+            ret['data'][f'{self.name}_ts_data'] = self._datum_id
+            ret['timestamps'][f'{self.name}_ts_data'] = time.time()
+        yield ret
         
     def describe_collect(self):
         print("in em describe_collect ...")
         ret = self.ts.SumAll.describe()
         for k in ret.keys():
             ret[k]['shape'] = [self.rep, ret[k]['shape'][0]]
+        if self.capture_mode=="channels":
+            ret[f'{self.name}_ts_data'] = {'source': self.ts.prefix+"TimeSeries", 'dtype': 'array', 
+                                           'shape': [self.rep, len(self.capture.channels), self.npoints.get()], 
+                                           'external': 'FILESTORE:'}
 
         #return {'primary': ret}
         return {self.name: ret}
+
+    def collect_asset_docs(self):
+        items = list(self._asset_docs_cache)
+        self._asset_docs_cache.clear()
+        yield from items
        
 # Siddons electrometer
 #em1 = LiX_EM('XF:16IDC-ES{NSLS_EM:1}', name='em1')
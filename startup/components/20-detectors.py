@@ -14,7 +14,7 @@ from ophyd.areadetector.trigger_mixins import SingleTrigger
 from ophyd.areadetector.filestore_mixins import (FileStoreTIFFIterativeWrite,
                                                  FileStoreHDF5IterativeWrite)
 from ophyd import Component as Cpt
-import imageio,time
+import imageio,time,threading
 
 class TIFFPluginWithFileStore(TIFFPlugin, FileStoreTIFFIterativeWrite):
     def make_filename(self):
@@ -238,37 +238,56 @@ class StandardProsilica(ProsilicaDetector, SingleTrigger):
     def watch_for_change(self, lock=None, poll_rate=0.01, timeout=10, watch_name=None, release_delay=0):
         """ lock should have been acquired before this function is called
             when a change is observed, release the lock and return
+            the lock is released in any case, including on errors
+            the watched signals are monitored, poll_rate is no longer used
         """
-        if len(self.watch_list.keys())==0:
-            print("nothing to watch for ...")
-            return
-        t1 = time.time()
-        while True:
-            changed = False
+        try:
+            if len(self.watch_list.keys())==0:
+                print("nothing to watch for ...")
+                return
             if watch_name is None:
                 watch_name = list(self.watch_list.keys())
             elif isinstance(watch_name, str):
                 watch_name = [watch_name]
+            
+            cond = threading.Condition()
+            values = {}
+            def changed():
+                for wn in watch_name:
+                    sig = self.watch_list[wn]
+                    if abs(values[wn]-sig['base_value'])>sig['thresh']:
+                        return True
+                return False
+            subs = []
             for wn in watch_name:
-                sig = self.watch_list[wn]
-                cur_value = sig['signal'].get()
-                if abs(cur_value-sig['base_value'])>sig['thresh']:
-                    print('change detected.')
-                    changed = True
-            if changed:
+                def cb(value, wn=wn, **kwargs):
+                    with cond:
+                        values[wn] = value
+                        cond.notify_all()
+                subs.append((self.watch_list[wn]['signal'], self.watch_list[wn]['signal'].subscribe(cb, run=False)))
+            # read after subscribing, a change in between would otherwise be missed
+            with cond:
+                for wn in watch_name:
+                    values.setdefault(wn, self.watch_list[wn]['signal'].get())
+            
+            try:
+                with cond:
+                    found = cond.wait_for(changed, timeout)
+            finally:
+                for sig,cid in subs:
+                    sig.unsubscribe(cid)
+            if found:
+                print('change detected.')
                 self.watch_timeouts=0
-                break
-            t2 = time.time()
-            if t2-t1>timeout:
+            else:
                 self.watch_timeouts+=1
                 print(f'timedout #{self.watch_timeouts}')
                 if self.watch_timeouts>=self.watch_timeouts_limit:
                     raise Exception(f"max # of timeouts reached.")
-                break
-            time.sleep(poll_rate)
-        if lock is not None:
-            time.sleep(release_delay)
-            lock.release()
+        finally:
+            if lock is not None:
+                time.sleep(release_delay)
+                lock.release()
 
 known_cameras = {"camMono": "XF:16IDA-BI{Cam:Mono}",
                  "camKB": "XF:16IDA-BI{Cam:KB}",
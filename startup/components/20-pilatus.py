@@ -7,7 +7,10 @@ from ophyd import ( Component as Cpt, ADComponent, Signal,
 
 from databroker.assets.handlers_base import HandlerBase
 from ophyd.device import Staged
+from ophyd.status import SubscriptionStatus
+from ophyd.utils import WaitTimeoutError
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import os,time,threading
 from types import SimpleNamespace
@@ -37,6 +40,7 @@ class LIXPilatus(PilatusDetector):
     ThresholdEnergy = Cpt(EpicsSignal, "cam1:ThresholdEnergy")
     armed = Cpt(EpicsSignal, "cam1:Armed")
     detstate = Cpt(EpicsSignal,"cam1:DetectorState_RBV")
+    arm_timeout = 10
 
     def make_data_key(self):
         ret = super().make_data_key()
@@ -70,9 +74,10 @@ class LIXPilatus(PilatusDetector):
         self._num_repeats = 1
         self._num_images = 1
         self.ts = []
+        self.arm_status = None
+        self.arm_latency = None
 
-        if self.hdf.run_time.get()==0: # first time using the plugin
-            self.hdf.warmup()
+        self.hdf.readiness.prepare(self.hdf.warmup)   # first time using the plugin
 
     def update_cbf_name(self, cn=None):
         if cn is None:
@@ -100,7 +105,30 @@ class LIXPilatus(PilatusDetector):
             print(f"Threshold is not set for {self.name} due to active data collection.")
             print(f"x-ray enegy = 2x {ene/2:.2f} keV, threshold is at {eth:.2f} keV")
 
-    def stage(self, trigger_mode):
+    def armed_status(self, armed=1, timeout=None):
+        """ finished when the detector reports the armed state, from the CA monitor on Armed
+        """
+        return SubscriptionStatus(self.armed, lambda value, **kwargs: value==armed, 
+                                  run=True, timeout=timeout)
+        
+    def arm(self):
+        """ start acquisition in the external trigger modes, without waiting
+            the returned status fails if the detector is not armed within arm_timeout
+            arm_latency is set when it is
+        """
+        t0 = time.time()
+        st = self.armed_status(timeout=self.arm_timeout)
+        def set_latency(status):
+            if status.success:
+                self.arm_latency = time.time()-t0
+        st.add_callback(set_latency)
+        self.arm_latency = None
+        self._acquisition_signal.put(1)
+        return st
+        
+    def stage(self, trigger_mode, wait=True):
+        """ wait=False: return once the detector is told to arm, arm_status for the rest 
+        """
         if self._staged == Staged.yes:
             return
 
@@ -116,17 +144,16 @@ class LIXPilatus(PilatusDetector):
         print(self.name, "super staged")
 
         if trigger_mode is PilatusTriggerMode.soft:
-            self._acquisition_signal.subscribe(self.parent._acquire_changed)
+            self.arm_status = NullStatus()
         else: # external triggering
-            self._counter_signal.put(0)
-            time.sleep(.1)
+            self._counter_signal.put(0, wait=True)
             print(self.name, "checking armed status")
-            self._acquisition_signal.put(1) #, wait=True)
-            while self.armed.get() != 1:
-                time.sleep(0.1)
+            self.arm_status = self.arm()
 
         self.ts = []
-        print(self.name, "staged")
+        if wait:
+            self.arm_status.wait()
+            print(self.name, "staged")
 
     def unstage(self, timeout=5):
         if self._staged == Staged.no:
@@ -134,18 +161,19 @@ class LIXPilatus(PilatusDetector):
 
         print(self.name, "unstaging ...")
         print(self.name, "checking detector Armed status:", end="")
-        ts0 = time.time()
-        st = None
-        while self.armed.get():
-            time.sleep(0.2)
-            if time.time()-ts0>timeout and st is None:
-                st = self.cam.acquire.set(0)
-                print(f"force stop {self.name}")
+        st = self.armed_status(0)
+        try:
+            st.wait(timeout)
+        except WaitTimeoutError:
+            print(f"force stop {self.name}")
+            self.cam.acquire.set(0)
+            try:
+                st.wait(timeout)
+            except WaitTimeoutError:
+                raise Exception(f"{self.name} is still armed {2*timeout} s after the end of the scan ...")
         print(" unarmed.")
 
-        if self.parent.trigger_mode is PilatusTriggerMode.soft:
-            self._acquisition_signal.clear_sub(self.parent._acquire_changed)
-        else:
+        if self.parent.trigger_mode is not PilatusTriggerMode.soft:
             self._acquisition_signal.put(0, wait=True)
             self.cam.trigger_mode.put(0, wait=True)   # always set back to software trigger
             self.cam.num_images.put(1, wait=True)
@@ -177,6 +205,8 @@ class LiXDetectors(Device):
     acq_time = 1.
     trigger_mode = PilatusTriggerMode.soft
     _trigger_width = 0.002
+    trigger_timeout = 5
+    trigger_lock_timeout = 60
 
     def __init__(self, prefix):
         super().__init__(prefix=prefix, name="pil")
@@ -191,8 +221,13 @@ class LiXDetectors(Device):
         self.trigger_time = Signal(name="pilatus_trigger_time")
 
         self._trigger_signal = EpicsSignal('XF:16IDC-ES{Zeb:1}:SOFT_IN:B0')
-        self._exp_completed = 0
         self._flying = False
+        # trigger status finished when all detectors report the frames, see watch_triggers()
+        self.trigger_engine = TriggerEngine(name="pil_trigger")
+        # stage/unstage the detectors at the same time
+        self._executor = ThreadPoolExecutor(max_workers=len(self.dets), thread_name_prefix="pil_stage")
+        self.arm_latency = {}
+        self.stage_time = 0
 
         RE.md['pilatus'] = {}
         RE.md['pilatus']['ramdisk'] = pilatus_data_dir
@@ -258,6 +293,12 @@ class LiXDetectors(Device):
             del RE.md['subdir'] 
             LIXhdfPlugin.sub_directory = sd
 
+    def use_swmr(self, swmr=False):
+        """ swmr=True: the IOC writes the hdf files in SWMR mode, needed by IncrementalH5Packer to
+            copy the frames during the scan
+        """
+        LIXhdfPlugin.swmr = swmr
+
     def set_thresh(self):
         ene = int(pseudoE.energy.position/100*0.5+0.5)*0.1
         for det in self.active_detectors: #self.dets.values():
@@ -281,7 +322,7 @@ class LiXDetectors(Device):
         for det in self.active_detectors:
             det._num_images = self._num_images
             det._num_repeats = self._num_repeats
-            det.stage(self.trigger_mode)
+        self.stage_detectors()
 
         if self.trigger_mode == PilatusTriggerMode.ext_multi:
             # the name is misleading, multi_triger means one image per trigger
@@ -291,10 +332,58 @@ class LiXDetectors(Device):
         
         self.datum={}
 
+    def stage_detectors(self):
+        """ stage all active detectors at the same time, then wait for all of them to arm
+            arm_latency: time from starting the acquisition to armed for each detector,
+            stage_time: the time for all of them
+            if any detector fails to stage or arm, all are unstaged and an exception is raised
+        """
+        t0 = time.time()
+        futures = {det.name: self._executor.submit(det.stage, self.trigger_mode, wait=False) 
+                   for det in self.active_detectors}
+        errors = {}
+        for dname,fut in futures.items():
+            try:
+                fut.result()
+            except Exception as e:
+                errors[dname] = e
+
+        self.arm_latency = {}
+        for det in self.active_detectors:
+            if det.name in errors:
+                continue
+            try:
+                det.arm_status.wait()
+                self.arm_latency[det.name] = det.arm_latency
+            except Exception as e:
+                errors[det.name] = (f"not armed after {det.arm_timeout} s" 
+                                    if isinstance(e, TimeoutError) else e)
+        if len(errors)>0:
+            self.unstage()
+            raise Exception(f"failed to stage {', '.join(errors.keys())}: {errors}")
+        self.watch_triggers()
+        self.stage_time = time.time()-t0
+        print(f"{self.name} staged in {self.stage_time:.3f} s", 
+              ", ".join([f"{k} armed in {v:.3f} s" for k,v in self.arm_latency.items() if v is not None]))
+    
+    def watch_triggers(self):
+        """ soft trigger: each trigger is done when Acquire goes back to 0 on all detectors
+            external trigger: when the array counter of every detector reaches the number
+            of frames expected
+        """
+        self.trigger_engine.clear()
+        for det in self.active_detectors:
+            if self.trigger_mode is PilatusTriggerMode.soft:
+                self.trigger_engine.watch(det.name, det._acquisition_signal, falling_edge=True)
+            else:
+                self.trigger_engine.watch(det.name, det._counter_signal)
+    
     def unstage(self):
         self._flying = False
-        for det in self.active_detectors:
-            det.unstage()
+        self.trigger_engine.clear()
+        futures = [self._executor.submit(det.unstage) for det in self.active_detectors]
+        for fut in futures:
+            fut.result()
 
     def kickoff(self):
         return NullStatus()
@@ -307,18 +396,22 @@ class LiXDetectors(Device):
         #    return
         self._status = DeviceStatus(self)
         if self.trigger_mode is not PilatusTriggerMode.soft and not self._flying:
-            while self.trigger_lock.locked():
-                time.sleep(self._trigger_width)
+            # e.g. held by StandardProsilica.watch_for_change() until the sample arrives
+            if not self.trigger_lock.acquire(timeout=self.trigger_lock_timeout):
+                raise Exception(f"trigger lock not released after {self.trigger_lock_timeout} s ...")
+            self.trigger_lock.release()
             self.trigger_time.put(time.time())
             print("generating triggering pulse ...")
             self._trigger_signal.put(1, wait=True)
             self._trigger_signal.put(0, wait=True)
         for det in self.active_detectors:
             det.trigger()
-        if self.trigger_mode is not PilatusTriggerMode.soft:
-            # soft: status to be cleared by _acquire_changed()
-            # ext: set up callback to clear status after the end-of-exposure
-            threading.Timer(self.trig_wait, self._status._finished, ()).start()
+        # the counts are cumulative, frames that arrived already are not missed
+        if self.trigger_mode is PilatusTriggerMode.ext:
+            nframes = self._num_images*self._num_repeats
+        else:
+            nframes = 1
+        self.trigger_engine.add(self._status, nframes, timeout=self.trig_wait+self.trigger_timeout)
         # should advance the file number in external trigger mode???
 
         return self._status
@@ -332,13 +425,6 @@ class LiXDetectors(Device):
             time.sleep(self.acq_time)
             print(f"# of triggers to go: {i} \r", end="")
 
-    def _acquire_changed(self, value=None, old_value=None, **kwargs):
-        if old_value==1 and value==0:
-            self._exp_completed += 1
-        if self._exp_completed==len(self.active_detectors):
-            self._exp_completed = 0
-            self._status._finished()
-
 #    def describe(self):
 #        """ aim to reduce the amount of information saved in the databroker
 #            all detectors share the same name, path and template
@@ -87,10 +87,7 @@ class LiXXspress(xspress3_class_4ch):
         self._num_images = 1
         self._flying = False
         
-        if self.hdf.run_time.get()==0: # first time using the plugin
-            print("warm up hdf plugin ...")
-            self.hdf.warmup()
-            print('done.')
+        self.hdf.readiness.prepare(self.hdf.warmup)   # first time using the plugin
 
     def stop(self, *, success=False):
         ret = super().stop()
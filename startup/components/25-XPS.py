@@ -59,22 +59,183 @@ class PositioningStackMicroscope(PositioningStack):
         rx = None
         print("ss.rx not available")
 
+class XPSStatusPoller():
+    """ a single thread per controller reads the motion status and positions of all groups, 
+        with the commands for all groups pipelined in one round trip, on a socket of its own
+        (moves are blocking on the controller, the socket used to start a move is busy until 
+        the move is complete)
+        
+        the values are cached with the time they were read; a read older than max_age 
+        triggers a refresh, which is shared by all callers waiting at the same time
+        the polling interval is interval while any group is moving, idle_interval otherwise
+        
+        subscribe(cb) to be called as cb(motor=, position=, moving=, timestamp=) when the 
+        position or the motion status of a motor changes
+    """
+    def __init__(self, controller, interval=0.05, idle_interval=0.5, max_age=0.1):
+        self.controller = controller
+        self.xps = controller.xps
+        self.sID = self.xps.TCP_ConnectToServer(controller.ip_addr, controller.port, 0.050)
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.max_age = max_age
+        self.lock = threading.Lock()       # one refresh at a time
+        self.cond = threading.Condition()  # notified after every refresh
+        self.status = {}     # motor: (err, value, timestamp)
+        self.positions = {}
+        self.replies = {}    # group: {'status': (err, ret), 'position': (err, ret)}
+        self.subs = {}
+        self.nrefresh = 0
+        self.wakeup = threading.Event()
+        self.fast_until = 0
+        self.thread = None
+    
+    def commands(self):
+        cmds = []
+        for grp,mots in self.controller.groups.items():
+            cmds.append(f"GroupMotionStatusGet({grp},"+",".join(["int *"]*len(mots))+")")
+            cmds.append(f"GroupPositionCurrentGet({grp},"+",".join(["double *"]*len(mots))+")")
+        return cmds
+    
+    def age(self):
+        """ of the oldest value in the cache
+        """
+        if len(self.positions)<len(self.controller.motors):
+            return np.inf
+        return time.time()-min([v[2] for v in self.positions.values()])
+    
+    def refresh(self, max_age=0):
+        with self.lock:
+            # another thread may have just done it 
+            if self.age()<=max_age:
+                return
+            rets = self.xps.sendAndReceiveMany(self.sID, self.commands())
+            ts = time.time()
+            self.nrefresh += 1
+        
+        changed = {}
+        with self.cond:
+            for i,(grp,mots) in enumerate(self.controller.groups.items()):
+                self.replies[grp] = {'status': tuple(rets[2*i]), 'position': tuple(rets[2*i+1])}
+                for cache,(err,ret) in [(self.status, rets[2*i]), (self.positions, rets[2*i+1])]:
+                    vals = ret.split(',')
+                    for mot in mots:
+                        idx = self.controller.motors[mot]['index']
+                        if err=='0' and len(vals)>idx:
+                            v = vals[idx]
+                        else:
+                            print(f"trouble getting the status/position of group {grp}: ", err,ret)
+                            v = cache[mot][1] if mot in cache.keys() else ''
+                        if mot not in cache.keys() or cache[mot][1]!=v:
+                            changed[mot] = ts
+                        cache[mot] = (err,v,ts)
+            self.cond.notify_all()
+        
+        for mot in changed.keys():
+            self.run_subs(mot)
+    
+    def run_subs(self, mot):
+        try:
+            pos = float(self.positions[mot][1])
+            moving = bool(int(self.status[mot][1]))
+        except ValueError:
+            return
+        for cid,(cb,m) in list(self.subs.items()):
+            if m is None or m==mot:
+                try:
+                    cb(motor=mot, position=pos, moving=moving, timestamp=self.positions[mot][2])
+                except Exception as e:
+                    print(f"error in XPS status subscription {cid}: {e}")
+    
+    def subscribe(self, cb, motor=None):
+        """ returns the subscription id 
+        """
+        cid = uuid.uuid4().hex
+        self.subs[cid] = (cb, motor)
+        return cid
+
+    def unsubscribe(self, cid):
+        self.subs.pop(cid, None)
+        
+    def get(self, mot, what="position", max_age=None):
+        """ returns (err, value), the value is at most max_age old
+        """
+        if max_age is None:
+            max_age = self.max_age
+        cache = self.positions if what=="position" else self.status
+        if mot not in cache.keys() or time.time()-cache[mot][2]>max_age:
+            self.refresh(max_age)
+        return cache[mot][:2]
+    
+    def moving(self):
+        return any([v[1]=='1' for v in self.status.values()])
+    
+    def kick(self, hold=1.0):
+        """ poll at the short interval for at least hold sec, call before starting a motion
+        """
+        self.fast_until = time.time()+hold
+        self.wakeup.set()
+    
+    def wait_for(self, predicate, timeout=None):
+        """ wait for predicate() to become true, evaluated after every refresh
+        """
+        self.wakeup.set()
+        with self.cond:
+            return self.cond.wait_for(predicate, timeout)
+    
+    def poll(self):
+        while self.thread is not None:
+            try:
+                self.refresh(self.interval/2)
+            except Exception as e:
+                print(f"XPS status poller: {e}")
+            fast = self.moving() or time.time()<self.fast_until
+            self.wakeup.wait(self.interval if fast else self.idle_interval)
+            self.wakeup.clear()
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.poll, daemon=True)
+            self.thread.start()
+    
+    def stop(self):
+        th = self.thread
+        self.thread = None
+        self.wakeup.set()
+        if th is not None:
+            th.join()
+    
+
 class XPSController():
-    def __init__(self, ip_addr, name):
+    def __init__(self, ip_addr, name, port=5001, ftp_port=21):
+        """ the ports can be changed to use the emulator in tests/xps_emulator.py
+        """
         self.xps = XPS()
         self.name = name
         self.ip_addr = ip_addr
-        self.sID = self.xps.TCP_ConnectToServer(ip_addr, 5001, 0.050)
+        self.port = port
+        self.ftp_port = ftp_port
+        self.sID = self.xps.TCP_ConnectToServer(ip_addr, port, 0.050)
         # 20 ms timeout is suggested for single-socket communication, per programming manual
+        # motions hold self.sID until they are complete, stop them through a socket of their own
+        self.abort_sID = self.xps.TCP_ConnectToServer(ip_addr, port, 0.050)
+        if self.sID<0 or self.abort_sID<0:
+            raise Exception(f"unable to connect to XPS at {ip_addr}:{port}")
         self.groups = {}
         self.traj = None
         self.motors = {}
         self.update()
-        self.lock = threading.Lock()
-        self.ts = time.time()
-        self.status = {}
-        self.positions = {}
-        self.check_status_interval = 0.05
+        # status and positions are read by the poller, see get_motor_status()
+        self.poller = XPSStatusPoller(self)
+        self.poller.start()
+
+    def abort(self, group):
+        """ GroupMoveAbort, for a motion or a trajectory running on self.sID
+        """
+        return self.xps.GroupMoveAbort(self.abort_sID, group)
+
+    def kill(self, group):
+        return self.xps.GroupKill(self.abort_sID, group)
 
     def synch_clock(self):
         """ time format follows HardwareDateAndTimeSet("Fri Sep 8 14:43:00 2023")
@@ -109,43 +270,21 @@ class XPSController():
                 self.motors[obj]['group'] = tl[0] 
                 self.motors[obj]['index'] = self.groups[tl[0]].index(obj)  
     
-    def get_motor_status(self, mot):
-        grp = self.motors[mot]['group']
-        ts = time.time()
-        if ts-self.ts>self.check_status_interval or mot not in self.status.keys():
-            self.get_group_status(grp)
-        self.ts = ts
-        return self.status[mot]
+    def get_motor_status(self, mot, max_age=None):
+        """ returns (err, status) read by the poller, at most max_age (poller.max_age) old
+        """
+        return self.poller.get(mot, "status", max_age)
                 
     def get_group_status(self, grp):
-        self.lock.acquire()
-        err,ret = self.xps.GroupMotionStatusGet(self.sID, grp,len(self.groups[grp]))
-        if err!='0' or len(ret)==0:
-            print(f"trouble getting group status for {grp}...: ", err,ret)
-        self.lock.release()
-        status = ret.split(',')
-        for mot in self.groups[grp]:
-            self.status[mot] = (err,status[self.motors[mot]['index']])
-        return err,ret
+        self.poller.refresh()
+        return self.poller.replies[grp]['status']
         
-    def get_motor_position(self, mot):
-        grp = self.motors[mot]['group']
-        ts = time.time()
-        if ts-self.ts>self.check_status_interval or mot not in self.positions.keys():
-            self.get_group_position(grp)
-        self.ts = ts
-        return self.positions[mot]
+    def get_motor_position(self, mot, max_age=None):
+        return self.poller.get(mot, "position", max_age)
 
     def get_group_position(self, grp):
-        self.lock.acquire()
-        err,ret = self.xps.GroupPositionCurrentGet(self.sID, grp,len(self.groups[grp]))
-        if err!='0' or len(ret)==0:
-            print(f"trouble getting group position for {grp} ...: ", err,ret)
-        self.lock.release()
-        pos = ret.split(',')
-        for mot in self.groups[grp]:
-            self.positions[mot] = (err,pos[self.motors[mot]['index']])
-        return err,ret
+        self.poller.refresh()
+        return self.poller.replies[grp]['position']
         
     def def_motor(self, motorName, OphydName, egu="mm", direction=1): 
         if not motorName in self.motors.keys():
@@ -160,6 +299,7 @@ class XPSController():
         
 class XPSmotor(PositionerBase):
     debug = False
+    move_timeout_margin = 5     # added to the time a move should take, see move_timeout()
     
     def __init__(self, controller, motorName, OphydName, egu, direction=1, settle_time=0):
         self.controller = controller
@@ -173,13 +313,41 @@ class XPSmotor(PositionerBase):
         self._position = None
         self.setpoint = None
         self.user_offset_dir = Signal(parent=self, name="motor dir", value=direction)
+        controller.poller.subscribe(self._poller_cb, motor=motorName)
+        
+    def _poller_cb(self, motor, position, moving, timestamp):
+        self._position = position
+        self._moving = moving
+        self._run_subs(sub_type=self.SUB_READBACK, value=position*self._dir, timestamp=timestamp)
         
-    def wait_for_stop(self, poll_time=0.1):
+    def move_timeout(self, set_point):
+        """ twice the time to move to set_point (dial) at the current velocity/acceleration, plus
+            move_timeout_margin; None if the position or the parameters cannot be read
+        """
+        err,ret = self.controller.xps.PositionerSGammaParametersGet(self.controller.sID, self.motorName)
+        try:
+            vel,acc = [float(v) for v in ret.split(',')[:2]]
+            distance = set_point-self.position*self._dir
+            return 2*(abs(distance)/vel + 2*vel/acc) + self.move_timeout_margin
+        except Exception as e:
+            print(f"{self.name}: unable to estimate the duration of the move, {e}")
+            return None
+
+    def wait_for_stop(self, poll_time=0.1, timeout=None):
+        """ the status is read by the poller of the controller, poll_time is no longer used
+            the move status fails after timeout, which stops the motor
+        """
         if self.debug:
             print(f"{self.name}: waiting for stop ...")
-        while self.moving:
-            pos = self.position
-            time.sleep(poll_time)
+        # the status must have been read after the move command returned
+        t0 = time.time()
+        poller = self.controller.poller
+        poller.refresh()
+        if not poller.wait_for(lambda: poller.status[self.motorName][2]>=t0 and poller.status[self.motorName][1]=='0',
+                               timeout):
+            print(f"{self.name}: still moving after {timeout:.1f} s, stopping ...")
+            self._done_moving(success=False, timestamp=time.time())
+            return
         time.sleep(self.settle_time)
         #pos = self.position
         self._done_moving(success=True, timestamp=time.time())
@@ -191,9 +359,11 @@ class XPSmotor(PositionerBase):
         self.set_point = position*self._dir
         self._status = super().move(self.set_point, **kwargs)
         self._run_subs(sub_type=PositionerBase.SUB_START)
+        timeout = self.move_timeout(self.set_point)
         
+        self.controller.poller.kick()
         err,ret = self.controller.xps.GroupMoveAbsolute(self.controller.sID, self.motorName, [self.set_point])
-        threading.Thread(target=self.wait_for_stop).start() 
+        threading.Thread(target=self.wait_for_stop, kwargs={'timeout': timeout}).start() 
         
         try:
             if wait:
@@ -265,8 +435,10 @@ class XPSmotor(PositionerBase):
         if self.debug:
             print(f"{self.name}: stop requested ...")
 
-        err,ret = self.controller.xps.GroupMoveAbort(self.controller.sID, self.motorName)
-        self._done_moving()
+        err,ret = self.controller.abort(self.motorName)
+        # also called by the move status when it fails
+        if self._status is not None and not self._status.done:
+            self._done_moving()
         
     def read(self):
         d = OrderedDict()
@@ -1,5 +1,9 @@
 print(f"Loading {__file__}...")
 
+import hashlib,io
+from ophyd.status import SubscriptionStatus
+from ophyd.utils import WaitTimeoutError
+
 class trajControl(Device):
     def __init__(self, *args, **kwargs):
         
@@ -17,6 +21,10 @@ class trajControl(Device):
         self.start_time = 0
         self._traj_status = None
         self.flying_motor = None
+        self.aborted = False
+        # time spent in each phase of the last trajectory execution, see mark_time()
+        self.timing = {}
+        self._t_mark = 0
         
         
     def stage(self):
@@ -44,11 +52,13 @@ class trajControl(Device):
           if val is not None
         }
     
-    def setup_traj(self, fast_axis, f_start, f_end, Nfast, step_size, dt, slow_axis=None, Nslow=1):
+    def setup_traj(self, fast_axis, f_start, f_end, Nfast, step_size, dt, slow_axis=None, Nslow=1, define=True):
         """ Nfast triggers, Nfast-1 segments 
             f_start and f_end are absolute positions
+            define=False if the trajectory is already defined, e.g. by setup_raster_traj()
         """
-        self.define_traj(fast_axis, Nfast-1, step_size, dt)
+        if define:
+            self.define_traj(fast_axis, Nfast-1, step_size, dt)
         
         if isinstance(fast_axis, EpicsMotor):  # trajectory is based on user/Ophyd position
             # motor_pos_sign = (-1 if fast_axis.user_offset_dir.get() else 1)
@@ -106,27 +116,47 @@ class trajControl(Device):
             raise Exception("trajectory not defined/verified.")
         
         self._traj_status = DeviceStatus(self)
+        self.timing = {}
+        self._t_mark = time.time()
       
-        th = threading.Thread(target=self.exec_traj, args=(self.traj_par['run_forward_traj'], ) )
+        th = threading.Thread(target=self.run_traj, args=(self.traj_par['run_forward_traj'], self._traj_status) )
         th.start() 
         
         print("traj kicked off ...")
         return self._traj_status
+    
+    def run_traj(self, forward, status):
+        """ runs in the thread started by kickoff()
+            status is finished as soon as exec_traj() returns, or fails if the trajectory is aborted
+        """
+        try:
+            self.exec_traj(forward)
+        except Exception as e:
+            status.set_exception(e)
+            return
+        if self.aborted:
+            status.set_exception(Exception("unable to complete the scan due to hardware issues ..."))
+        else:
+            print("traj completed ...")
+            status._finished()
+        
+    def mark_time(self, phase):
+        """ record the time since the previous mark (or kickoff) as the duration of phase
+            the phases are move, setup, exec and readback, reported by raster()
+        """
+        t = time.time()
+        self.timing[phase] = t-self._t_mark
+        self._t_mark = t
         
     def complete(self):
         """
             according to run_engine.py: Tell a flyer, 'stop collecting, whenever you are ready'.
             Return a status object tied to 'done'.
+            the status is finished by run_traj(), wait on it instead of polling 
         """
         print("completing traj ...")
         if self._traj_status is None:
             raise RuntimeError("must call kickoff() before complete()")
-        while not self._traj_status.done:
-            print(f"{time.asctime()}: waiting for the trajectory to finish ...   \r", end='')
-            time.sleep(1)
-        if self.aborted:
-            raise Exception("unable to complete the scan due to hardware issues ...")
-        print("traj completed ...")
              
         return self._traj_status
         
@@ -232,8 +262,14 @@ class XPStraj(trajControl):
         self.sID = controller.sID
         
         self.verified = False
-        uname = getpass.getuser()
-        self.traj_files = ["TrajScan_FW.trj-%s" % uname, "TrajScan_BK.trj-%s" % uname]
+        self.uname = getpass.getuser()
+        self.traj_files = ["TrajScan_FW.trj-%s" % self.uname, "TrajScan_BK.trj-%s" % self.uname]
+        # trajectories already uploaded and verified, see define_traj()
+        self.traj_cache = OrderedDict()
+        self.traj_cache_size = 32
+        self.traj_cache_stats = {'hits': 0, 'misses': 0}
+        self.stale_traj_files = []
+        self.traj_def = None
     
         
     def define_traj(self, motor, N, dx, dt, Nr=2):
@@ -253,6 +289,8 @@ class XPStraj(trajControl):
             1.0,  0,0,     0.0
             detector triggering should start from the 5th segment
             
+            the trajectories are uploaded to the controller and verified only once, as long as 
+            they remain in the cache, see traj_cache_info()
         """        
         self.verified = False
 
@@ -266,67 +304,210 @@ class XPStraj(trajControl):
         mvel,macc = np.asarray(ret.split(','), dtype=float)
         midx = self.controller.motors[self.motors[motor.name]]['index']
         
+        # the trajectory is relative to the current position, the start/end positions of the 
+        # scan only matter through N and dx
+        key = (self.motors[motor.name], self.Nmot, N, round(dx, 9), round(dt, 6), Nr, mvel, macc)
+        # kept to upload the trajectory again if needed, see exec_traj()
+        self.traj_def = (key, lambda: self.gen_traj(midx, N, dx, dt, Nr), ["FW", "BK"], [self.motors[motor.name]])
+        self.traj_files,self.ramp_dist = self.load_traj(*self.traj_def)
+
+        self.verified = True
+        self.traj_par = {'run_forward_traj': True, 
+                         'no_of_segments': N, 
+                         'no_of_rampup_points': Nr,
+                         'segment_displacement': dx,
+                         'segment_duration': dt,
+                         'motor': self.motors[motor.name],
+                         'rampup_distance': self.ramp_dist,
+                        }
+
+        self.time_modified = time.time()
+        
+    def ramp_profile(self, N, dt, Nr=2):
+        """ displacement and velocity at the end of each of the Nr+N+Nr segments, for a jerk of
+            +1/-1 during the ramp-up and ramp-down, acceleration=velocity=0 at both ends
+        """
         jj = np.zeros(Nr+N+Nr)
         jj[0] = 1; jj[Nr-1] = -1
         jj[-1] = 1; jj[-Nr] = -1
         # these include the starting state of acc=vel=disp=0
-        disp = np.zeros(Nr+N+Nr+1)
-        vel = np.zeros(Nr+N+Nr+1)
-        acc = np.zeros(Nr+N+Nr+1)
-
-        for i in range(N+2*Nr):
-            acc[i+1] = acc[i] + jj[i]*dt
-            vel[i+1] = vel[i] + acc[i]*dt + jj[i]*dt*dt/2
-            disp[i+1] = vel[i]*dt + acc[i]*dt*dt/2 + jj[i]*dt*dt*dt/6
-        vel = vel/vel.max()*dx/dt
-        disp = disp/disp.max()*dx
-        self.ramp_dist = disp[1:Nr+1].sum()
-        
-        # rows in a PVT trajectory file correspond ot the segments  
-        # for each row/segment, the elements are
-        #     time, axis 1 displancement, axis 1 velocity out, axsi 2 ... 
+        acc = np.concatenate([[0], np.cumsum(jj)*dt])
+        vel = np.concatenate([[0], np.cumsum(acc[:-1]*dt + jj*dt*dt/2)])
+        disp = vel[:-1]*dt + acc[:-1]*dt*dt/2 + jj*dt*dt*dt/6
+        return disp,vel[1:]
+        
+    def gen_traj(self, midx, N, dx, dt, Nr=2):
+        """ returns the FW and BK trajectories for the motor at index midx in the group, and 
+            the ramp-up distance
+            rows in a PVT trajectory file correspond ot the segments  
+            for each row/segment, the elements are
+                time, axis 1 displancement, axis 1 velocity out, axsi 2 ... 
+        """
+        disp,vel = self.ramp_profile(N, dt, Nr)
+        # disp.max() is the displacement in one segment at constant velocity
+        disp,vel = disp/disp.max()*dx,vel/disp.max()*dx
+        ramp_dist = disp[:Nr].sum()
+        
         ot1 = np.zeros((Nr+N+Nr, 1+2*self.Nmot))
         ot1[:, 0] = dt
-        ot1[:, 2*midx+1] = disp[1:] 
-        ot1[:, 2*midx+2] = vel[1:] 
-        ot2 = np.zeros((Nr+N+Nr, 1+2*self.Nmot))
-        ot2[:, 0] = dt
-        ot2[:, 2*midx+1] = -disp[1:] 
-        ot2[:, 2*midx+2] = -vel[1:] 
-        
-        np.savetxt("/tmp/"+self.traj_files[0], ot1, fmt='%f', delimiter=', ')
-        np.savetxt("/tmp/"+self.traj_files[1], ot2, fmt='%f', delimiter=', ')
-        ftp = FTP(self.controller.ip_addr)
-        ftp.connect()
-        ftp.login("Administrator", "Administrator")
-        ftp.cwd("Public/Trajectories")
-        for fn in self.traj_files:
-            file = open("/tmp/"+fn, "rb")
-            ftp.storbinary('STOR %s' % fn, file)
-            file.close()
-        ftp.quit()
+        ot1[:, 2*midx+1] = disp
+        ot1[:, 2*midx+2] = vel
+        ot2 = ot1.copy()
+        ot2[:, 1:] *= -1
+        
+        return [ot1,ot2],ramp_dist
+    
+    def gen_raster_traj(self, fidx, sidx, N, dx, Nslow, dy, dt, Nr=2, forward_first=True):
+        """ a single trajectory for a serpentine raster: Nslow lines on the fast axis (index fidx in 
+            the group), in alternating directions; the slow axis (index sidx) moves by dy during the 
+            ramp-down of one line and the ramp-up of the next 
+            each line has N+1 segments at constant velocity, one more than the FW/BK trajectories, 
+            so that the next line starts where this one ends and the N+1 pulses are at the same 
+            positions as in the FW/BK trajectories 
+        """
+        (ot,ot_bk),ramp_dist = self.gen_traj(fidx, N+1, dx, dt, Nr)
+        nl = N+1+2*Nr
+        ot = np.tile(ot, (Nslow, 1))
+        sign = np.where(np.arange(Nslow)%2==0, 1, -1)*(1 if forward_first else -1)
+        ot[:, 2*fidx+1:2*fidx+3] *= np.repeat(sign, nl)[:, None]
+        
+        # same profile as the ramp-up/down, no constant velocity part, dy in total
+        sd,sv = self.ramp_profile(0, dt, Nr)
+        sd,sv = sd/sd.sum()*dy,sv/sd.sum()*dy
+        for i in range(Nslow-1):
+            ot[i*nl+Nr+N+1:(i+1)*nl+Nr, 2*sidx+1] = sd
+            ot[i*nl+Nr+N+1:(i+1)*nl+Nr, 2*sidx+2] = sv
+        
+        return [ot],ramp_dist
+    
+    def define_raster_traj(self, fast_axis, N, dx, slow_axis, Nslow, dy, dt, Nr=2, forward_first=True):
+        """ see gen_raster_traj(), both motors must be in the group of this trajectory
+            dx>0 and dy are dial displacements
+        """
+        self.verified = False
+        for m in [fast_axis, slow_axis]:
+            if m.name not in self.motors.keys():
+                print(f"{m.name} not in the list of motors: ", self.motors)
+                raise Exception
+        self.flying_motor = self.controller.motors[self.motors[fast_axis.name]]['ophyd']
+        
+        key = ["raster", self.Nmot, N, round(dx, 9), Nslow, round(dy, 9), round(dt, 6), Nr, forward_first]
+        idx = []
+        for m in [fast_axis, slow_axis]:
+            pn = self.motors[m.name]
+            err,ret = self.xps.PositionerMaximumVelocityAndAccelerationGet(self.sID, pn)
+            key += [pn, *np.asarray(ret.split(','), dtype=float)]
+            idx.append(self.controller.motors[pn]['index'])
+        self.traj_def = (tuple(key), lambda: self.gen_raster_traj(*idx, N, dx, Nslow, dy, dt, Nr, forward_first),
+                         ["RASTER"], [self.motors[fast_axis.name], self.motors[slow_axis.name]])
+        self.traj_files,self.ramp_dist = self.load_traj(*self.traj_def)
         
-        for fn in self.traj_files:
-            err,ret = self.xps.MultipleAxesPVTVerification(self.sID, self.group, fn)
-            if err!='0':
-                print(ret)
-                raise Exception("trajectory verification failed.")
-            err,ret = self.xps.MultipleAxesPVTVerificationResultGet (self.sID, self.motors[motor.name])
         self.verified = True
         self.traj_par = {'run_forward_traj': True, 
                          'no_of_segments': N, 
                          'no_of_rampup_points': Nr,
                          'segment_displacement': dx,
                          'segment_duration': dt,
-                         'motor': self.motors[motor.name],
+                         'motor': self.motors[fast_axis.name],
                          'rampup_distance': self.ramp_dist,
+                         'serpentine': True,
+                         'no_of_lines': Nslow,
+                         'line_segments': N+1+2*Nr,
+                         'slow_motor': self.motors[slow_axis.name],
+                         'line_displacement': dy,
                         }
-
         self.time_modified = time.time()
+    
+    def setup_raster_traj(self, fast_axis, f_start, f_end, Nfast, step_size, dt, 
+                          slow_axis, s_start, s_end, Nslow):
+        """ the whole raster as a single trajectory, see raster(..., serpentine=True)
+            both axes must be XPS motors in the group of this trajectory
+        """
+        if not isinstance(slow_axis, XPSmotor) or slow_axis.name not in self.motors.keys():
+            raise Exception(f"{slow_axis} must be in the same XPS group as {fast_axis} for a serpentine raster.")
+        fwd = (fast_axis.user_offset_dir.get()>0)==(f_start<f_end)
+        dy = (s_end-s_start)/(Nslow-1)*slow_axis.user_offset_dir.get() if Nslow>1 else 0
+        self.define_raster_traj(fast_axis, Nfast-1, step_size, slow_axis, Nslow, dy, dt, forward_first=fwd)
+        self.setup_traj(fast_axis, f_start, f_end, Nfast, step_size, dt, slow_axis, Nslow, define=False)
+        self.traj_par['slow_start'] = s_start*slow_axis.user_offset_dir.get()
+    
+    def load_traj(self, key, gen, labels, positioners):
+        """ returns the names of the trajectory files on the controller and the ramp-up distance
+            gen() returns the trajectories, one for each label, and the ramp-up distance
+            the trajectories are generated, uploaded and verified only if key is not in the cache
+        """
+        if key in self.traj_cache.keys():
+            self.traj_cache.move_to_end(key)
+            self.traj_cache_stats['hits'] += 1
+            files,ramp_dist = self.traj_cache[key]
+            print(f"using cached trajectory {files[0]} ...")
+            return files,ramp_dist
+        
+        self.traj_cache_stats['misses'] += 1
+        trajs,ramp_dist = gen()
+        data = []
+        for ot in trajs:
+            buf = io.BytesIO()
+            np.savetxt(buf, ot, fmt='%f', delimiter=', ')
+            data.append(buf.getvalue())
+        h = hashlib.sha1(b''.join(data)).hexdigest()[:12]
+        files = [f"TrajScan_{h}_{d}.trj-{self.uname}" for d in labels]
+        self.upload_traj(dict(zip(files, data)))
+        
+        for fn in files:
+            err,ret = self.xps.MultipleAxesPVTVerification(self.sID, self.group, fn)
+            if err!='0':
+                print(ret)
+                raise Exception("trajectory verification failed.")
+            for p in positioners:
+                err,ret = self.xps.MultipleAxesPVTVerificationResultGet (self.sID, p)
+        
+        self.traj_cache[key] = (files, ramp_dist)
+        if len(self.traj_cache)>self.traj_cache_size:
+            k,(fs,rd) = self.traj_cache.popitem(last=False)
+            # files with the same content may still be in use under a different key
+            if fs not in [f for f,rd in self.traj_cache.values()]:
+                self.stale_traj_files += fs
+        return files,ramp_dist
+    
+    def upload_traj(self, files):
+        """ files: {file name: contents}
+            also remove the files of trajectories that are no longer in the cache
+        """
+        ftp = FTP()
+        ftp.connect(self.controller.ip_addr, self.controller.ftp_port)
+        ftp.login("Administrator", "Administrator")
+        ftp.cwd("Public/Trajectories")
+        for fn in self.stale_traj_files:
+            if fn in files.keys():
+                continue
+            try:
+                ftp.delete(fn)
+            except Exception as e:
+                print(f"unable to remove {fn} from the controller: {e}")
+        self.stale_traj_files = []
+        for fn,data in files.items():
+            ftp.storbinary('STOR %s' % fn, io.BytesIO(data))
+        ftp.quit()
+    
+    def traj_cache_info(self):
+        """ hit/miss statistics of the trajectory cache
+        """
+        n = self.traj_cache_stats['hits']+self.traj_cache_stats['misses']
+        return {**self.traj_cache_stats, 'size': len(self.traj_cache), 
+                'hit_rate': (self.traj_cache_stats['hits']/n if n>0 else 0)}
+    
+    def clear_traj_cache(self):
+        """ e.g. after the controller is rebooted 
+        """
+        for files,rd in self.traj_cache.values():
+            self.stale_traj_files += files
+        self.traj_cache.clear()
         
     def exec_traj(self, forward=True, clean_event_queue=False, n_retry=5):
         """
            execuate either the foward or backward trajectory
+           or the whole raster, if defined by setup_raster_traj()
         """
         if self.verified==False:
             raise Exception("trajectory not defined/verified.")
@@ -335,28 +516,59 @@ class XPStraj(trajControl):
         Nr = self.traj_par['no_of_rampup_points']
         motor = self.traj_par['motor']
         dt = self.traj_par['segment_duration']
-        
-        if forward: 
-            traj_fn = self.traj_files[0]
+        serpentine = self.traj_par.get('serpentine', False)
+        
+        if serpentine:
+            forward = self.traj_par['run_forward_first']
+            traj_idx = 0
+            # pulses continue through the turnarounds between lines, to be gated by the Zebra
+            pulse_end = N+Nr+1 + (self.traj_par['no_of_lines']-1)*self.traj_par['line_segments']
+        elif forward: 
+            traj_idx = 0
+            pulse_end = N+Nr+1
         else:
-            traj_fn = self.traj_files[1]
+            traj_idx = 1
+            pulse_end = N+Nr+1
+        traj_fn = self.traj_files[traj_idx]
         
         print("moving into starting position ...")
         pos = (self.traj_par['ready_pos'][0] if forward else self.traj_par['ready_pos'][1])
+        self.controller.poller.kick()
         err,ret = self.xps.GroupMoveAbsolute(self.sID, self.traj_par['motor'], [pos])
+        if serpentine:
+            err,ret = self.xps.GroupMoveAbsolute(self.sID, self.traj_par['slow_motor'], [self.traj_par['slow_start']])
             
         # otherwise starting the trajectory might generate an error
-        while self.moving():
-            time.sleep(0.2)
+        # GroupMoveAbsolute() returns at the end of the motion, wait for the poller to agree 
+        poller = self.controller.poller
+        t0 = time.time()
+        poller.refresh()
+        if not poller.wait_for(lambda: poller.status[motor][2]>=t0 and not poller.moving(), timeout=10):
+            raise Exception(f"{motor} not in the starting position after 10 s.")
+        self.mark_time("move")
         
         print("executing trajectory ...")
         # first set up gathering
         self.xps.GatheringReset(self.sID)        
         # pulse is generated when the positioner enters the segment
-        print("starting a trajectory with triggering parameters: %d, %d, %.3f ..." % (Nr+1, N+Nr+1, dt))
-        self.xps.MultipleAxesPVTPulseOutputSet(self.sID, self.group, Nr+1, N+Nr+1, dt)
-        self.xps.MultipleAxesPVTVerification(self.sID, self.group, traj_fn)
-        self.xps.GatheringConfigurationSet(self.sID, [motor+".CurrentPosition"])        
+        print("starting a trajectory with triggering parameters: %d, %d, %.3f ..." % (Nr+1, pulse_end, dt))
+        self.xps.MultipleAxesPVTPulseOutputSet(self.sID, self.group, Nr+1, pulse_end, dt)
+        err,ret = self.xps.MultipleAxesPVTVerification(self.sID, self.group, traj_fn)
+        if err!='0':
+            # e.g. the files are gone after the controller is rebooted 
+            print(f"verification of {traj_fn} failed, uploading the trajectory again ...")
+            self.clear_traj_cache()
+            self.traj_files,self.ramp_dist = self.load_traj(*self.traj_def)
+            traj_fn = self.traj_files[traj_idx]
+            # load_traj() verifies all the files, the one to execute must be verified last
+            err,ret = self.xps.MultipleAxesPVTVerification(self.sID, self.group, traj_fn)
+            if err!='0':
+                raise Exception(f"verification of {traj_fn} failed: {ret}")
+        if serpentine:
+            self.xps.GatheringConfigurationSet(self.sID, [motor+".CurrentPosition", 
+                                                          self.traj_par['slow_motor']+".CurrentPosition"])
+        else:
+            self.xps.GatheringConfigurationSet(self.sID, [motor+".CurrentPosition"])        
         self.xps.EventExtendedConfigurationTriggerSet(self.sID,
                                                       ["Always", f"{self.group}.PVT.TrajectoryPulse"],
                                                       ["0", "0"], ["0", "0"], ["0", "0"], ["0", "0"])
@@ -370,11 +582,14 @@ class XPStraj(trajControl):
                 for ev in ret.split(';'):
                     self.xps.EventExtendedRemove(self.sID, ev) 
         eID = self.xps.EventExtendedStart(self.sID)[1]
+        self.mark_time("setup")
         self.start_time = time.time()
         
+        self.controller.poller.kick()
         [err, ret] = self.xps.MultipleAxesPVTExecution(self.sID, self.group, traj_fn, 1)
         if err!='0':
-            self.safe_stop()
+            self.aborted = True
+            self.controller.abort(self.group)
             print("motion group re-initialized ...")
             #    break
             print(f'An error (code {err}) as occured when starting trajectory execution') #, retry #{i+1} ...')
@@ -382,16 +597,18 @@ class XPStraj(trajControl):
             [err, ret] = self.xps.GroupMotionEnable(self.sID, self.group)
             print(f"attempted to re-enable motion group: ", end='')
             time.sleep(1)
+        self.mark_time("exec")
         
         if not self.aborted:
             self.xps.GatheringStopAndSave(self.sID)
             self.xps.EventExtendedRemove(self.sID, eID)
-            self.update_readback()
+            if serpentine:
+                self.update_raster_readback()
+            else:
+                self.update_readback()
+            self.mark_time("readback")
             print('end of trajectory execution, ', end='')
 
-        if self._traj_status != None:
-            self._traj_status._finished()
-
         # for testing only
         #if caget('XF:16IDC-ES:XPSAux1Bi0'):
         #    self.aborted = True
@@ -404,6 +621,44 @@ class XPStraj(trajControl):
         
         return [float(p) for p in ret.split('\n') if p!='']
     
+    def readback_gathering(self, block_size=1000):
+        """ all gathered data, one row per pulse, one column per gathered quantity
+            read block_size lines at a time, to limit the size of the reply
+        """
+        err,ret = self.xps.GatheringCurrentNumberGet(self.sID)
+        ndata = int(ret.split(',')[0])
+        lines = []
+        for i in range(0, ndata, block_size):
+            err,ret = self.xps.GatheringDataMultipleLinesGet(self.sID, i, min(block_size, ndata-i))
+            lines += [p for p in ret.split('\n') if p!='']
+        return np.array([[float(v) for v in p.split(';')] for p in lines])
+    
+    def update_raster_readback(self):
+        """ for a trajectory defined by setup_raster_traj(), keep the positions gathered in the lines
+            one slow axis position per line, the average during the line
+        """
+        N = self.traj_par['no_of_segments']
+        Nr = self.traj_par['no_of_rampup_points']
+        Nl = self.traj_par['no_of_lines']
+        dt = self.traj_par['segment_duration']
+        nl = self.traj_par['line_segments']
+        data = self.readback_gathering()
+        k = np.arange(len(data))
+        sel = (k%nl)<=N
+        if sel.sum()!=Nl*(N+1):
+            print(f"Warning: incorrect readback length {sel.sum()}, expecting {Nl*(N+1)}")
+        ts = self.start_time + (0.5 + Nr + k)*dt
+        self.read_back['fast_axis'] += list(data[sel, 0])
+        self.read_back['timestamp'] += list(ts[sel])
+        
+        if self.slow_axis is not None:
+            for i in range(Nl):
+                li = sel & (k//nl==i)
+                self.read_back['slow_axis'].append(data[li, 1].mean()*self.slow_axis.user_offset_dir.get())
+                self.read_back['timestamp2'].append(ts[li].mean())
+
+        print("traj data updated ..")
+    
 
 class ZEBRAtraj(trajControl):
     def __init__(self, controller, motors, **kwargs):
@@ -415,6 +670,15 @@ class ZEBRAtraj(trajControl):
         super().__init__(name=controller.name+"_traj", **kwargs)
         self.controller = controller
         self.vel_scale = 2.1
+        self._disarmed = None
+        # positions captured in the current line, streamed from the PC data array as it fills
+        self.pc_buf = np.zeros(0)
+        self.pc_count = 0
+        self._pc_line_done = threading.Event()
+        self._pc_cid = None
+        self._ndown_cid = None
+        self._pc_value = np.zeros(0)
+        self._pc_ndown = 0
 
         # need to revise Zebra IOC to get PV names for connected motors
         # self.motors provides the encoder number based on the PV name of the motor
@@ -455,15 +719,17 @@ class ZEBRAtraj(trajControl):
         
         #   enc: Enc1/Enc2 or 0/1
         #   gate_width/gate_step/pulse_start/pulse_width/pulse_step/pulse_max: independent of traj direction
-        self.controller.pc.enc.set(f"Enc{self.motors[motor.prefix]}").wait()
-        self.controller.pc.gate_source.set('Position').wait()
-        self.controller.pc.pulse_source.set('Position').wait()
-        self.controller.pc.gate_width.set((N+1)*dx).wait()
-        self.controller.pc.gate_step.set((N+2)*dx).wait()
-        self.controller.pc.pulse_start.set(0).wait()
-        self.controller.pc.pulse_step.set(dx).wait()
-        self.controller.pc.pulse_width.set(dx/5).wait()
-        self.controller.pc.pulse_max.set(0).wait()   # disarm once gate is low
+        # the sources first, the units of the rest depend on them; each group is set as a batch 
+        pc = self.controller.pc
+        setSignals([(pc.enc, f"Enc{self.motors[motor.prefix]}"),
+                    (pc.gate_source, 'Position'),
+                    (pc.pulse_source, 'Position')])
+        setSignals([(pc.gate_width, (N+1)*dx),
+                    (pc.gate_step, (N+2)*dx),
+                    (pc.pulse_start, 0),
+                    (pc.pulse_step, dx),
+                    (pc.pulse_width, dx/5),
+                    (pc.pulse_max, 0)])   # disarm once gate is low
         
         self.ramp_dist = dx
         self.verified = True
@@ -493,45 +759,109 @@ class ZEBRAtraj(trajControl):
         # hence the added factor of 2.2 
         # possibily a Delta-Tau issue?
         vel = self.traj_par['segment_displacement']/self.traj_par['segment_duration']*self.vel_scale
-        # set motor speed
-        motor.velocity.set(vel).wait()
-        
+        # set motor speed, together with the direction dependent Zebra PC parameters 
         # the following need to be changed every time the trajectory is reversed
         #   dir: Positive/Negative or 0/1
         #   gate_start: ready_position +/- step
-        if forward: 
-            self.controller.pc.dir.set("Positive").wait()
-            self.controller.pc.gate_start.set(ready_pos+dx0).wait()
-        else:
-            self.controller.pc.dir.set("Negative").wait()
-            self.controller.pc.gate_start.set(ready_pos-dx0).wait()
+        pc = self.controller.pc
+        setSignals([(motor.velocity, vel),
+                    (pc.dir, "Positive" if forward else "Negative"),
+                    (pc.gate_start, ready_pos+dx0 if forward else ready_pos-dx0)])
         
         print("moving into starting position ...")
         motor.move(ready_pos, wait=True)
+        self.mark_time("move")
         
         print("arming Zebra PC ...")
-        self.controller.pc.arm.set(0).wait()  # the value doesn't seem to matter
-        while (not self.controller.pc.armed.get()):
-            time.sleep(0.1)
-            
-        print(f"moving {self.flying_motor.name} ...")
-        target_pos = self.traj_par['ready_pos'][1 if forward else 0]
-        motor.move(target_pos, wait=True)
+        # monitor the armed state, instead of polling it
+        self._disarmed = None
+        armed = SubscriptionStatus(pc.armed, lambda value, **kwargs: value==1)
+        pc.arm.set(0).wait()  # the value doesn't seem to matter
+        armed.wait(10)
+        self._disarmed = SubscriptionStatus(pc.armed, lambda value, **kwargs: value==0)
+        self.start_pc_stream()
+        try:
+            self.mark_time("setup")
+
+            print(f"moving {self.flying_motor.name} ...")
+            target_pos = self.traj_par['ready_pos'][1 if forward else 0]
+            self.start_time = time.time()
+            motor.move(target_pos, wait=True)
+            self.mark_time("exec")
 
-        self.update_readback()
+            self.update_readback()
+            self.mark_time("readback")
+        finally:
+            self.stop_pc_stream()
         print('end of trajectory execution, ', end='')
             
         # reset motor speed
         motor.velocity.set(vel0).wait()
-        
-        if self._traj_status!=None:
-            self._traj_status._finished()
             
-    def readback_traj(self):
+    def pc_data_signal(self):
+        return getattr(self.controller.pc.data, f"enc{self.motors[self.flying_motor.prefix]}")
+    
+    def start_pc_stream(self):
+        """ the IOC updates the PC data arrays while capturing, copy the new points into 
+            a buffer preallocated for the line, so that nothing is left to read when the gate closes
+        """
+        self.stop_pc_stream()
+        self.pc_buf = np.zeros(self.traj_par['no_of_segments']+1)
+        self.pc_count = 0
+        self._pc_value = np.zeros(0)
+        self._pc_ndown = 0
+        self._pc_line_done.clear()
+        # the arrays are reset when PC is armed, no need to look at the current value
+        # only the first PC_NUM_DOWN elements of the array are valid, the two are updated separately
+        self._pc_cid = self.pc_data_signal().subscribe(self._pc_data_cb, run=False)
+        self._ndown_cid = self.controller.pc.data.num_down.subscribe(self._pc_ndown_cb, run=False)
+        
+    def stop_pc_stream(self):
+        if self._pc_cid is not None:
+            self.pc_data_signal().unsubscribe(self._pc_cid)
+            self._pc_cid = None
+        if self._ndown_cid is not None:
+            self.controller.pc.data.num_down.unsubscribe(self._ndown_cid)
+            self._ndown_cid = None
+    
+    def _pc_data_cb(self, value, **kwargs):
+        self._pc_value = np.asarray(value)
+        self._pc_update()
+
+    def _pc_ndown_cb(self, value, **kwargs):
+        self._pc_ndown = int(value)
+        self._pc_update()
+
+    def _pc_update(self):
+        n = min(len(self._pc_value), self._pc_ndown, len(self.pc_buf))
+        if n>self.pc_count:
+            self.pc_buf[self.pc_count:n] = self._pc_value[self.pc_count:n]
+            self.pc_count = n
+        if self.pc_count==len(self.pc_buf):
+            self._pc_line_done.set()
+    
+    def readback_traj(self, timeout=1.0, disarm_timeout=10.):
+        """ the positions are streamed during the line, see start_pc_stream()
+            read the whole array only if the last update does not arrive within timeout after
+            the gate closes
+            PC should disarm within disarm_timeout after the expected duration of the trajectory
+        """
         print("waiting for Zebra PC to disarm ...")
-        while (self.controller.pc.armed.get()):
-            time.sleep(0.1)
-        
-        print('reading back trajectory ...')  
-        data = self.controller.pc.data.read()
-        return data[f'Zebra_pc_data_enc{self.motors[self.flying_motor.prefix]}']['value']
+        # the motor may run slower than asked for, see vel_scale
+        t_traj = (self.traj_par['no_of_segments']+2)*self.traj_par['segment_duration']*self.vel_scale
+        disarmed = self._disarmed
+        if disarmed is None:
+            disarmed = SubscriptionStatus(self.controller.pc.armed, lambda value, **kwargs: value==0)
+        try:
+            disarmed.wait(t_traj+disarm_timeout)
+            self._pc_line_done.wait(timeout)
+        except WaitTimeoutError:
+            raise Exception(f"Zebra PC did not disarm within {t_traj+disarm_timeout:.1f} sec.")
+        finally:
+            self.stop_pc_stream()
+        if self.pc_count==len(self.pc_buf):
+            return self.pc_buf.copy()
+        
+        print(f'only {self.pc_count} of {len(self.pc_buf)} positions streamed, reading back trajectory ...')  
+        ndown = int(self.controller.pc.data.num_down.get())
+        return np.asarray(self.pc_data_signal().get())[:ndown]
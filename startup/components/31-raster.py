@@ -29,20 +29,92 @@ pil and emXext need to be revised to work like a flyer
         xsp3 shouldn't need it, single hdf per scan
 """    
         
+class RasterTiming(Device):
+    """ where the time goes in raster(): one event per line in the "timing" stream of the run, 
+        plus the phases before/after the lines, kept for the last scan, see summary()
+        traj_*: from traj.timing, within the wait for the trajectory to complete (traj_wait)
+        line_start: kickoff() of the trajectory and the TetrAMMs
+        em_readback: complete() of the TetrAMMs, i.e. reading back the time series
+    """
+    line = Cpt(Signal, value=0)
+    slow_move = Cpt(Signal, value=0.)
+    line_start = Cpt(Signal, value=0.)
+    traj_move = Cpt(Signal, value=0.)
+    traj_setup = Cpt(Signal, value=0.)
+    traj_exec = Cpt(Signal, value=0.)
+    traj_readback = Cpt(Signal, value=0.)
+    traj_wait = Cpt(Signal, value=0.)
+    em_readback = Cpt(Signal, value=0.)
+    total = Cpt(Signal, value=0.)
+    
+    scan_phases = ["setup", "stage", "lines", "det_complete", "collect", "sleep"]
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lines = []
+        self.scan = {}
+        self.exposure = 0
+        self._t_mark = 0
+        
+    def reset(self, exposure):
+        """ exposure is the total exposure time of the scan
+        """
+        self.lines = []
+        self.scan = {}
+        self.exposure = exposure
+        self._t_mark = time.time()
+        
+    def mark_time(self, phase):
+        """ time since the previous mark as the duration of a per-scan phase
+        """
+        t = time.time()
+        self.scan[phase] = self.scan.get(phase, 0) + t-self._t_mark
+        self._t_mark = t
+        
+    def record_line(self, phases):
+        phases['line'] = len(self.lines)
+        for k in self.read_attrs:
+            getattr(self, k).put(phases.get(k, 0))
+        self.lines.append(phases)
+    
+    def summary(self):
+        """ returns the time spent in each phase, also printed
+        """
+        t_tot = sum(self.scan.values())
+        print(f"raster timing: {len(self.lines)} line(s), {t_tot:.2f} s in total, "
+              f"{self.exposure/t_tot*100:.0f}% of the time exposing")
+        print(f"{'':>16}{'total (s)':>12}{'mean (s)':>12}{'max (s)':>12}")
+        ret = {}
+        for k in self.scan_phases:
+            ret[k] = self.scan.get(k, 0)
+            print(f"{k:>16}{ret[k]:>12.3f}")
+            if k=="lines":
+                for p in self.read_attrs:
+                    if p in ["line", "total"]:
+                        continue
+                    v = np.asarray([l.get(p, 0) for l in self.lines])
+                    ret[p] = v.sum()
+                    print(f"{'  '+p:>16}{v.sum():>12.3f}{v.mean():>12.3f}{v.max():>12.3f}")
+        ret['exposure'] = self.exposure
+        return ret
+
+raster_timing = RasterTiming(name="raster_timing")
+        
 def rel_raster(exp_time, fast_axis, f_start, f_end, Nfast,
                slow_axis=None, s_start=0, s_end=0, Nslow=1, debug=False, md=None, 
-               detectors = [pil, em1ext, em2ext]
+               detectors = [pil, em1ext, em2ext], serpentine=False, preview=None
               ):
 
     fm0 = fast_axis.position
     sm0 = slow_axis.position
     yield from raster(exp_time, fast_axis, fm0+f_start, fm0+f_end, Nfast,
                       slow_axis=slow_axis, s_start=sm0+s_start, s_end=sm0+s_end, Nslow=Nslow, 
-                      debug=debug, md=md, detectors=detectors)
+                      debug=debug, md=md, detectors=detectors, serpentine=serpentine, 
+                      preview=preview)
     
 def raster(exp_time, fast_axis, f_start, f_end, Nfast,
            slow_axis=None, s_start=0, s_end=0, Nslow=1, debug=False, md=None,
-           detectors = [pil, em1ext, em2ext] 
+           detectors = [pil, em1ext, em2ext], serpentine=False, preview=None
           ):
     """ raster scan in fly mode using detectors with exposure time of exp_time
         detectors must be a member of pilatus_detectors_ext
@@ -53,8 +125,15 @@ def raster(exp_time, fast_axis, f_start, f_end, Nfast,
         
         use it within the run engine: RE(raster(...))
         update 2020aug: always use the re-defined pilatus detector group
+        the time spent in each phase of every line is saved in the "timing" stream, 
+            raster_timing.summary() for the last scan
+        serpentine=True: the whole raster is a single trajectory, the slow axis moves during 
+            the turnarounds between lines; both axes must be in the same XPS group
+            the trajectory pulses reach the detectors only during the lines, gated by the Zebra
+        preview=em2ext: show the map from the TetrAMM as the lines come in, see LiveMapPreview
         
     """
+    raster_timing.reset(Nfast*Nslow*exp_time)
     step_size = np.fabs((f_end-f_start)/(Nfast-1))
     dt = exp_time + 0.005    # exposure_period is 5ms longer than exposure_time, as defined in Pilatus
 
@@ -62,9 +141,21 @@ def raster(exp_time, fast_axis, f_start, f_end, Nfast,
         raise exception(f"don't know how to run atrajectory using {fast_axis} ...")
         
     traj = fast_axis.traj
-    traj.setup_traj(fast_axis, f_start, f_end, Nfast, step_size, dt, slow_axis, Nslow)
+    if serpentine:
+        if slow_axis is None or not hasattr(traj, "setup_raster_traj"):
+            raise Exception(f"serpentine raster requires a slow_axis and a XPS trajectory ...")
+        traj.setup_raster_traj(fast_axis, f_start, f_end, Nfast, step_size, dt, 
+                               slow_axis, s_start, s_end, Nslow)
+    else:
+        traj.setup_traj(fast_axis, f_start, f_end, Nfast, step_size, dt, slow_axis, Nslow)
     traj.clear_readback()
     
+    if preview is not None:
+        if preview not in detectors:
+            raise Exception(f"{preview.name} must be one of the detectors for the preview ...")
+        fsign = (fast_axis.user_offset_dir.get() if isinstance(fast_axis, XPSmotor) else 1)
+        preview = LiveMapPreview(traj, preview, f_start, f_end, Nfast, s_start, s_end, Nslow, fsign=fsign)
+    
     if debug:
         print('## trajectory parameters:')
         print(traj.traj_par)
@@ -84,6 +175,7 @@ def raster(exp_time, fast_axis, f_start, f_end, Nfast,
     print(pos_s)
     print(motor_names)
     
+    capture_modes = {}   # restored at the end of the scan
     for det in detectors:
         if isinstance(det, LiXXspress):
             det.set_ext_trigger(True)
@@ -99,6 +191,12 @@ def raster(exp_time, fast_axis, f_start, f_end, Nfast,
             det.avg_time.put(exp_time)
             det.npoints.put(Nfast)
             det.rep = Nslow
+            det.nlines = (Nslow if serpentine else 1)
+            if det.capture_mode=="sum" and Nfast*det.nlines>TimeSeriesCapture.max_points:
+                # the circular buffer cannot hold all the points read back at complete()
+                print(f"{det.name}: {Nfast*det.nlines} points per read-back, switching to capture_mode='channels'")
+                capture_modes[det] = det.capture_mode
+                det.capture_mode = "channels"
         else:
             raise Exception(f"{det} is not supported in a raster scan ...")
 
@@ -115,47 +213,91 @@ def raster(exp_time, fast_axis, f_start, f_end, Nfast,
     _md.update(md or {})
     _md['hints'].setdefault('dimensions', [(('time',), 'primary')])        
    
-    def line():
+    def line(phases):
         print("in line()")
+        t0 = time.time()
         yield from bps.kickoff(traj, wait=False)
         for em in set([em1ext, em2ext])&set(detectors):
             yield from bps.kickoff(em, wait=False)
-        yield from bps.complete(traj, wait=False)
+        t1 = time.time()
+        # the status is finished by the trajectory thread, the line ends when the trajectory does
+        yield from bps.complete(traj, wait=True)
+        t2 = time.time()
         for em in set([em1ext, em2ext])&set(detectors):
             yield from bps.complete(em, wait=False)
+        phases.update({'line_start': t1-t0, 'traj_wait': t2-t1, 'em_readback': time.time()-t2})
+        phases.update({'traj_'+k: v for k,v in traj.timing.items()})
         print("leaving line()")
+    
+    def record_line(phases, t0):
+        phases['total'] = time.time()-t0
+        raster_timing.record_line(phases)
+        if preview is not None:
+            preview.update()
+        yield from bps.trigger_and_read([raster_timing], name="timing")
 
+    def serpentine_line():
+        # the pulses for the Nfast points in each line span Nfast-1 segments
+        set_zebra_line_gate(zebra, Nslow, (Nfast-0.5)*dt, traj.traj_par['line_segments']*dt)
+        def clear_gate():
+            clear_zebra_line_gate(zebra)
+            yield from bps.null()
+        phases = {'slow_move': 0}
+        t0 = time.time()
+        yield from bpp.finalize_wrapper(line(phases), clear_gate)
+        yield from record_line(phases, t0)
+        
     @bpp.stage_decorator([traj])
     @bpp.stage_decorator(detectors)
     @bpp.run_decorator(md=_md)
     @fast_shutter_decorator()
     def inner(detectors, fast_axis, slow_axis, Nslow, pos_s):
         print("in inner()")
+        raster_timing.mark_time("stage")
         
         running_forward = traj.traj_par['run_forward_first']
+        if serpentine:
+            print("starting the raster trajectory ...")
+            yield from serpentine_line()
+            pos_s = []
         for sp in pos_s:
             print("start of the loop")
+            t0 = time.time()
             if slow_axis is not None:
                 print(f"moving {slow_axis.name} to {sp}")
                 yield from mv(slow_axis, sp)
+            phases = {'slow_move': time.time()-t0}
 
             print("starting trajectory ...")
             traj.select_forward_traj(running_forward)
-            yield from line()
+            yield from line(phases)
+            yield from record_line(phases, t0)
             print("Done")
             running_forward = not running_forward
+        raster_timing.mark_time("lines")
 
         for det in detectors:
             if isinstance(det, LiXDetectors): # pil
                 yield from bps.complete(det, wait=True)
             elif isinstance(det, LiXXspress): # xsp3
                 yield from bps.complete(det, wait=False)
+        raster_timing.mark_time("det_complete")
 
         for flyer in [traj]+detectors:
             print(f"collecting from {flyer.name} ...")
             yield from bps.collect(flyer)
+        raster_timing.mark_time("collect")
         print("leaving inner()")
 
-    yield from inner(detectors, fast_axis, slow_axis, Nslow, pos_s)
+    def restore_capture_modes():
+        for det,mode in capture_modes.items():
+            det.capture_mode = mode
+        yield from bps.null()
+
+    raster_timing.mark_time("setup")
+    yield from bpp.finalize_wrapper(inner(detectors, fast_axis, slow_axis, Nslow, pos_s), 
+                                    restore_capture_modes)
     yield from sleeplan(1.0)  # give time for the current em1 timeseries monitor to finish
+    raster_timing.mark_time("sleep")
+    raster_timing.summary()
          
\ No newline at end of file
@@ -0,0 +1,136 @@
+print(f"Loading {__file__}...")
+
+import numpy as np
+
+class MapAssembler:
+    """ bins the data from a raster onto the regular grid of the scan, Nslow x Nfast
+        each frame goes to the nearest grid point, according to its fast axis readback position,
+        so that the small velocity ripple and the line direction in serpentine scans do not matter;
+        frames that end up in the same pixel are averaged
+
+        the readback position is taken at the start of the exposure, i.e. half a step before
+        the average position during the exposure, in the direction of motion (offset=0.5)
+
+        e.g. ma = MapAssembler(0, 1, 101, 0, 0.5, 51)
+             ma.add(fpos, values, spos, line)
+             ma.image()
+    """
+    def __init__(self, f_start, f_end, Nfast, s_start=0, s_end=0, Nslow=1, offset=0.5):
+        self.f0 = f_start
+        self.df = (f_end-f_start)/(Nfast-1) if Nfast>1 else 1
+        self.s0 = s_start
+        self.ds = (s_end-s_start)/(Nslow-1) if Nslow>1 else 1
+        self.shape = (Nslow, Nfast)
+        self.offset = offset
+        self.clear()
+
+    def clear(self):
+        self.sum = np.zeros(self.shape[0]*self.shape[1])
+        self.count = np.zeros(self.shape[0]*self.shape[1])
+        self.nframes = 0
+        self.nrejected = 0
+
+    def extent(self):
+        """ for imshow(), with the origin at the lower left
+        """
+        (Ns,Nf) = self.shape
+        return [self.f0-self.df/2, self.f0+(Nf-0.5)*self.df, self.s0-self.ds/2, self.s0+(Ns-0.5)*self.ds]
+
+    def add(self, fpos, values, spos=None, line=None):
+        """ fpos and values: one for each frame
+            line: the line each frame belongs to, needed for the direction of motion when the
+                  frames are from more than one line
+            spos: slow axis position, for each line (indexed by line) if line is given, 
+                  otherwise a single value or one for each frame
+        """
+        fpos = np.asarray(fpos, dtype=float)
+        values = np.asarray(values, dtype=float)
+        n = len(fpos)
+        if len(values)!=n:
+            raise Exception(f"mismatched number of positions ({n}) and values ({len(values)}).")
+        given_line = (line is not None)
+        if line is None:
+            line = np.zeros(n, dtype=int)
+        else:
+            line = np.asarray(line, dtype=int)
+
+        # direction of motion in each line, from the position change between frames in the same line
+        same = (line[1:]==line[:-1])
+        l0 = line.min() if n>0 else 0
+        d = np.bincount(line[1:][same]-l0, weights=np.diff(fpos)[same], minlength=line.max()-l0+1 if n>0 else 0)
+        direction = np.sign(d)[line-l0]
+
+        fi = np.rint((fpos+direction*self.offset*np.fabs(self.df)-self.f0)/self.df).astype(int)
+        if spos is None:
+            si = np.zeros(n, dtype=int)
+        else:
+            spos = np.asarray(spos, dtype=float)
+            if given_line:
+                spos = spos[line]
+            si = np.rint((spos-self.s0)/self.ds).astype(int)
+
+        ok = (fi>=0) & (fi<self.shape[1]) & (si>=0) & (si<self.shape[0]) & np.isfinite(values)
+        idx = si[ok]*self.shape[1]+fi[ok]
+        if len(idx)>0:
+            # only the part of the map covered by these frames, e.g. a single line
+            i0 = idx.min()
+            i1 = idx.max()+1
+            self.sum[i0:i1] += np.bincount(idx-i0, weights=values[ok], minlength=i1-i0)
+            self.count[i0:i1] += np.bincount(idx-i0, minlength=i1-i0)
+        self.nframes += n
+        self.nrejected += n-ok.sum()
+
+    def image(self):
+        """ NaN where there is no data
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            img = self.sum/self.count
+        img[self.count==0] = np.nan
+        return img.reshape(self.shape)
+
+
+class LiveMapPreview:
+    """ an image of the map, updated after each line in raster(..., preview=em2ext)
+        the values are from the time series of the TetrAMM, the positions from the trajectory
+        readback; lines that are already in the map are skipped
+    """
+    def __init__(self, traj, em, f_start, f_end, Nfast, s_start=0, s_end=0, Nslow=1, fsign=1):
+        self.traj = traj
+        self.em = em
+        self.Nfast = Nfast
+        self.fsign = fsign   # trajectory readback to user position
+        (self.s_start, self.s_end, self.Nslow) = (s_start, s_end, Nslow)
+        self.assembler = MapAssembler(f_start, f_end, Nfast, s_start, s_end, Nslow)
+        self.nlines = 0
+        self.fig = plt.figure()
+        self.ax = self.fig.gca()
+        self.im = self.ax.imshow(self.assembler.image(), origin="lower", aspect="auto",
+                                 interpolation="nearest", extent=self.assembler.extent())
+        self.ax.set_title(em.name)
+        self.fig.colorbar(self.im)
+        plt.show(block=False)
+
+    def update(self):
+        data = self.em.read_back['data']
+        nl = len(data)
+        if nl<=self.nlines:
+            return
+        Nf = self.Nfast
+        fpos = np.asarray(self.traj.read_back['fast_axis'][self.nlines*Nf:nl*Nf])*self.fsign
+        values = np.concatenate([np.asarray(v)[:Nf] for v in data[self.nlines:nl]])
+        line = np.repeat(np.arange(self.nlines, nl), Nf)[:len(fpos)]
+        # the nominal slow axis positions, unless read back
+        spos = np.linspace(self.s_start, self.s_end, max(self.Nslow, nl))
+        if 'slow_axis' in self.traj.read_back.keys():
+            rb = self.traj.read_back['slow_axis'][:nl]
+            spos[:len(rb)] = rb
+        n = min(len(fpos), len(values))
+        self.assembler.add(fpos[:n], values[:n], spos, line[:n])
+        self.nlines = nl
+
+        img = self.assembler.image()
+        self.im.set_data(img)
+        if np.isfinite(img).any():
+            self.im.set_clim(np.nanmin(img), np.nanmax(img))
+        self.fig.canvas.draw_idle()
+        self.fig.canvas.flush_events()
@@ -6,10 +6,15 @@
 #  __sendAndReceive() is revised to transition from python 2 to 3:
 #           confusion between byte streams and strings
 #           handling of socket error
+#  each socket has its own lock and receive buffer, so that different threads can use different
+#  sockets at the same time, see XPSConnectionPool; sendAndReceiveMany() pipelines commands
+#  a socket is held for the whole round trip, i.e. until a motion is complete for GroupMoveAbsolute(),
+#  GroupMoveAbort()/GroupKill() must therefore be sent on a socket not used for motions
 #
 
 import socket
 import threading
+import queue
 
 class XPS:
     # Defines
@@ -18,46 +23,89 @@ class XPS:
     # Global variables
     __sockets = {}
     __usedSockets = {}
+    __locks = {}
+    __buffers = {}
     __nbSockets = 0
     debug = False
+    recv_size = 65536
+    terminator = b',EndOfAPI'
 
     # Initialization Function
     def __init__ (self):
         XPS.__nbSockets = 0
         self.errorcodes = {}
-        self.lock = threading.Lock()
         for socketId in range(self.MAX_NB_SOCKETS):
             XPS.__usedSockets[socketId] = 0
 
     def sendAndReceive(self, socketId, command):
-        self.lock.acquire()
-        ret = self.__sendAndReceive(socketId, command)
-        self.lock.release()
+        return self.__sendAndReceive(socketId, command)
+        
+    def __receive(self, socketId):
+        """ return the next reply on the socket, without the terminator
+            any bytes received beyond the terminator are kept for the next reply
+        """
+        buf = XPS.__buffers[socketId]
+        start = 0
+        while True:
+            idx = buf.find(self.terminator, start)
+            if idx>=0:
+                break
+            # the terminator may straddle two recv()
+            start = max(0, len(buf)-len(self.terminator)+1)
+            data = XPS.__sockets[socketId].recv(self.recv_size)
+            if not data:
+                raise socket.error("connection closed by the controller")
+            buf += data
+        ret = buf[:idx].decode()
+        del buf[:idx+len(self.terminator)]
         return ret
         
-    # Send command and get return
-    def __sendAndReceive (self, socketId, command):
-        try:
-            XPS.__sockets[socketId].send(command.encode())
-            ret = '' 
-            while (ret.find(',EndOfAPI') == -1):
-                ret += XPS.__sockets[socketId].recv(1024).decode()
-        except socket.timeout:
-            print("xps timeout.")
-            return [-2, '']
-        except socket.error as e: # (errNb, errString):
-            print('Socket error: %s ' % e)
-            return [-2, '']
-
+    def __parse(self, command, ret):
         if self.debug:
             print(command, ret)
-        retlist = ret.strip(',EndOfAPI').split(',', 1)
+        retlist = ret.split(',', 1)
         if retlist[0]!='0':
             print(f"returned value for {command}: ", retlist)
         if len(retlist)==1:
             retlist.append('')
         return retlist
     
+    # Send command and get return
+    def __sendAndReceive (self, socketId, command):
+        with XPS.__locks[socketId]:
+            try:
+                XPS.__sockets[socketId].sendall(command.encode())
+                ret = self.__receive(socketId)
+            except socket.timeout:
+                print("xps timeout.")
+                XPS.__buffers[socketId].clear()
+                return [-2, '']
+            except socket.error as e: # (errNb, errString):
+                print('Socket error: %s ' % e)
+                XPS.__buffers[socketId].clear()
+                return [-2, '']
+        return self.__parse(command, ret)
+    
+    def sendAndReceiveMany(self, socketId, commands):
+        """ send all commands before reading any reply, the controller processes the commands 
+            received on a socket in order, and the replies come back in the same order
+            this saves a round trip per command, e.g. for reading the status and position of 
+            several groups; do not include commands that wait for a motion to finish
+        """
+        with XPS.__locks[socketId]:
+            try:
+                XPS.__sockets[socketId].sendall(''.join(commands).encode())
+                rets = [self.__receive(socketId) for cmd in commands]
+            except socket.timeout:
+                print("xps timeout.")
+                XPS.__buffers[socketId].clear()
+                return [[-2, ''] for cmd in commands]
+            except socket.error as e:
+                print('Socket error: %s ' % e)
+                XPS.__buffers[socketId].clear()
+                return [[-2, ''] for cmd in commands]
+        return [self.__parse(cmd, ret) for cmd,ret in zip(commands, rets)]
+    
     # TCP_ConnectToServer
     def TCP_ConnectToServer (self, IP, port, timeOut):
         socketId = 0
@@ -71,9 +119,13 @@ class XPS:
 
         XPS.__usedSockets[socketId] = 1
         XPS.__nbSockets += 1
+        XPS.__locks[socketId] = threading.Lock()
+        XPS.__buffers[socketId] = bytearray()
         try:
             XPS.__sockets[socketId] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             XPS.__sockets[socketId].connect((IP, port))
+            # small request/reply messages, do not wait to fill a segment
+            XPS.__sockets[socketId].setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             XPS.__sockets[socketId].settimeout(timeOut)
             XPS.__sockets[socketId].setblocking(1)
         except socket.error:
@@ -104,6 +156,9 @@ class XPS:
                 XPS.__nbSockets -= 1
             except socket.error:
                 pass
+            XPS.__sockets.pop(socketId, None)
+            XPS.__locks.pop(socketId, None)
+            XPS.__buffers.pop(socketId, None)
 
     # GetLibraryVersion
     def GetLibraryVersion (self):
@@ -4197,3 +4252,48 @@ class XPS:
         return [error, returnedString]
 
 
+
+class XPSConnectionPool:
+    """ a number of sockets open to the same controller, each used by one thread at a time
+        
+            pool = XPSConnectionPool(xps, "xf16idc-mc-xps-rl4.nsls2.bnl.local", size=4)
+            err,ret = pool.call("GroupStatusGet", "scan")
+            with pool.socket() as sID:
+                rets = xps.sendAndReceiveMany(sID, commands)
+    """
+    def __init__(self, xps, IP, port=5001, timeOut=0.050, size=4):
+        self.xps = xps
+        self.free = queue.Queue()
+        self.socketIds = []
+        for i in range(size):
+            sID = xps.TCP_ConnectToServer(IP, port, timeOut)
+            if sID<0:
+                raise Exception(f"unable to connect to {IP}:{port}")
+            self.socketIds.append(sID)
+            self.free.put(sID)
+        
+    def socket(self):
+        return _PooledSocket(self)
+    
+    def call(self, func, *args):
+        """ func is the name of the XPS method, args are those following the socketId
+        """
+        with self.socket() as sID:
+            return getattr(self.xps, func)(sID, *args)
+    
+    def close(self):
+        for sID in self.socketIds:
+            self.xps.TCP_CloseSocket(sID)
+        self.socketIds = []
+
+
+class _PooledSocket:
+    def __init__(self, pool):
+        self.pool = pool
+    
+    def __enter__(self):
+        self.sID = self.pool.free.get()
+        return self.sID
+    
+    def __exit__(self, *args):
+        self.pool.free.put(self.sID)
@@ -0,0 +1,29 @@
+# the worker processes of pack_h5_shards() (40-hdf5.py)
+#
+# the workers are spawned rather than forked, the packing queue server that calls pack_h5_shards()
+# runs several threads (queue workers, asyncio, pyepics, pymongo), a forked child may inherit a lock
+# held by one of them (e.g. in HDF5 or pymongo) and deadlock
+# a spawned worker starts from scratch: init() loads hdf5_export() from the startup files and opens
+# its own connection to databroker
+#
+
+import os,time
+
+startup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+ns = {}
+
+def init(broker_name, variables):
+    """ variables: global names used by hdf5_export(), e.g. data_destination, set in the session
+    """
+    from databroker import Broker
+    for fn in ["02-utils.py", "39-original_suitcase.py"]:
+        fn = os.path.join(startup_dir, fn)
+        ns["__file__"] = fn
+        exec(compile(open(fn).read(), fn, "exec"), ns)
+    ns.update(variables)
+    ns["db"] = Broker.named(broker_name)
+
+def export_shard(uid, fn_shard, kwargs):
+    t0 = time.time()
+    ns["hdf5_export"](ns["db"][uid], fn_shard, use_uid=False, **kwargs)
+    return fn_shard,time.time()-t0
@@ -88,9 +88,32 @@ def test_flying(exp_time, dx=0.2, Nx=20, dy=0.1, Ny=10):
     ss.y.move(y0)
 
 
+# number of points in a raster allowed by the detectors
+raster_max_frames = {"xsp3": 12000}
+# segments of a large map are kept to this size or smaller
+map_segment_max_frames = 10000
+
+def map_segment_size(Nfast, Nslow, detectors, max_frames=map_segment_max_frames):
+    """ returns the number of lines in each segment, the segments are as even as possible
+        the number of frames in a segment is limited by max_frames, the detectors (raster_max_frames),
+        and the memory available to each packing worker
+    """
+    limit = min([max_frames]+[raster_max_frames[det.name] for det in detectors if det.name in raster_max_frames.keys()])
+    adm = pack_h5_admission
+    mem = pack_h5_mem_budget/packing_queue_nworkers-adm.base
+    limit = min(limit, int(mem/(len(detectors)*adm.event_overhead*adm.scale)))
+    nl = limit//Nfast
+    if nl<1:
+        raise Exception(f"a line of {Nfast} points is longer than the segment size limit ({limit}) ...")
+    Nseg = int(np.ceil(Nslow/nl))
+    return [len(a) for a in np.array_split(np.arange(Nslow), Nseg)]
+
 def collect_large_map(sname, x1, x2, y1, y2, step_size_x=0.1, step_size_y=0.1, 
-                exp_time=0.2, check_beam=True, use_XSP3=False, md=None):
-    """ split the large area into smaller ones, such that total number of frames in each scan is ~10k or fewer
+                exp_time=0.2, check_beam=True, use_XSP3=False, md=None, pack_remote=False):
+    """ split the large area into smaller ones, see map_segment_size() 
+        each segment is packed while the next one is collected, by the packing queue server if 
+        pack_remote is True; the packed segments are then merged into {sname}.h5
+        returns the MapPackingJob, job.result() waits for the merged file
     """
     
     if x1>x2:
@@ -116,38 +139,36 @@ def collect_large_map(sname, x1, x2, y1, y2, step_size_x=0.1, step_size_y=0.1,
     update_metadata()
     pil.use_sub_directory(sname)    
 
-    Nseg = int(Nx0*Ny0/10000)+1    
     if Nx0>Ny0:
         fast_axis = 'x'
-        dN = int(Ny0/Nseg)
+        seg_lines = map_segment_size(Nx0, Ny0, detectors)
     else:
         fast_axis = 'y'
-        dN = int(Nx0/Nseg)
+        seg_lines = map_segment_size(Ny0, Nx0, detectors)
+    Nseg = len(seg_lines)
         
-    for i in range(Nseg):
+    job = MapPackingJob(sname, "flyscan", pack_remote=pack_remote, 
+                        attrs={'shape': [Ny0, Nx0], 'fast_axis': fast_axis, 'segment_lines': seg_lines})
+    i0 = 0
+    for i,nl in enumerate(seg_lines):
         print(f"{sname}-{i:02d}:  ", end="")
         change_sample(f"{sname}-{i:02d}", exception=False)
 
         if fast_axis=='x':
             Nx = Nx0
-            if i==Nseg-1:
-                Ny = Ny0-i*dN
-            else:
-                Ny = dN
+            Ny = nl
             x1s = x1
             x2s = x2
-            y1s = y1+i*dN*step_size_y
+            y1s = y1+i0*step_size_y
             y2s = y1s+(Ny-1)*step_size_y    
         else:
-            if i==Nseg-1:
-                Nx = Nx0-i*dN
-            else:
-                Nx = dN
+            Nx = nl
             Ny = Ny0 
-            x1s = x1+i*dN*step_size_x
+            x1s = x1+i0*step_size_x
             x2s = x1s+(Nx-1)*step_size_x
             y1s = y1
             y2s = y2  
+        i0 += nl
             
         ss.x.move(x1s)
         ss.y.move(y1s)
@@ -177,7 +198,11 @@ def collect_large_map(sname, x1, x2, y1, y2, step_size_x=0.1, step_size_y=0.1,
                       detectors=detectors, md=_md))
             
         print('raster completed.')
-        send_to_packing_queue(db[-1].start['uid'], "flyscan")
+        # packed in the background while the next segment is collected
+        job.submit(db[-1].start['uid'])
+
+    job.finish()
+    return job
 
 
 def collect_map(sname, x1, x2, y1, y2, step_size_x=0.1, step_size_y=0.1, fast_axis="y",
@@ -313,36 +338,51 @@ def collect_projections0(sname, x1, x2, y1, y2, step_size_x=0.1, step_size_y=0.1
     
         
 def collect_tomo(sname, x1, x2, step_size=0.1, Nphi=120, Nseg=1, skip=0, dy=0.0,
-                        exp_time=0.2, check_beam=True, use_XSP3=False, md=None):
+                        exp_time=0.2, check_beam=True, use_XSP3=False, md=None, pack_remote=False):
+    """ if Nseg is None, use the smallest number of segments that Nphi is divisible by and 
+        that keeps the segments within the limits, see map_segment_size()
+        each segment is packed while the next one is collected, by the packing queue server if 
+        pack_remote is True; the packed segments are then merged into {sname}.h5
+        returns the MapPackingJob, job.result() waits for the merged file
+    """
     
     if not Nphi in [90, 100, 120]:
         print("dphi must be one of 90 (2.0deg), 100 (1.8deg), or 120 (1.5deg)")
         return
-    if int(Nphi/Nseg)*Nseg<Nphi:
-        print(f"Nphi={Nphi} is not divisible by Nseg={Nseg}")
-        return
-    
     if x1>x2:
         t=x1;x1=x2;x2=t
     
     dx = x2-x1
     Nx = int(dx/step_size+0.5)+1
     
+    if use_XSP3:
+        detectors = [xsp3,pil,em1ext,em2ext]
+    else:
+        detectors = [pil,em1ext,em2ext]
+    
+    if Nseg is None:
+        # the first segment has one more angle, at 90deg
+        nmax = max(map_segment_size(Nx, Nphi+1, detectors))
+        Nseg = next((n for n in range(1, Nphi+1) if Nphi%n==0 and Nphi/n+1<=nmax), None)
+        if Nseg is None:
+            raise Exception(f"cannot split {Nphi} angles into segments of {nmax} lines or fewer ...")
+        print(f"collecting in {Nseg} segment(s) ...")
+    if int(Nphi/Nseg)*Nseg<Nphi:
+        print(f"Nphi={Nphi} is not divisible by Nseg={Nseg}")
+        return
+    
     dphi = 180./Nphi
     phi_list = np.arange(-90, 90., dphi).reshape(-1, Nseg).T
     Nang = Nphi/Nseg
 
-    if Nx*Nang>12000: # limited by XSP3
+    if Nx*Nang>raster_max_frames['xsp3']: # limited by XSP3
         raise Exception(f"too many data points: {Nx*Nang}, increase the number of segments ...")
     
     _md = {"experiment": "scanning"}
     _md.update(md or {})
     
     if use_XSP3:
-        detectors = [xsp3,pil,em1ext,em2ext]
         makedirs(get_IOC_datapath(xsp3.name, xsp3.hdf.data_dir)+sname, mode=0O777)
-    else:
-        detectors = [pil,em1ext,em2ext]
 
     update_metadata()
     pil.use_sub_directory(sname)
@@ -350,6 +390,8 @@ def collect_tomo(sname, x1, x2, step_size=0.1, Nphi=120, Nseg=1, skip=0, dy=0.0,
     
     phi0 = -90
     dn = int(Nphi/Nseg)
+    job = MapPackingJob(sname, "flyscan", pack_remote=pack_remote, 
+                        attrs={'Nx': Nx, 'Nphi': Nphi, 'Nseg': Nseg, 'skip': skip})
     for i in range(Nseg):
         phi0 = phi_list[i][0]
         phi1 = phi_list[i][-1]
@@ -381,11 +423,14 @@ def collect_tomo(sname, x1, x2, step_size=0.1, Nphi=120, Nseg=1, skip=0, dy=0.0,
             RE(raster(exp_time, ss.x, x1, x2, Nx, ss.ry, phi0, phi1, n, 
                       detectors=detectors, md=_md))
             print('raster completed.')
-            send_to_packing_queue(db[-1].start['uid'], "flyscan")
+            # packed in the background while the next segment is collected
+            job.submit(db[-1].start['uid'])
         phi0 += (n+1)*dphi
         ss.y.move(ss.y.position+dy)
     
     pil.use_sub_directory()
+    job.finish()
+    return job
 
 def get_contour(img, roi=[0, -15, 220, 470], ax=None, rotate=True):
     img0 = np.copy(img[roi[0]:roi[1], roi[2]:roi[3]])
@@ -514,7 +514,10 @@ def CreateAgilentSeqFile(spreadsheet_fn, batchID, sheet_name='Samples'):
     return samples, valve_position  
 """
     
-def collect_hplc(sample_name, exp, nframes,md=None):
+def collect_hplc(sample_name, exp, nframes,md=None, live_pack=False):
+    """ live_pack: write {sample_name}_live.h5 in proc_path as the data are collected,
+            so that the data can be examined before the run is finished and packed
+    """
     TRP.set_flowrate(5) # to clear any bubbles
     TRP.start_pump()
     time.sleep(5)
@@ -538,7 +541,15 @@ def collect_hplc(sample_name, exp, nframes,md=None):
 
     #sol.ready_for_hplc.set(0)
     start_monitor([em1,em2], rate=4)
-    RE(monitor_during_wrapper(ct([pil], num=nframes, md=_md), [em1.ts.SumAll, em2.ts.SumAll]))
+    if live_pack:
+        pil.use_swmr(True)
+        packer = start_incremental_packing(f"{proc_path}/{sample_name}_live.h5")
+    try:
+        RE(monitor_during_wrapper(ct([pil], num=nframes, md=_md), [em1.ts.SumAll, em2.ts.SumAll]))
+    finally:
+        if live_pack:
+            packer.stop()
+            pil.use_swmr(False)
     sd.monitors = []
     pil.use_sub_directory()
     change_sample()
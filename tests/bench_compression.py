@@ -0,0 +1,73 @@
+# write/read throughput of the compression profiles and chunk layouts used by hdf5_export()
+#
+# run from the top of the profile directory, e.g.
+#     python tests/bench_compression.py 200
+#
+# the frames are Poisson-distributed counts, the size of the Pilatus 1M
+# the lz4 and zstd profiles are skipped if hdf5plugin is not installed
+
+import os,time,tempfile,argparse
+import numpy as np
+import h5py
+
+from profile_loader import load_suitcase
+
+frame_shape = (1043, 981)
+
+def make_frames(nframes, seed=0):
+    rng = np.random.default_rng(seed)
+    bkg = rng.gamma(2., 2., size=frame_shape)
+    return rng.poisson(bkg, size=(nframes, *frame_shape)).astype(np.int32)
+
+def bench(ns, frames, profile, access):
+    fn = tempfile.mktemp(suffix=".h5")
+    opts = ns['h5_compression_opts'](profile)
+    chunks = ns['plan_chunks'](frames.shape, frames.dtype, access)
+    mb = frames.nbytes/1024/1024
+
+    t0 = time.time()
+    with h5py.File(fn, "w") as f:
+        f.create_dataset("data", data=frames, chunks=chunks, **opts)
+    t_write = time.time()-t0
+    size = os.path.getsize(fn)/1024/1024
+
+    # frame-wise, as py4xs does when processing the data
+    t0 = time.time()
+    with h5py.File(fn, "r") as f:
+        dset = f["data"]
+        for i in range(dset.shape[0]):
+            img = dset[i]
+    t_frame = time.time()-t0
+
+    # time series of a 10x10 ROI
+    t0 = time.time()
+    with h5py.File(fn, "r") as f:
+        ts = f["data"][:, 500:510, 400:410].sum(axis=(1,2))
+    t_pixel = time.time()-t0
+    # all profiles are lossless
+    assert np.array_equal(ts, frames[:, 500:510, 400:410].sum(axis=(1,2))), f"{profile}: the data read back differ"
+
+    os.remove(fn)
+    return chunks, mb/size, mb/t_write, mb/t_frame, t_pixel
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("nframes", type=int, nargs="?", default=100)
+    args = parser.parse_args()
+
+    nframes = args.nframes
+    ns = load_suitcase()
+    frames = make_frames(nframes)
+    print(f"{nframes} frames, {frames.nbytes/1024/1024:.0f} MB")
+    print(f"{'profile':>8}{'access':>8}{'chunks':>20}{'ratio':>8}{'write MB/s':>12}{'read MB/s':>12}{'ROI ts (s)':>12}")
+    for profile in ns['compression_profiles']:
+        for access in ["frame", "pixel"]:
+            try:
+                chunks,ratio,w,r,tp = bench(ns, frames, profile, access)
+            except AssertionError:
+                raise
+            except Exception as e:
+                print(f"{profile:>8}{access:>8}  skipped: {e}")
+                break
+            print(f"{profile:>8}{access:>8}{str(chunks):>20}{ratio:>8.2f}{w:>12.1f}{r:>12.1f}{tp:>12.3f}")
@@ -0,0 +1,121 @@
+# reading back the TetrAMM time series in LiXTetrAMMext (20-bpm.py), against tests/sim_detector_iocs.py
+#
+#     python tests/bench_em_ts.py [--rep 5] [--avg 0.002] [--line-gap 0.05] [--ts-read 5]
+#
+# em1 on the simulated IOC, one trigger on the Zebra soft input per point, as in raster(), no triggers
+#     for --line-gap between lines
+# compared, for each case (points per line x lines per kickoff/complete):
+#     sum:       capture_mode="sum", the circular buffer, TSRead and a fixed 0.2 s sleep in complete(),
+#                SumAll only
+#     channels:  capture_mode="channels", TimeSeriesCapture, fixed length buffers read back when
+#                TSAcquiring goes to Done, the sum and current1-4 saved to file
+# the time series arrays hold at most 2048 points, longer lines span several buffers, the sum mode
+#     cannot be used then; the triggers that come in while a buffer is read back are lost, this is
+#     between lines unless a line is longer than the buffer
+# reported: mean time in complete() per kickoff/complete, points received vs expected,
+#     buffers per kickoff/complete, points paired with the wrong trigger (the simulated values encode
+#     the trigger number), whether the per-channel data were saved and add up to the sum
+# raises if any point is paired with the wrong trigger, or the saved data do not match
+
+import os,sys,time,argparse,subprocess
+import numpy as np
+import h5py
+
+os.environ["EPICS_CA_ADDR_LIST"] = "127.0.0.1"
+os.environ["EPICS_CA_AUTO_ADDR_LIST"] = "NO"
+from epics import caput
+from ophyd import EpicsSignal,EpicsSignalRO
+
+from profile_loader import tests_dir,load_startup
+from sim_detector_iocs import SimTetrAMM
+data_dir = "/tmp/sim_data"
+ns = {"time": time, "caput": caput, "EpicsSignalRO": EpicsSignalRO, "current_sample": "bench",
+      "get_IOC_datapath": lambda name, sub=None: f"{data_dir}/{name}/"}
+# the devices need the beamline
+load_startup("components/20-bpm.py", ns, stop={"components/20-bpm.py": "# Siddons electrometer"},
+             edit={"components/20-bpm.py": lambda src: src.replace("from nslsii.ad33 import QuadEMV33", "")})
+LiXTetrAMMext = ns["LiXTetrAMMext"]
+
+def start_ioc(ts_read):
+    proc = subprocess.Popen([sys.executable, os.path.join(tests_dir, "sim_detector_iocs.py"),
+                             "--interfaces", "127.0.0.1", "--ts-read", str(ts_read), "--data-dir", data_dir],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc
+
+def send_triggers(trigger, n, period):
+    for i in range(n):
+        t0 = time.time()
+        trigger.put(1, wait=True)
+        trigger.put(0, wait=True)
+        time.sleep(max(0, period-(time.time()-t0)))
+
+def run(em, mode, trigger, npts, nlines, rep, avg, line_gap):
+    em.capture_mode = mode
+    em.avg_time.put(avg)
+    em.npoints.put(npts)
+    em.nlines = nlines
+    em.rep = rep*nlines
+    em.stage()
+    ts = []
+    nbuf = []
+    misplaced = 0
+    try:
+        for i in range(rep):
+            em.kickoff()
+            for j in range(nlines):
+                send_triggers(trigger, npts, 2*avg+0.002)
+                time.sleep(line_gap)
+            t0 = time.time()
+            em.complete()
+            ts.append(time.time()-t0)
+            nbuf.append(em.capture.nbuffers if mode=="channels" else 1)
+            if mode=="channels":
+                # value n is (1+1e-5*n)*sum(channel_scale), n counted from Acquire=1
+                v = np.concatenate(em.read_back['data'][-nlines:])
+                n = np.round((v/SimTetrAMM.channel_scale.sum()-1)*1e5)
+                k = ~np.isnan(v)
+                misplaced += np.sum(n[k]!=(em.capture.base+np.arange(len(v)))[k])
+        desc = em.describe_collect()
+        ev, = em.collect()
+        docs = dict(em.collect_asset_docs())
+    finally:
+        em.unstage()
+    data = np.array(em.read_back['data'])
+    received = np.sum(~np.isnan(data.astype(float)))
+    saved = "-"
+    if mode=="channels":
+        res = docs['resource']
+        with h5py.File(os.path.join(res['root'], res['resource_path']), "r") as fh5:
+            d = fh5["/entry/data/data"][...]
+        assert list(d.shape)==desc[em.name][f'{em.name}_ts_data']['shape']
+        ok = np.nanmax(np.abs(d[:,0,:]-d[:,1:,:].sum(axis=1)))<1e-12 and np.allclose(d[:,0,:], data, equal_nan=True)
+        saved = "yes" if ok else "mismatch"
+    print(f"{f'{npts} x {nlines}':>14}{mode:>10}{np.mean(ts):>12.3f}{received:>10}/{npts*nlines*rep:<8}"
+          f"{np.mean(nbuf):>8.1f}{misplaced:>10}{saved:>10}")
+    assert misplaced==0, f"{misplaced} points paired with the wrong trigger"
+    assert saved in ["yes", "-"], "the saved data do not match the read-back"
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rep", type=int, default=5, help="kickoff/complete per case")
+    parser.add_argument("--avg", type=float, default=0.002, help="averaging time")
+    parser.add_argument("--line-gap", type=float, default=0.05, help="time between lines, e.g. the turnaround")
+    parser.add_argument("--ts-read", type=float, default=5, help="time for the IOC to read back the time series in ms")
+    args = parser.parse_args()
+
+    proc = start_ioc(args.ts_read)
+    try:
+        EpicsSignalRO("XF:16IDC-BI{BPM:1}TS:TSAcquiring", name="acquiring").wait_for_connection(timeout=10)
+        em = LiXTetrAMMext("XF:16IDC-BI{BPM:1}", name="em1")
+        trigger = EpicsSignal('XF:16IDC-ES{Zeb:1}:SOFT_IN:B0', name="trigger")
+        print(f"{'':>24}{'complete (s)':>12}{'points':>18}{'buffers':>8}{'misplaced':>10}{'saved':>10}")
+        for npts,nlines,rep in [(100, 1, args.rep), (300, 10, 2), (3000, 1, 2)]:
+            for mode in ["sum", "channels"]:
+                if mode=="sum" and npts*nlines>2048:    # stage() raises, more points than the buffer
+                    print(f"{f'{npts} x {nlines}':>14}{mode:>10}{'more points than the buffer':>36}")
+                    continue
+                run(em, mode, trigger, npts, nlines, rep, args.avg, args.line_gap)
+    finally:
+        proc.terminate()
+        proc.wait()
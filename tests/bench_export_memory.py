@@ -0,0 +1,99 @@
+# peak memory used by hdf5_export() vs the number of events in the scan
+#
+# run from the top of the profile directory, e.g.
+#     python tests/bench_export_memory.py 1000 10000 100000
+#
+# each export runs in a separate process so that ru_maxrss reflects that export only
+
+import os,time,uuid,resource,tempfile,queue,argparse
+import multiprocessing as mp
+import numpy as np
+
+from profile_loader import load_suitcase
+
+
+class FakeHeader:
+    """ enough of databroker.Header for hdf5_export(), without any detector resource
+        events are generated on the fly, so that the header itself uses no memory
+    """
+    def __init__(self, nevents, npts=20):
+        self.nevents = nevents
+        self.npts = npts
+        self.db = self
+        self.start = {'uid': str(uuid.uuid4()), 'scan_id': 1, 'plan_name': 'raster',
+                      'time': time.time(), 'sample_name': 'bench'}
+        data_keys = {'em1_ts_SumAll': {'dtype': 'array', 'shape': [npts], 'source': 'sim'},
+                     'em2_ts_SumAll': {'dtype': 'array', 'shape': [npts], 'source': 'sim'},
+                     'ss_x': {'dtype': 'number', 'shape': [], 'source': 'sim'},
+                     'ss_y': {'dtype': 'number', 'shape': [], 'source': 'sim'},
+                     'sample': {'dtype': 'string', 'shape': [], 'source': 'sim'}}
+        self.descriptors = [{'uid': str(uuid.uuid4()), 'name': 'primary', 'data_keys': data_keys}]
+
+    # hdf5_export() saves dict(header) as attributes
+    def keys(self):
+        return ['start', 'descriptors']
+
+    def __getitem__(self, k):
+        return getattr(self, k)
+
+    def documents(self):
+        yield ('start', self.start)
+        yield ('descriptor', self.descriptors[0])
+
+    def events(self, stream_name=None, fill=False):
+        t0 = time.time()
+        for i in range(self.nevents):
+            ts = t0+0.1*i
+            data = {'em1_ts_SumAll': list(np.random.random(self.npts)),
+                    'em2_ts_SumAll': list(np.random.random(self.npts)),
+                    'ss_x': 0.01*i, 'ss_y': 0.1, 'sample': 'bench'}
+            yield {'time': ts, 'seq_num': i+1, 'data': data,
+                   'timestamps': {k: ts for k in data.keys()}}
+
+
+def run_export(nevents, batch_size, q):
+    ns = load_suitcase()
+    hdr = FakeHeader(nevents)
+    fn = tempfile.mktemp(suffix=".h5")
+    t0 = time.time()
+    ns['hdf5_export']([hdr], fn, use_uid=False, batch_size=batch_size)
+    dt = time.time()-t0
+    os.remove(fn)
+    # ru_maxrss is in kB on linux
+    q.put((dt, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024))
+
+
+def measure(nevents, batch_size, timeout=3600):
+    """ raises if the export process dies, e.g. killed for running out of memory, or does not
+        finish within timeout
+    """
+    q = mp.Queue()
+    p = mp.Process(target=run_export, args=(nevents, batch_size, q))
+    p.start()
+    t0 = time.time()
+    while True:
+        try:
+            ret = q.get(timeout=1)
+            break
+        except queue.Empty:
+            # the result is in the queue before the process exits
+            if p.exitcode is not None and q.empty():
+                raise Exception(f"export of {nevents} events failed, exit code {p.exitcode}")
+            if time.time()-t0>timeout:
+                p.terminate()
+                raise Exception(f"export of {nevents} events not finished after {timeout} s")
+    p.join()
+    return ret
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("nevents", type=int, nargs="*", default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    nlist = args.nevents
+    print(f"{'events':>10}{'batch':>8}{'time (s)':>12}{'peak RSS (MB)':>16}")
+    for n in nlist:
+        for bs in [None, 1000]:
+            dt,rss = measure(n, bs)
+            print(f"{n:>10}{str(bs):>8}{dt:>12.2f}{rss:>16.1f}")
@@ -0,0 +1,88 @@
+# incremental packing (IncrementalH5Packer, 43-h5_incremental.py) of detector frames, with one or
+# more frames per event (frame_per_point in the resource)
+#
+#     python tests/bench_h5_incremental.py [--nevents 20] [--fpp 1 3]
+#
+# the detector file is written in SWMR-capable format, as by the IOC with pil.use_swmr(), so that
+# the frames are copied as the events arrive (flush_interval=0); the packed frames are compared
+# with the source, the run fails if any is missing or different
+# reported: frames per event, events, frames copied while the events arrived, frames in the
+# packed file, time (s)
+
+import os,time,uuid,tempfile,argparse
+import numpy as np
+import h5py
+
+from profile_loader import load_startup,load_suitcase
+
+def load_packer():
+    ns = load_suitcase()
+    ns.update({"pack_h5_compression": "gzip", "RE": None,
+               "replace_res_path_from_md": lambda md: {}})
+    return load_startup("43-h5_incremental.py", ns)["IncrementalH5Packer"]
+
+def write_source(fn, nframes, shape=(64, 48), seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.poisson(10, size=(nframes, *shape)).astype(np.int32)
+    with h5py.File(fn, "w", libver='latest') as f:
+        f.create_dataset("/entry/data/data", data=data, chunks=(1, *shape))
+    return data
+
+def docs(fn, nevents, fpp, shape):
+    t0 = time.time()
+    start = {'uid': str(uuid.uuid4()), 'time': t0, 'scan_id': 1, 'sample_name': 'bench'}
+    desc = {'uid': str(uuid.uuid4()), 'run_start': start['uid'], 'name': 'primary', 'time': t0,
+            'data_keys': {'pil1M_image': {'dtype': 'array', 'shape': [fpp, *shape], 'source': 'sim',
+                                          'external': 'FILESTORE:'},
+                          'ss_x': {'dtype': 'number', 'shape': [], 'source': 'sim'}}}
+    res = {'uid': str(uuid.uuid4()), 'run_start': start['uid'], 'spec': 'AD_HDF5',
+           'root': os.path.dirname(fn), 'resource_path': os.path.basename(fn),
+           'resource_kwargs': {'frame_per_point': fpp}}
+    yield "start",start
+    yield "descriptor",desc
+    yield "resource",res
+    for i in range(nevents):
+        yield "event",{'uid': str(uuid.uuid4()), 'descriptor': desc['uid'], 'seq_num': i+1, 'time': t0+i,
+                       'data': {'pil1M_image': f"{res['uid']}/{i}", 'ss_x': 0.1*i},
+                       'timestamps': {'pil1M_image': t0+i, 'ss_x': t0+i}}
+    yield "stop",{'uid': str(uuid.uuid4()), 'run_start': start['uid'], 'time': t0+nevents,
+                  'exit_status': 'success'}
+
+def run(IncrementalH5Packer, tmpdir, nevents, fpp):
+    shape = (64, 48)
+    src_fn = os.path.join(tmpdir, f"src_{fpp}.h5")
+    data = write_source(src_fn, nevents*fpp, shape)
+    fn = os.path.join(tmpdir, f"packed_{fpp}.h5")
+    t0 = time.time()
+    packer = IncrementalH5Packer(fn, flush_interval=0)
+    nlive = 0
+    for name,doc in docs(src_fn, nevents, fpp, shape):
+        if name=="stop":
+            # the frames copied by the time the last event has been written
+            t1 = time.time()
+            while sum(packer.nevents.values())<nevents and time.time()-t1<10:
+                time.sleep(0.01)
+            nlive = sum(packer.frames.values())
+        packer(name, doc)
+    packer.stop()
+    t = time.time()-t0
+    with h5py.File(fn, "r") as f:
+        packed = f["bench/primary/data/pil1M_image"][...]
+        nev = len(f["bench/primary/data/ss_x"])
+    print(f"{fpp:>6d} {nevents:>8d} {nlive:>8d} {len(packed):>8d} {t:>10.3f}")
+    assert nev==nevents, f"{nev} events packed, {nevents} expected"
+    assert packed.shape==data.shape, f"packed frames {packed.shape}, source {data.shape}"
+    assert np.array_equal(packed, data), "the packed frames differ from the source"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nevents", type=int, default=20)
+    parser.add_argument("--fpp", type=int, nargs="+", default=[1, 3])
+    args = parser.parse_args()
+
+    IncrementalH5Packer = load_packer()
+    print("   fpp   events     live   packed   time (s)")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for fpp in args.fpp:
+            run(IncrementalH5Packer, tmpdir, args.nevents, fpp)
@@ -0,0 +1,161 @@
+# staging the hdf plugin (LIXhdfPlugin, 05-data.py), against tests/sim_detector_iocs.py
+#
+#     python tests/bench_hdf_stage.py [--ncycles 10] [--file-open 20]
+#
+# a Pilatus-like detector (cam1: + LIXhdfPlugin) on the simulated SAXS detector, a fresh IOC for each method
+# compared:
+#     before:     warmup() with the sleeps, when run_time==0 at detector init; capture in stage_sigs,
+#                 i.e. set() polling the readback
+#     readiness:  FileWriterReadiness (02-utils.py), warm-up decided from the array size/data type
+#                 on the CA monitors, at init and on every stage; capture confirmed from the monitor
+# reported, for each step: time (s), warm-ups, frames written to the file
+#     init:          detector created, IOC just started
+#     re-init:       detector created again, the plugin has seen a frame but not written a file (run_time==0)
+#     stage x N:     stage, collect 2 frames, unstage; mean stage time
+#     dtype change:  the cam DataType changed to UInt32 before staging
+
+import os,sys,time,argparse,subprocess
+import numpy as np
+
+os.environ["EPICS_CA_ADDR_LIST"] = "127.0.0.1"
+os.environ["EPICS_CA_AUTO_ADDR_LIST"] = "NO"
+from ophyd import Component, ADComponent, EpicsSignal, EpicsSignalRO
+from ophyd.areadetector import DetectorBase
+from ophyd.areadetector.cam import PilatusDetectorCam
+
+from profile_loader import tests_dir,load_startup
+
+data_dir = "/tmp/sim_data"
+# the rest of 05-data.py needs the beamline environment
+ns = load_startup(["02-utils.py", "05-data.py"], start={"05-data.py": "# this used to be part of 20-pilatus"})
+ns["current_sample"] = "bench"
+ns["get_IOC_datapath"] = lambda name, sub=None: f"/nsls2/data/lix/sim/{name}/"
+LIXhdfPlugin = ns["LIXhdfPlugin"]
+
+class BeforeHDF(LIXhdfPlugin):
+    """ as LIXhdfPlugin used to stage
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stage_sigs.update([('capture', 1)])
+
+    def warmup(self, xsp=True):
+        cam = self.parent.cam
+        self.enable.set(1).wait()
+        sigs = {cam.array_callbacks: 1, cam.image_mode: "Single", cam.trigger_mode: "Internal",
+                cam.acquire_time: 0.1, cam.acquire_period: 0.105, cam.acquire: 1}
+        original_vals = {sig: sig.get() for sig in sigs}
+        for sig, val in sigs.items():
+            time.sleep(0.1)  # abundance of caution
+            sig.set(val).wait()
+        while cam.armed.get():
+            time.sleep(0.2)
+        for sig, val in reversed(list(original_vals.items())):
+            time.sleep(0.1)
+            sig.set(val).wait()
+
+    def stage(self):
+        filename, read_path, write_path = self.make_filename()
+        self.capture.set(0).wait()
+        self.file_path.set(write_path).wait()
+        self.file_name.set(filename).wait()
+        self.num_capture.set(self.parent._num_captures).wait()
+        super(ns["LiXFileStorePluginBase"], self).stage()
+        self._fn = self.file_template.get() % (read_path, filename, self.file_number.get() - 1)
+        self._generate_resource({'frame_per_point': self.get_frames_per_point()})
+
+    def unstage(self):
+        super(ns["LiXFileStorePluginBase"], self).unstage()
+
+def det_class(hdf_class):
+    class Det(DetectorBase):
+        _num_captures = 0
+        _num_images = 2
+        detector_id = "SAXS"
+        cam = ADComponent(PilatusDetectorCam, "cam1:")
+        hdf = Component(hdf_class, "HDF1:", write_path_template="", root="/")
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.warmups = 0
+            warmup = self.hdf.warmup
+            def counted_warmup(*args):
+                self.warmups += 1
+                warmup(*args)
+            self.hdf.warmup = counted_warmup
+            if hdf_class is BeforeHDF:
+                if self.hdf.run_time.get()==0: # first time using the plugin
+                    self.hdf.warmup()
+            else:
+                self.hdf.readiness.prepare(self.hdf.warmup)
+    return Det
+
+def start_ioc(file_open):
+    proc = subprocess.Popen([sys.executable, os.path.join(tests_dir, "sim_detector_iocs.py"),
+                             "--interfaces", "127.0.0.1", "--file-open", str(file_open), "--data-dir", data_dir],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc
+
+def collect(det):
+    cam = det.cam
+    for sig,v in [(cam.trigger_mode, "Internal"), (cam.image_mode, "Multiple"),
+                  (cam.num_images, det._num_images), (cam.acquire_time, 0.01)]:
+        sig.set(v).wait()
+    cam.acquire.put(1, wait=True)
+    while cam.acquire.get(use_monitor=False)==1:
+        time.sleep(0.01)
+
+def report(step, t, det, nframes):
+    print(f"{'before' if det.hdf.__class__ is BeforeHDF else 'readiness':>10}{step:>16}"
+          f"{t:>10.3f}{det.warmups:>10}{nframes:>10}")
+
+def run(hdf_class, ncycles, file_open):
+    proc = start_ioc(file_open)
+    try:
+        EpicsSignalRO("XF:16IDC-DT{Det:SAXS}HDF1:RunTime", name="run_time").wait_for_connection(timeout=10)
+        Det = det_class(hdf_class)
+        t0 = time.time()
+        det = Det("XF:16IDC-DT{Det:SAXS}", name="pil1M")
+        EpicsSignal("XF:16IDC-DT{Det:SAXS}HDF1:CreateDirectory", name="create_dir").put(-3)
+        report("init", time.time()-t0, det, 0)
+        t0 = time.time()
+        det = Det("XF:16IDC-DT{Det:SAXS}", name="pil1M")
+        report("re-init", time.time()-t0, det, 0)
+        ts = []
+        nframes = 0
+        for i in range(ncycles):
+            t0 = time.time()
+            det.hdf.stage()
+            ts.append(time.time()-t0)
+            collect(det)
+            nframes += det.hdf.num_captured.get(use_monitor=False)
+            det.hdf.unstage()
+        report(f"stage x {ncycles}", np.mean(ts), det, nframes)
+        assert nframes==ncycles*det._num_images, f"{nframes} frames written, {ncycles*det._num_images} expected"
+        det.cam.data_type.set("UInt32").wait()
+        t0 = time.time()
+        det.hdf.stage()
+        t = time.time()-t0
+        collect(det)
+        nframes = det.hdf.num_captured.get(use_monitor=False)
+        det.hdf.unstage()
+        report("dtype change", t, det, nframes)
+        # without warming up again, the plugin cannot open the file with the new data type
+        if hdf_class is not BeforeHDF:
+            assert nframes==det._num_images, f"{nframes} frames written after the dtype change, {det._num_images} expected"
+        if hdf_class is not BeforeHDF:
+            det.hdf.readiness.report()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ncycles", type=int, default=10)
+    parser.add_argument("--file-open", type=float, default=20, help="time for the IOC to open a file in ms")
+    args = parser.parse_args()
+
+    print(f"{'':>26}{'time (s)':>10}{'warm-ups':>10}{'frames':>10}")
+    for hdf_class in [BeforeHDF, LIXhdfPlugin]:
+        run(hdf_class, args.ncycles, args.file_open)
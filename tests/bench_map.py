@@ -0,0 +1,89 @@
+# MapAssembler (components/32-map.py) on a simulated serpentine raster
+#
+#     python tests/bench_map.py [--nfast 1000] [--nslow 1000] [--ripple 0.1]
+#
+# nfast x nslow frames (1M by default), with the readback positions at the start of each exposure,
+# as from the trajectory, and a velocity ripple of +/- ripple steps on the fast axis;
+# the values are a known image, the assembled map should reproduce it
+# compared:
+#     loop:       one frame at a time, the way the packed data used to be re-binned by hand,
+#                 timed for the first 20 lines and scaled to the whole map
+#     per line:   MapAssembler.add() once for every line, as in the live preview during raster()
+#     single:     MapAssembler.add() once for all frames
+
+import os,sys,time,argparse
+import numpy as np
+
+from profile_loader import load_startup
+
+MapAssembler = load_startup("components/32-map.py")['MapAssembler']
+
+def simulate(Nfast, Nslow, step, ripple):
+    """ returns fpos, spos (per line), line, values, and the expected image
+    """
+    img = np.add.outer(np.sin(np.arange(Nslow)/37), np.cos(np.arange(Nfast)/23))
+    fi = np.tile(np.arange(Nfast), Nslow)
+    line = np.repeat(np.arange(Nslow), Nfast)
+    direction = np.where(line%2, -1, 1)
+    fi[direction<0] = (Nfast-1-fi.reshape(Nslow, Nfast)[1::2]).flatten()
+    values = img[line, fi]
+    # position at the start of the exposure
+    fpos = (fi-direction*0.5+np.random.uniform(-ripple, ripple, len(fi)))*step
+    spos = np.arange(Nslow)*step
+    return fpos,spos,line,values,img
+
+def bin_loop(fpos, spos, line, values, Nfast, Nslow, step, nlines):
+    sm = np.zeros((Nslow, Nfast))
+    cnt = np.zeros((Nslow, Nfast))
+    for i in range(nlines*Nfast):
+        l = line[i]
+        d = 1 if fpos[l*Nfast+Nfast-1]>fpos[l*Nfast] else -1
+        fi = int(round((fpos[i]+d*step/2)/step))
+        si = int(round(spos[l]/step))
+        if 0<=fi<Nfast and 0<=si<Nslow:
+            sm[si,fi] += values[i]
+            cnt[si,fi] += 1
+    with np.errstate(invalid='ignore'):
+        return sm/cnt
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nfast", type=int, default=1000)
+    parser.add_argument("--nslow", type=int, default=1000)
+    parser.add_argument("--step", type=float, default=0.005)
+    parser.add_argument("--ripple", type=float, default=0.1, help="in steps")
+    args = parser.parse_args()
+    (Nf,Ns,step) = (args.nfast, args.nslow, args.step)
+    fpos,spos,line,values,img = simulate(Nf, Ns, step, args.ripple)
+    print(f"{Nf}x{Ns} = {len(fpos)} frames, velocity ripple +/-{args.ripple} steps")
+    print(f"{'':>10}{'time (s)':>12}{'frames/s':>14}{'max error':>12}")
+
+    nl = min(20, Ns)
+    t0 = time.perf_counter()
+    m = bin_loop(fpos, spos, line, values, Nf, Ns, step, nl)
+    t = (time.perf_counter()-t0)*Ns/nl
+    err = np.fabs(m[:nl]-img[:nl]).max()
+    print(f"{'loop':>10}{t:>12.2f}{len(fpos)/t:>14.0f}{err:>12.2g}   (scaled from {nl} lines)")
+
+    ma = MapAssembler(0, (Nf-1)*step, Nf, 0, (Ns-1)*step, Ns)
+    t0 = time.perf_counter()
+    for l in range(Ns):
+        sl = slice(l*Nf, (l+1)*Nf)
+        ma.add(fpos[sl], values[sl], spos, line[sl])
+    t = time.perf_counter()-t0
+    err = np.nanmax(np.fabs(ma.image()-img))
+    print(f"{'per line':>10}{t:>12.2f}{len(fpos)/t:>14.0f}{err:>12.2g}")
+    assert err<1e-9, f"the map assembled line by line differs from the image by {err}"
+
+    ma.clear()
+    t0 = time.perf_counter()
+    ma.add(fpos, values, spos, line)
+    t = time.perf_counter()-t0
+    err = np.nanmax(np.fabs(ma.image()-img))
+    nempty = np.isnan(ma.image()).sum()
+    print(f"{'single':>10}{t:>12.2f}{len(fpos)/t:>14.0f}{err:>12.2g}")
+    print(f"{'':>10}{ma.nframes} frames, {ma.nrejected} outside the map, {nempty} empty pixels")
+    assert err<1e-9, f"the map assembled at once differs from the image by {err}"
+    # the ripple is less than half a step, every frame belongs in the map
+    if args.ripple<0.5:
+        assert ma.nrejected==0 and nempty==0, f"{ma.nrejected} frames rejected, {nempty} empty pixels"
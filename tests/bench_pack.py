@@ -0,0 +1,167 @@
+# time, throughput and peak memory of hdf5_export() per stage, for raster, sol and HPLC data
+#
+# run from the top of the profile directory, e.g.
+#     python tests/bench_pack.py raster sol hplc --scale 0.5 --batch 1000
+#
+# the detector files are written into a temporary directory first (not timed)
+# stages:
+#     events:   iterating over the databroker events
+#     locate:   locate_h5_resource(), opening the detector files
+#     copy:     copying the detector data into the packed file
+#     attrs:    _safe_attrs_assignment(), saving the metadata as attributes
+#     other:    everything else, e.g. converting and writing the event data
+
+import os,sys,time,tempfile,shutil,threading,argparse
+
+from profile_loader import load_suitcase
+from synthetic_db import SyntheticDB
+
+def rss():
+    with open("/proc/self/statm") as fh:
+        return int(fh.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+
+
+class StageMonitor:
+    """ wraps functions in the suitcase namespace to attribute time and memory to stages
+        nested stages are not double counted, the time goes to the innermost stage
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.stack = ["other"]
+        self.time = {}
+        self.calls = {}
+        self.nbytes = {}
+        self.peak = {}
+        self.t_last = None
+
+    def switch(self, stage=None):
+        """ push stage, or pop if stage is None
+        """
+        t = time.time()
+        cur = self.stack[-1]
+        self.time[cur] = self.time.get(cur, 0) + t-self.t_last
+        self.t_last = t
+        self.sample()
+        if stage is None:
+            self.stack.pop()
+        else:
+            self.stack.append(stage)
+            self.calls[stage] = self.calls.get(stage, 0)+1
+
+    def sample(self):
+        cur = self.stack[-1]
+        self.peak[cur] = max(self.peak.get(cur, 0), rss()-self.rss0)
+
+    def sampler(self):
+        while not self.done.wait(self.interval):
+            self.sample()
+
+    def wrap(self, ns, fname, stage, count_bytes=None):
+        func = ns[fname]
+        def wrapped(*args, **kwargs):
+            self.switch(stage)
+            try:
+                ret = func(*args, **kwargs)
+                if count_bytes:
+                    self.nbytes[stage] = self.nbytes.get(stage, 0)+count_bytes(ret)
+                return ret
+            finally:
+                self.switch()
+        ns[fname] = wrapped
+
+    def wrap_events(self, header):
+        events = header.events
+        def wrapped(*args, **kwargs):
+            gen = events(*args, **kwargs)
+            while True:
+                self.switch("events")
+                try:
+                    ev = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    self.switch()
+                yield ev
+        header.events = wrapped
+
+    def __enter__(self):
+        self.rss0 = rss()
+        self.t_last = time.time()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sampler, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.done.set()
+        self.thread.join()
+        t = time.time()
+        self.time["other"] = self.time.get("other", 0) + t-self.t_last
+
+    def report(self):
+        print(f"    {'stage':>8}{'calls':>8}{'time (s)':>10}{'MB':>10}{'MB/s':>10}{'peak dRSS (MB)':>16}")
+        for stage in ["events", "locate", "copy", "attrs", "other"]:
+            t = self.time.get(stage, 0)
+            mb = self.nbytes.get(stage, 0)/1024**2
+            print(f"    {stage:>8}{self.calls.get(stage, 0):>8}{t:>10.2f}{mb:>10.1f}"
+                  f"{(mb/t if t>0 and mb>0 else 0):>10.1f}{self.peak.get(stage, 0)/1024**2:>16.1f}")
+
+
+def dataset_nbytes(ret):
+    dset = ret[0]
+    if dset is None:
+        return 0
+    return dset.size*dset.dtype.itemsize
+
+def bench(ns, headers, fn, **kwargs):
+    mon = StageMonitor()
+    for h in headers:
+        mon.wrap_events(h)
+    mon.wrap(ns, 'locate_h5_resource', "locate")
+    mon.wrap(ns, '_copy_h5_resource', "copy", count_bytes=dataset_nbytes)
+    mon.wrap(ns, '_safe_attrs_assignment', "attrs")
+    t0 = time.time()
+    with mon:
+        ns['hdf5_export'](headers, fn, use_uid=False, replace_res_path={'/__none__': '/__none__'}, **kwargs)
+    dt = time.time()-t0
+    size = os.path.getsize(fn)/1024**2
+    print(f"  total: {dt:.2f} s, {size:.1f} MB written, {size/dt:.1f} MB/s")
+    mon.report()
+    # undo the wrapping for the next run
+    for f in ['locate_h5_resource', '_copy_h5_resource', '_safe_attrs_assignment']:
+        ns[f] = ns['_orig_'+f]
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("plans", nargs="*", default=["raster", "sol", "hplc"])
+    parser.add_argument("--scale", type=float, default=0.25, help="scale factor for the frame size")
+    parser.add_argument("--batch", type=int, default=None, help="batch_size for hdf5_export()")
+    parser.add_argument("--compression", default="gzip")
+    parser.add_argument("--nx", type=int, default=50)
+    parser.add_argument("--ny", type=int, default=20)
+    parser.add_argument("--nframes", type=int, default=1000, help="number of HPLC frames")
+    args = parser.parse_args()
+
+    ns = load_suitcase()
+    for f in ['locate_h5_resource', '_copy_h5_resource', '_safe_attrs_assignment']:
+        ns['_orig_'+f] = ns[f]
+    data_dir = tempfile.mkdtemp()
+    db = SyntheticDB(data_dir, frame_scale=args.scale)
+    try:
+        for plan in args.plans:
+            t0 = time.time()
+            if plan=="raster":
+                headers = [db.raster(args.nx, args.ny, use_xsp3=True)]
+            elif plan=="sol":
+                headers = [db[u] for u in db.sol()]
+            elif plan=="hplc":
+                headers = [db.hplc(args.nframes)]
+            else:
+                raise Exception(f"unknown plan: {plan}")
+            print(f"{plan}: {len(headers)} header(s), detector files generated in {time.time()-t0:.1f} s")
+            fn = os.path.join(data_dir, f"{plan}.h5")
+            bench(ns, headers, fn, batch_size=args.batch, compression=args.compression)
+            os.remove(fn)
+    finally:
+        shutil.rmtree(data_dir)
@@ -0,0 +1,177 @@
+# trigger rate of the Pilatus detectors in LiXDetectors, against tests/sim_detector_iocs.py
+#
+#     python tests/bench_pil_trigger.py [--ntrig 100] [--exp 0.01] [--readout 3]
+#
+# the simulated IOC is started on localhost, for both Pilatus detectors and the Zebra soft input
+# triggers are issued one after another, each when the previous one is reported done
+# compared, for soft trigger (Acquire) and external trigger (ExtMTrigger, one frame per pulse):
+#     before:   soft: counting Acquire going back to 0 on the detectors in the monitor callback,
+#               as in LiXDetectors._acquire_changed()
+#               ext:  polling the trigger lock, then a threading.Timer for the exposure time
+#     engine:   TriggerEngine (02-utils.py), the Acquire/ArrayCounter monitors of every detector
+# reported: triggers/s, frames received per detector vs expected, mean/std of the time for each
+#     trigger; with the timer, triggers issued during the readout of the previous frame are lost
+
+import os,sys,time,argparse,subprocess,threading
+import numpy as np
+
+os.environ["EPICS_CA_ADDR_LIST"] = "127.0.0.1"
+os.environ["EPICS_CA_AUTO_ADDR_LIST"] = "NO"
+from ophyd import EpicsSignal,EpicsSignalRO
+from ophyd.status import DeviceStatus,Status
+
+from profile_loader import tests_dir,load_startup
+
+TriggerEngine = load_startup("02-utils.py")['TriggerEngine']
+
+def start_ioc(readout, arm):
+    proc = subprocess.Popen([sys.executable, os.path.join(tests_dir, "sim_detector_iocs.py"),
+                             "--interfaces", "127.0.0.1", "--readout", str(readout), "--arm", str(arm)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc
+
+class Det:
+    def __init__(self, name, prefix):
+        self.name = name
+        self.acquire = EpicsSignal(prefix+"Acquire", name=name+"_acquire")
+        self.counter = EpicsSignal(prefix+"ArrayCounter_RBV", write_pv=prefix+"ArrayCounter", name=name+"_counter")
+        self.armed = EpicsSignalRO(prefix+"Armed", name=name+"_armed")
+        self.trigger_mode = EpicsSignal(prefix+"TriggerMode", name=name+"_trigger_mode")
+        self.num_images = EpicsSignal(prefix+"NumImages", name=name+"_num_images")
+        self.acquire_time = EpicsSignal(prefix+"AcquireTime", name=name+"_acquire_time")
+        self.acquire_period = EpicsSignal(prefix+"AcquirePeriod", name=name+"_acquire_period")
+
+    def setup(self, mode, num_images, exp):
+        self.acquire.set(0).wait()
+        for sig,v in [(self.trigger_mode, mode), (self.num_images, num_images),
+                      (self.acquire_time, exp), (self.acquire_period, exp+0.002), (self.counter, 0)]:
+            sig.set(v).wait()
+
+class Before:
+    """ the way LiXDetectors used to complete the trigger status
+    """
+    def __init__(self, dets, trigger_signal, lock):
+        self.dets = dets
+        self.trigger_signal = trigger_signal
+        self.trigger_lock = lock
+        self._exp_completed = 0
+
+    def _acquire_changed(self, value=None, old_value=None, **kwargs):
+        if old_value==1 and value==0:
+            self._exp_completed += 1
+        if self._exp_completed==len(self.dets):
+            self._exp_completed = 0
+            self._status._finished()
+
+    def watch(self, soft):
+        if soft:
+            for det in self.dets:
+                det.acquire.subscribe(self._acquire_changed, run=False)
+
+    def clear(self):
+        for det in self.dets:
+            det.acquire.clear_sub(self._acquire_changed)
+
+    def trigger(self, soft, trig_wait):
+        self._status = DeviceStatus(self.dets[0].acquire)
+        if not soft:
+            while self.trigger_lock.locked():
+                time.sleep(0.002)
+            self.trigger_signal.put(1, wait=True)
+            self.trigger_signal.put(0, wait=True)
+        else:
+            for det in self.dets:
+                det.acquire.put(1, wait=False)
+        if not soft:
+            threading.Timer(trig_wait, self._status._finished, ()).start()
+        return self._status
+
+class Engine:
+    """ as in LiXDetectors.trigger()/watch_triggers()
+    """
+    def __init__(self, dets, trigger_signal, lock):
+        self.dets = dets
+        self.trigger_signal = trigger_signal
+        self.trigger_lock = lock
+        self.engine = TriggerEngine(name="bench_trigger")
+
+    def watch(self, soft):
+        for det in self.dets:
+            if soft:
+                self.engine.watch(det.name, det.acquire, falling_edge=True)
+            else:
+                self.engine.watch(det.name, det.counter)
+
+    def clear(self):
+        self.engine.clear()
+
+    def trigger(self, soft, trig_wait):
+        st = DeviceStatus(self.dets[0].acquire)
+        if not soft:
+            with self.trigger_lock:
+                pass
+            self.trigger_signal.put(1, wait=True)
+            self.trigger_signal.put(0, wait=True)
+        else:
+            for det in self.dets:
+                det.acquire.put(1, wait=False)
+        return self.engine.add(st, 1, timeout=trig_wait+5)
+
+def run(method, dets, soft, ntrig, exp):
+    for det in dets:
+        det.setup(0 if soft else 3, 1 if soft else ntrig, exp)
+    if not soft:
+        for det in dets:
+            det.acquire.put(1)
+        for det in dets:
+            while det.armed.get()!=1:
+                time.sleep(0.01)
+    method.watch(soft)
+    times = []
+    failed = 0
+    t_start = time.time()
+    for i in range(ntrig):
+        t0 = time.time()
+        try:
+            method.trigger(soft, exp+0.002).wait(10)
+        except Exception as e:
+            failed += 1
+        times.append(time.time()-t0)
+    t_total = time.time()-t_start
+    method.clear()
+    time.sleep(0.2)
+    nframes = [det.counter.get() for det in dets]
+    for det in dets:
+        det.acquire.set(0).wait()
+    times = np.asarray(times)
+    print(f"{'soft' if soft else 'ext':>6}{method.__class__.__name__.lower():>8}{ntrig/t_total:>12.1f}"
+          f"{str(nframes):>16}{times.mean()*1e3:>12.2f}{times.std()*1e3:>10.2f}{failed:>8}")
+    return nframes,failed
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ntrig", type=int, default=100)
+    parser.add_argument("--exp", type=float, default=0.01, help="exposure time")
+    parser.add_argument("--readout", type=float, default=3, help="readout latency per frame in ms")
+    parser.add_argument("--arm", type=float, default=50, help="time to arm in ms")
+    args = parser.parse_args()
+
+    proc = start_ioc(args.readout, args.arm)
+    try:
+        dets = [Det(n, f"XF:16IDC-DT{{Det:{d}}}cam1:") for n,d in [("pil1M", "SAXS"), ("pilW2", "WAXS2")]]
+        trigger_signal = EpicsSignal('XF:16IDC-ES{Zeb:1}:SOFT_IN:B0', name="trigger")
+        for det in dets:
+            det.acquire.wait_for_connection(timeout=10)
+        lock = threading.Lock()
+        print(f"{args.ntrig} triggers, {args.exp*1e3:.0f} ms exposure, {args.readout:.0f} ms readout")
+        print(f"{'':>14}{'triggers/s':>12}{'frames':>16}{'mean (ms)':>12}{'std (ms)':>10}{'failed':>8}")
+        for soft in [True, False]:
+            for cls in [Before, Engine]:
+                nframes,failed = run(cls(dets, trigger_signal, lock), dets, soft, args.ntrig, args.exp)
+                # triggers may be lost the way it used to be done, not with the engine
+                if cls is Engine:
+                    assert failed==0, f"{failed} triggers failed"
+                    assert nframes==[args.ntrig]*len(dets), f"{nframes} frames, {args.ntrig} triggers"
+    finally:
+        proc.terminate()
@@ -0,0 +1,121 @@
+# commands/s and latency of the XPS driver, against a fake XPS TCP server on localhost
+#
+#     python tests/bench_xps_driver.py [--ncmd 4000] [--delay 0.2]
+#
+# the fake server answers every command after a fixed delay, the way the controller would
+# answer status and position queries; the commands received on a connection are answered
+# in order, which is what makes pipelining possible
+#
+# compared:
+#     legacy:     the original recv(1024)/string concatenation, one lock for all sockets
+#     serial:     one socket, one thread
+#     shared:     one socket, 4 threads (per-socket lock)
+#     pool:       XPSConnectionPool with 4 sockets, 4 threads
+#     pipelined:  one socket, batches of 10 commands with sendAndReceiveMany(), the latency
+#                 is that of the batch
+
+import os,sys,time,socket,socketserver,threading,argparse
+import numpy as np
+
+from profile_loader import startup_dir
+sys.path.insert(0, os.path.join(startup_dir, "components"))
+from XPS_Q8_drivers3 import XPS,XPSConnectionPool
+
+class FakeXPSHandler(socketserver.BaseRequestHandler):
+    delay = 0.0002
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = b''
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            buf += data
+            while b')' in buf:
+                cmd,buf = buf.split(b')', 1)
+                time.sleep(self.delay)
+                if cmd.startswith(b'ErrorListGet'):
+                    ret = b'0,Error 0: Success;Error -1: Busy socket'
+                elif cmd.startswith(b'GroupPositionCurrentGet'):
+                    ret = b'0,' + b','.join([b'%.6f' % np.random.random() for i in range(cmd.count(b'double'))])
+                else:
+                    ret = b'0,' + b'12'*(cmd.count(b'*')+1)
+                self.request.sendall(ret+b',EndOfAPI')
+
+class FakeXPSServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def start_server(delay):
+    FakeXPSHandler.delay = delay
+    server = FakeXPSServer(('localhost', 0), FakeXPSHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server,server.server_address[1]
+
+
+class LegacyXPS:
+    """ the original __sendAndReceive(), for comparison
+    """
+    lock = threading.Lock()
+    def __init__(self, port):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(('localhost', port))
+    def GroupPositionCurrentGet(self, grp, n):
+        command = f"GroupPositionCurrentGet({grp},"+",".join(["double *"]*n)+")"
+        with self.lock:
+            self.sock.send(command.encode())
+            ret = ''
+            while (ret.find(',EndOfAPI') == -1):
+                ret += self.sock.recv(1024).decode()
+        return ret.strip(',EndOfAPI').split(',', 1)
+
+
+def run_threads(func, ncmd, nthreads):
+    lat = []
+    def worker():
+        for i in range(ncmd//nthreads):
+            t0 = time.perf_counter()
+            func()
+            lat.append(time.perf_counter()-t0)
+    ts = [threading.Thread(target=worker) for i in range(nthreads)]
+    t0 = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return len(lat)/(time.perf_counter()-t0), np.percentile(lat, 99)
+
+def report(name, rate, p99, per_cmd=1):
+    print(f"{name:>12}{rate*per_cmd:>14.0f}{p99*1e3:>14.3f}")
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ncmd", type=int, default=4000, help="number of commands")
+    parser.add_argument("--delay", type=float, default=0.2, help="server delay per command in ms")
+    args = parser.parse_args()
+
+    ncmd = args.ncmd
+    delay = args.delay*1e-3
+    server,port = start_server(delay)
+    print(f"{ncmd} commands, {delay*1e3:.2f} ms per command on the server")
+    print(f"{'':>12}{'commands/s':>14}{'p99 (ms)':>14}")
+
+    lx = LegacyXPS(port)
+    report("legacy", *run_threads(lambda: lx.GroupPositionCurrentGet("scan", 4), ncmd, 1))
+
+    xps = XPS()
+    sID = xps.TCP_ConnectToServer('localhost', port, 1)
+    report("serial", *run_threads(lambda: xps.GroupPositionCurrentGet(sID, "scan", 4), ncmd, 1))
+    report("shared", *run_threads(lambda: xps.GroupPositionCurrentGet(sID, "scan", 4), ncmd, 4))
+
+    pool = XPSConnectionPool(xps, 'localhost', port, timeOut=1, size=4)
+    report("pool", *run_threads(lambda: pool.call("GroupPositionCurrentGet", "scan", 4), ncmd, 4))
+
+    cmds = ["GroupPositionCurrentGet(scan,double *,double *,double *,double *)"]*10
+    rate,p99 = run_threads(lambda: xps.sendAndReceiveMany(sID, cmds), ncmd//10, 1)
+    report("pipelined", rate, p99, per_cmd=10)   # latency of the whole batch
+
+    pool.close()
+    xps.TCP_CloseSocket(sID)
+    server.shutdown()
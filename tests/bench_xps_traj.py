@@ -0,0 +1,176 @@
+# timing of XPStraj trajectories and raster-like line sequences, against tests/xps_emulator.py
+#
+#     python tests/bench_xps_traj.py [--nfast 21] [--nslow 5] [--exp 0.05] [--nrep 5]
+#
+# 25-XPS.py and 30-traj.py are loaded as in the IPython profile, without creating the
+# controller for the beamline; ophyd must be installed
+# reported:
+#     define:   define_traj(), i.e. generating, uploading and verifying the FW/BK trajectories,
+#               the same trajectory repeatedly, only the first is a cache miss
+#     move:     XPSmotor.move() of 1 mm, compared to the duration of the motion
+#     line:     kickoff()/complete() of one line in a raster, compared to the trajectory duration
+#               (run-up, N segments, run-down), the difference is the per-line overhead
+#               (dead time); its histogram is shown for waiting on the status returned by 
+#               complete(), and for polling it once a second, the way complete() used to 
+#     status:   nthreads threads reading XPSmotor.position/moving for 2 s, the number of reads
+#               per second and the number of commands the controller received per second
+#     raster:   the same raster, one line per trajectory (moving the slow axis between lines), and
+#               as a single serpentine trajectory (setup_raster_traj()); the efficiency is the 
+#               fraction of the time spent exposing
+# and the number of commands the emulator received in each case
+
+import os,sys,time,re,argparse,threading
+import numpy as np
+
+from xps_emulator import XPSEmulator
+from profile_loader import startup_dir,load_startup
+
+# for XPS_Q8_drivers3
+sys.path.insert(0, os.path.join(startup_dir, "components"))
+
+def load_xps(emu):
+    """ returns the namespace, with xps connected to the emulator
+    """
+    from ophyd import Signal
+    files = ["components/25-XPS.py", "components/30-traj.py"]
+    # without the beamline controller
+    ns = load_startup(files, {"Signal": Signal}, 
+                      edit={f: lambda src: re.sub(r'\nxps = XPSController\(.*\)', '', src) for f in files})
+    ns['xps'] = ns['XPSController']("localhost", "XPS-EMU", port=emu.port, ftp_port=emu.ftp_port)
+    return ns
+
+def ncmd(emu, n0):
+    return sum(emu.ncommands.values())-n0
+
+def wait_polling(st):
+    """ the way trajControl.complete() used to wait for the trajectory
+    """
+    while not st.done:
+        time.sleep(1)
+
+def histogram(dead_time, bins=np.arange(0, 1.3, 0.1)):
+    h,b = np.histogram(np.clip(dead_time, bins[0], bins[-1]-1e-6), bins)
+    for n,b0,b1 in zip(h, b[:-1], b[1:]):
+        print(f"{'':>8}{b0:>6.1f}-{b1:.1f} s {n:>4} {'#'*n}")
+
+def report(name, times, nominal, ncommands, n):
+    t = np.asarray(times)
+    print(f"{name:>8}{n:>6}{t.mean():>12.3f}{t.max():>12.3f}{nominal:>12.3f}"
+          f"{t.mean()-nominal:>14.3f}{ncommands/n:>12.1f}")
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nfast", type=int, default=21)
+    parser.add_argument("--nslow", type=int, default=5)
+    parser.add_argument("--exp", type=float, default=0.05, help="exposure time")
+    parser.add_argument("--step", type=float, default=0.01, help="step size on the fast axis")
+    parser.add_argument("--nrep", type=int, default=5, help="number of repeats for define/move")
+    parser.add_argument("--latency", type=float, default=0.5, help="emulator reply latency in ms")
+    parser.add_argument("--nlines", type=int, default=20, help="number of lines for the dead-time histogram")
+    args = parser.parse_args()
+
+    emu = XPSEmulator(latency=args.latency*1e-3).start()
+    ns = load_xps(emu)
+    xps = ns['xps']
+    ss_x = xps.def_motor("scan.X", "ss_x", direction=-1)
+    ss_y = xps.def_motor("scan.Y", "ss_y")
+    traj = ns['XPStraj'](xps, "scan")
+    dt = args.exp+0.005    # as in raster()
+    N = args.nfast-1
+
+    print(f"{'':>8}{'n':>6}{'mean (s)':>12}{'max (s)':>12}{'motion (s)':>12}{'overhead (s)':>14}{'commands':>12}")
+
+    times = []
+    n0 = ncmd(emu, 0)
+    for i in range(args.nrep):
+        t0 = time.time()
+        traj.define_traj(ss_x, N, args.step, dt)
+        times.append(time.time()-t0)
+    report("define", times, 0, ncmd(emu, n0), args.nrep)
+    print(f"{'':>8}trajectory cache: {traj.traj_cache_info()}")
+
+    times = []
+    n0 = ncmd(emu, 0)
+    vel,acc = [float(v) for v in xps.xps.PositionerSGammaParametersGet(xps.sID, "scan.Y")[1].split(',')[:2]]
+    p0 = ss_y.position
+    for i in range(args.nrep):
+        t0 = time.time()
+        ss_y.move(p0+(i+1)%2, wait=True)
+        times.append(time.time()-t0)
+    report("move", times, 1/vel+vel/acc, ncmd(emu, n0), args.nrep)
+
+    for nthreads in [1, 8]:
+        nreads = [0]*nthreads
+        def reader(i):
+            t0 = time.time()
+            while time.time()-t0<2:
+                pos,mv = ss_x.position,ss_y.moving
+                nreads[i] += 1
+        ths = [threading.Thread(target=reader, args=(i,)) for i in range(nthreads)]
+        n0 = ncmd(emu, 0)
+        for th in ths:
+            th.start()
+        for th in ths:
+            th.join()
+        print(f"  status{nthreads:>6}  {sum(nreads)/2:.0f} reads/s, {ncmd(emu, n0)/2:.0f} commands/s")
+
+    f0 = ss_x.position
+    y0 = ss_y.position
+    def run_lines(nlines, wait):
+        """ returns the duration of each line and of the whole raster
+        """
+        traj.setup_traj(ss_x, f0, f0+args.step*N, args.nfast, args.step, dt, ss_y, nlines)
+        traj.clear_readback()
+        traj.stage()
+        times = []
+        running_forward = traj.traj_par['run_forward_first']
+        t_start = time.time()
+        for sp in y0+np.linspace(0, 0.1, nlines):
+            ss_y.move(sp, wait=True)
+            t0 = time.time()
+            traj.select_forward_traj(running_forward)
+            traj.kickoff()
+            wait(traj.complete())
+            times.append(time.time()-t0)
+            running_forward = not running_forward
+        t_total = time.time()-t_start
+        traj.unstage()
+        return times,t_total
+    
+    n0 = ncmd(emu, 0)
+    times,t_total = run_lines(args.nslow, lambda st: st.wait())
+    raster_times = {"per line": (t_total, len(traj.read_back['fast_axis']))}
+    assert raster_times["per line"][1]==args.nslow*args.nfast, \
+        f"{raster_times['per line'][1]} positions read back, {args.nslow*args.nfast} expected"
+    Nr = traj.traj_par['no_of_rampup_points']
+    report("line", times, (N+2*Nr)*dt, ncmd(emu, n0), args.nslow)
+    
+    for name,wait in [("polling complete() every 1 s (before)", wait_polling), 
+                      ("waiting on the complete() status", lambda st: st.wait())]:
+        tl,tt = run_lines(args.nlines, wait)
+        dead_time = np.asarray(tl)-(N+2*Nr)*dt
+        print(f"{'':>8}per-line dead time, {name}: mean {dead_time.mean():.3f} s")
+        histogram(dead_time)
+
+    def report_raster(name, t_total, npts):
+        print(f"{name:>12}: {args.nslow}x{args.nfast} points in {t_total:.2f} s, {npts/t_total:.1f} points/s, "
+              f"{npts} positions read back, {args.nslow*args.nfast*dt/t_total*100:.0f}% of the time exposing")
+    print("raster")
+    report_raster("per line", *raster_times["per line"])
+    
+    ss_x.move(f0, wait=True)
+    ss_y.move(y0, wait=True)
+    traj.setup_raster_traj(ss_x, f0, f0+args.step*N, args.nfast, args.step, dt, 
+                           ss_y, y0, y0+0.1, args.nslow)
+    traj.clear_readback()
+    traj.stage()
+    t_start = time.time()
+    traj.kickoff()
+    traj.complete().wait()
+    t_total = time.time()-t_start
+    traj.unstage()
+    npts = len(traj.read_back['fast_axis'])
+    report_raster("serpentine", t_total, npts)
+    emu.stop()
+    assert npts==args.nslow*args.nfast, f"{npts} positions read back, {args.nslow*args.nfast} expected"
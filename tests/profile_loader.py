@@ -0,0 +1,39 @@
+# loading the startup files of the profile outside of IPython, for the benches in this directory
+#
+# in the IPython profile the startup files share one namespace, each relying on what the files
+# before it defined; load_startup() runs them in a namespace prepared by the bench instead,
+# optionally only a part of each file (the rest needs the beamline), with the line numbers kept
+
+import os
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+startup_dir = os.path.join(tests_dir, "../startup")
+
+def load_startup(files, ns=None, start=None, stop=None, edit=None):
+    """ exec the files (relative to startup/) one after another in ns, returns ns
+        start/stop: {file: marker}, only the source from start up to stop is run
+        edit: {file: function}, applied to the source, e.g. to leave out a beamline device
+    """
+    if isinstance(files, str):
+        files = [files]
+    if ns is None:
+        ns = {}
+    for f in files:
+        fn = os.path.join(startup_dir, f)
+        src = open(fn).read()
+        if stop and f in stop.keys():
+            src = src[:src.index(stop[f])]
+        if start and f in start.keys():
+            i = src.index(start[f])
+            src = "\n"*src[:i].count("\n")+src[i:]
+        if edit and f in edit.keys():
+            src = edit[f](src)
+        ns["__file__"] = fn
+        exec(compile(src, fn, "exec"), ns)
+    return ns
+
+def load_suitcase():
+    """ 39-original_suitcase.py, as used by pack_h5()
+    """
+    ns = {"os": os, "pilatus_data_dir": "/ramdisk", "data_destination": "/tmp", "makedirs": os.makedirs}
+    return load_startup("39-original_suitcase.py", ns)
@@ -0,0 +1,768 @@
+# simulated detector IOCs (caproto), for benchmarking the detector classes off the beamline
+#
+#     python tests/sim_detector_iocs.py [--readout 3] [--arm 50] [--file-open 20] [--ts-read 5]
+#                                       [--data-dir /tmp/sim_data] --list-pvs --interfaces 127.0.0.1
+#
+# the PV names are those used by the profile, so the clients must only look for them locally:
+#     EPICS_CA_ADDR_LIST=127.0.0.1 EPICS_CA_AUTO_ADDR_LIST=NO
+# latencies are in ms
+#
+# XF:16IDC-DT{Det:SAXS}, XF:16IDC-DT{Det:WAXS2}: Pilatus (LIXPilatus), cam1: and HDF1:
+#     TriggerMode Internal: Acquire=1 collects NumImages frames (1 in ImageMode Single)
+#     Ext. Trigger/Mult. Trigger: Acquire=1 arms the detector after the arm latency, each trigger on
+#         the Zebra soft input collects NumImages frames or one frame, until NumImages frames are
+#         collected; triggers are ignored while busy
+#     each frame takes AcquireTime, plus the readout latency before the counter is updated
+# XF:16IDC-ES{Xsp:1}: Xspress3 (LiXXspress), det1: and HDF1:, 4x4096 spectra
+#     TriggerMode Internal, or TTL Veto Only (one frame per trigger)
+# HDF1: the frames reach the plugin if both ArrayCallbacks and EnableCallbacks are on
+#     Capture=1 in Stream mode opens the file (after the file-open latency), but only once the plugin
+#     has seen a frame, as in areaDetector (hence LIXhdfPlugin.warmup()); frames with a different
+#     shape/data type than the file are dropped; the file is closed after NumCapture frames or on
+#     Capture=0; FileNumber is incremented when the file is opened; RunTime, as in NDFileHDF5, is the
+#     time since the file was opened, 0 until the first frame is written to a file
+#     the files go under --data-dir, i.e. /nsls2/... becomes /tmp/sim_data/nsls2/...; FilePath is
+#     created if CreateDirectory is not 0; with SWMRMode On the file is written in SWMR mode and the
+#     frames flushed every NumFramesFlush frames
+# XF:16IDC-BI{BPM:1}, XF:16IDC-BI{BPM:2}: TetrAMM (LiXTetrAMMext), with the TS: time series
+#     one value per AveragingTime in free run, one per trigger in Ext. trigger mode
+#     TS:TSAcquire=1 starts a fixed length or circular buffer of TSNumPoints, TSAcquiring is 1 until
+#     TSAcquire=0 or the fixed length buffer is full; TS:TSRead=1 posts the arrays after the ts-read
+#     latency, the circular buffer in time order; TSNumPoints is at most 2048, the size of the arrays
+#     allocated in the IOC; NumAcquired counts the values since Acquire was set to 1, the value n
+#     is (1+1e-5*n) times a fixed current for each channel, so that it can be matched to its trigger
+# XF:16IDC-BI{Cam:es1}: Prosilica (StandardProsilica), cam1:, image1:, ROI1-4: and Stats1-4:
+#     an image every AcquirePeriod while acquiring, with a bright spot in the middle if SIM:Sample=1
+# XF:16IDC-ES{Zeb:1}:SOFT_IN:B0: the trigger for all detectors in external trigger modes
+
+import os,asyncio,argparse,socket,time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import h5py
+# caproto holds each monitor update for up to 10 ms to batch it with the next ones
+os.environ.setdefault("CAPROTO_SERVER_HIGH_LOAD_TIMEOUT_SEC", "0.0005")
+from caproto import ChannelType
+from caproto.server import PVGroup, SubGroup, pvproperty, template_arg_parser, run
+import caproto.asyncio.server
+
+# the caproto TCP sockets are created with proto=0, asyncio then leaves Nagle on and every reply
+# that follows another write is held back ~40 ms by the delayed ACK of the client; an EPICS IOC
+# (rsrv) sets TCP_NODELAY, the accepted sockets inherit it from the listening socket
+_create_bound_tcp_socket = caproto.asyncio.server._create_bound_tcp_socket
+async def create_bound_tcp_socket(addr, port):
+    sock = await _create_bound_tcp_socket(addr, port)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+caproto.asyncio.server._create_bound_tcp_socket = create_bound_tcp_socket
+
+latency = {"readout": 0.003, "arm": 0.05, "file_open": 0.02, "ts_read": 0.005}
+data_dir = "/tmp/sim_data"
+
+data_types = ["Int8", "UInt8", "Int16", "UInt16", "Int32", "UInt32", "Int64", "UInt64", "Float32", "Float64"]
+
+def nd_data_type(dtype):
+    """ e.g. uint32 -> UInt32
+    """
+    return np.dtype(dtype).name.capitalize().replace("Ui", "UI")
+
+def char_pv(name, value="", read_only=False):
+    """ file paths/names can be longer than the 40 characters of a string PV
+    """
+    return pvproperty(value=value, name=name, dtype=ChannelType.CHAR, max_length=256,
+                      string_encoding="latin-1", read_only=read_only)
+
+def enum_pv(name, strs, value=0, read_only=False):
+    return pvproperty(value=strs[value], name=name, dtype=ChannelType.ENUM, enum_strings=strs,
+                      read_only=read_only)
+
+async def write_with_rbv(group, instance, value):
+    """ for the putters of the setting/_RBV pairs
+    """
+    await getattr(group, instance.pvspec.attr+"_rbv").write(value)
+    return value
+
+
+class SimHDF5Plugin(PVGroup):
+    """ HDF1:, writes /entry/data/data one frame at a time
+    """
+    hdf_enable = enum_pv("HDF1:EnableCallbacks", ["Disable", "Enable"])
+    hdf_enable_rbv = enum_pv("HDF1:EnableCallbacks_RBV", ["Disable", "Enable"], read_only=True)
+    hdf_port_name = pvproperty(value="FileHDF1", name="HDF1:PortName_RBV", dtype=ChannelType.STRING, read_only=True)
+    hdf_nd_array_port = pvproperty(value="DET1", name="HDF1:NDArrayPort", dtype=ChannelType.STRING)
+    hdf_nd_array_port_rbv = pvproperty(value="DET1", name="HDF1:NDArrayPort_RBV", dtype=ChannelType.STRING,
+                                       read_only=True)
+    hdf_blocking_callbacks = enum_pv("HDF1:BlockingCallbacks", ["No", "Yes"])
+    hdf_blocking_callbacks_rbv = enum_pv("HDF1:BlockingCallbacks_RBV", ["No", "Yes"], read_only=True)
+    hdf_file_path = char_pv("HDF1:FilePath")
+    hdf_file_path_rbv = char_pv("HDF1:FilePath_RBV", read_only=True)
+    hdf_file_path_exists = pvproperty(value=0, name="HDF1:FilePathExists_RBV", read_only=True)
+    hdf_create_directory = pvproperty(value=0, name="HDF1:CreateDirectory")
+    hdf_create_directory_rbv = pvproperty(value=0, name="HDF1:CreateDirectory_RBV", read_only=True)
+    hdf_file_name = char_pv("HDF1:FileName")
+    hdf_file_name_rbv = char_pv("HDF1:FileName_RBV", read_only=True)
+    hdf_file_template = char_pv("HDF1:FileTemplate", "%s%s_%6.6d.h5")
+    hdf_file_template_rbv = char_pv("HDF1:FileTemplate_RBV", "%s%s_%6.6d.h5", read_only=True)
+    hdf_file_number = pvproperty(value=0, name="HDF1:FileNumber")
+    hdf_file_number_rbv = pvproperty(value=0, name="HDF1:FileNumber_RBV", read_only=True)
+    hdf_full_file_name = char_pv("HDF1:FullFileName_RBV", read_only=True)
+    hdf_auto_increment = enum_pv("HDF1:AutoIncrement", ["No", "Yes"])
+    hdf_auto_increment_rbv = enum_pv("HDF1:AutoIncrement_RBV", ["No", "Yes"], read_only=True)
+    hdf_auto_save = enum_pv("HDF1:AutoSave", ["No", "Yes"])
+    hdf_auto_save_rbv = enum_pv("HDF1:AutoSave_RBV", ["No", "Yes"], read_only=True)
+    hdf_file_write_mode = enum_pv("HDF1:FileWriteMode", ["Single", "Capture", "Stream"])
+    hdf_file_write_mode_rbv = enum_pv("HDF1:FileWriteMode_RBV", ["Single", "Capture", "Stream"], read_only=True)
+    hdf_num_capture = pvproperty(value=0, name="HDF1:NumCapture")
+    hdf_num_capture_rbv = pvproperty(value=0, name="HDF1:NumCapture_RBV", read_only=True)
+    hdf_num_captured = pvproperty(value=0, name="HDF1:NumCaptured_RBV", read_only=True)
+    hdf_capture = pvproperty(value=0, name="HDF1:Capture")
+    hdf_capture_rbv = pvproperty(value=0, name="HDF1:Capture_RBV", read_only=True)
+    hdf_write_status = pvproperty(value=0, name="HDF1:WriteStatus", read_only=True)
+    hdf_write_message = char_pv("HDF1:WriteMessage", read_only=True)
+    hdf_array_counter = pvproperty(value=0, name="HDF1:ArrayCounter")
+    hdf_array_counter_rbv = pvproperty(value=0, name="HDF1:ArrayCounter_RBV", read_only=True)
+    hdf_array_size0 = pvproperty(value=0, name="HDF1:ArraySize0_RBV", read_only=True)
+    hdf_array_size1 = pvproperty(value=0, name="HDF1:ArraySize1_RBV", read_only=True)
+    hdf_array_size2 = pvproperty(value=0, name="HDF1:ArraySize2_RBV", read_only=True)
+    hdf_ndimensions = pvproperty(value=0, name="HDF1:NDimensions_RBV", read_only=True)
+    hdf_data_type = enum_pv("HDF1:DataType_RBV", data_types, read_only=True)
+    hdf_run_time = pvproperty(value=0., name="HDF1:RunTime", read_only=True)
+    hdf_swmr_mode = enum_pv("HDF1:SWMRMode", ["Off", "On"])
+    hdf_swmr_mode_rbv = enum_pv("HDF1:SWMRMode_RBV", ["Off", "On"], read_only=True)
+    hdf_num_frames_flush = pvproperty(value=0, name="HDF1:NumFramesFlush")
+    hdf_num_frames_flush_rbv = pvproperty(value=0, name="HDF1:NumFramesFlush_RBV", read_only=True)
+    hdf_plugin_type = pvproperty(value="NDFileHDF5", name="HDF1:PluginType_RBV", dtype=ChannelType.STRING,
+                                 read_only=True)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._h5 = None
+        self._h5_key = None
+        self._open_time = None
+        # h5py calls one after another, without blocking the IOC
+        self._writer = ThreadPoolExecutor(max_workers=1)
+
+    async def _in_writer(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, func, *args)
+
+    @hdf_file_path.putter
+    async def hdf_file_path(self, instance, value):
+        path = data_dir+value
+        if self.hdf_create_directory.value!=0:
+            os.makedirs(path, exist_ok=True)
+        await self.hdf_file_path_exists.write(int(os.path.isdir(path)))
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_capture.putter
+    async def hdf_capture(self, instance, value):
+        if value==1 and self._h5 is None:
+            if self.hdf_array_size0.value==0:
+                await self.hdf_write_status.write(1)
+                await self.hdf_write_message.write("ERROR, must collect an array to get dimensions first")
+                return 0
+            fn = self.hdf_file_template.value % (self.hdf_file_path.value, self.hdf_file_name.value,
+                                                 self.hdf_file_number.value)
+            await asyncio.sleep(latency["file_open"])
+            self._h5_key = self._array_key()
+            shape,dtype = self._h5_key
+            swmr = (self.hdf_swmr_mode.value=="On")
+            def create(fn):
+                h5 = h5py.File(fn, "w", libver=('latest' if swmr else 'earliest'))
+                h5.create_dataset("/entry/data/data", (0, *shape), dtype=dtype,
+                                  maxshape=(None, *shape), chunks=(1, *shape))
+                if swmr:
+                    h5.swmr_mode = True
+                return h5
+            try:
+                self._h5 = await self._in_writer(create, data_dir+fn)
+            except OSError as e:
+                await self.hdf_write_status.write(1)
+                await self.hdf_write_message.write(str(e)[:255])
+                raise
+            self._open_time = time.time()
+            await self.hdf_run_time.write(0)
+            if self.hdf_auto_increment.value=="Yes":
+                await self.hdf_file_number.write(self.hdf_file_number.value+1)
+                await self.hdf_file_number_rbv.write(self.hdf_file_number.value)
+            await self.hdf_full_file_name.write(fn)
+            await self.hdf_num_captured.write(0)
+            await self.hdf_write_status.write(0)
+            await self.hdf_write_message.write("")
+        elif value==0 and self._h5 is not None:
+            await self._close()
+        return await write_with_rbv(self, instance, value)
+
+    def _array_key(self):
+        shape = [s.value for s in [self.hdf_array_size2, self.hdf_array_size1, self.hdf_array_size0]]
+        return tuple(shape[3-self.hdf_ndimensions.value:]),np.dtype(self.hdf_data_type.value.lower())
+
+    async def _close(self):
+        h5 = self._h5
+        self._h5 = None
+        await self._in_writer(h5.close)
+        await self.hdf_capture.write(0)
+        await self.hdf_capture_rbv.write(0)
+
+    async def hdf_frame(self, frame):
+        """ called by the detector for every frame
+        """
+        if self.hdf_enable.value!="Enable":
+            return
+        shape = frame.shape[::-1]+(0,)*(3-frame.ndim)
+        for sig,v in zip([self.hdf_array_size0, self.hdf_array_size1, self.hdf_array_size2], shape):
+            if sig.value!=v:
+                await sig.write(v)
+        if self.hdf_ndimensions.value!=frame.ndim:
+            await self.hdf_ndimensions.write(frame.ndim)
+        dtype = nd_data_type(frame.dtype)
+        if self.hdf_data_type.value!=dtype:
+            await self.hdf_data_type.write(dtype)
+        await self.hdf_array_counter_rbv.write(self.hdf_array_counter_rbv.value+1)
+        if self._h5 is not None:
+            if self._h5_key!=(frame.shape, frame.dtype):
+                await self.hdf_write_status.write(1)
+                await self.hdf_write_message.write(f"frame dropped, {frame.shape} {frame.dtype}")
+            else:
+                n = self.hdf_num_captured.value+1
+                nflush = self.hdf_num_frames_flush.value
+                def append(h5, frame):
+                    dset = h5["/entry/data/data"]
+                    dset.resize(dset.shape[0]+1, axis=0)
+                    dset[-1] = frame
+                    if h5.swmr_mode and nflush>0 and n%nflush==0:
+                        dset.flush()
+                await self._in_writer(append, self._h5, frame)
+                await self.hdf_num_captured.write(n)
+                await self.hdf_run_time.write(time.time()-self._open_time)
+                if n==self.hdf_num_capture.value:
+                    await self._close()
+
+    # the setting/_RBV pairs
+    @hdf_enable.putter
+    async def hdf_enable(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_swmr_mode.putter
+    async def hdf_swmr_mode(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_num_frames_flush.putter
+    async def hdf_num_frames_flush(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_blocking_callbacks.putter
+    async def hdf_blocking_callbacks(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_create_directory.putter
+    async def hdf_create_directory(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_file_name.putter
+    async def hdf_file_name(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_file_template.putter
+    async def hdf_file_template(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_file_number.putter
+    async def hdf_file_number(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_auto_increment.putter
+    async def hdf_auto_increment(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_auto_save.putter
+    async def hdf_auto_save(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_file_write_mode.putter
+    async def hdf_file_write_mode(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_num_capture.putter
+    async def hdf_num_capture(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @hdf_array_counter.putter
+    async def hdf_array_counter(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+
+def detector_class(cam, trigger_modes, ext_all, ext_one, frame_shape, dtype):
+    """ cam: the prefix of the detector PVs, cam1: (Pilatus) or det1: (Xspress3)
+        trigger_modes: the enum strings of TriggerMode, the internal trigger is "Internal"
+        ext_all/ext_one: the external modes in which each trigger collects NumImages frames/one frame
+    """
+    class SimDetector(SimHDF5Plugin):
+        port_name = pvproperty(value="DET1", name=cam+"PortName_RBV", dtype=ChannelType.STRING, read_only=True)
+        acquire = pvproperty(value=0, name=cam+"Acquire")
+        acquire_rbv = pvproperty(value=0, name=cam+"Acquire_RBV", read_only=True)
+        armed = pvproperty(value=0, name=cam+"Armed", read_only=True)
+        detector_state = enum_pv(cam+"DetectorState_RBV", ["Idle", "Acquire"], read_only=True)
+        erase = pvproperty(value=0, name=cam+"ERASE")
+        array_counter = pvproperty(value=0, name=cam+"ArrayCounter")
+        array_counter_rbv = pvproperty(value=0, name=cam+"ArrayCounter_RBV", read_only=True)
+        array_callbacks = enum_pv(cam+"ArrayCallbacks", ["Disable", "Enable"], 1)
+        array_callbacks_rbv = enum_pv(cam+"ArrayCallbacks_RBV", ["Disable", "Enable"], 1, read_only=True)
+        image_mode = enum_pv(cam+"ImageMode", ["Single", "Multiple", "Continuous"], 1)
+        image_mode_rbv = enum_pv(cam+"ImageMode_RBV", ["Single", "Multiple", "Continuous"], 1, read_only=True)
+        num_images = pvproperty(value=1, name=cam+"NumImages")
+        num_images_rbv = pvproperty(value=1, name=cam+"NumImages_RBV", read_only=True)
+        trigger_mode = enum_pv(cam+"TriggerMode", trigger_modes)
+        trigger_mode_rbv = enum_pv(cam+"TriggerMode_RBV", trigger_modes, read_only=True)
+        acquire_time = pvproperty(value=1.0, name=cam+"AcquireTime")
+        acquire_time_rbv = pvproperty(value=1.0, name=cam+"AcquireTime_RBV", read_only=True)
+        acquire_period = pvproperty(value=1.0, name=cam+"AcquirePeriod")
+        acquire_period_rbv = pvproperty(value=1.0, name=cam+"AcquirePeriod_RBV", read_only=True)
+        data_type = enum_pv(cam+"DataType", data_types, data_types.index(nd_data_type(dtype)))
+        data_type_rbv = enum_pv(cam+"DataType_RBV", data_types, data_types.index(nd_data_type(dtype)),
+                                read_only=True)
+        array_size_x = pvproperty(value=frame_shape[-1], name=cam+"ArraySizeX_RBV", read_only=True)
+        array_size_y = pvproperty(value=frame_shape[-2], name=cam+"ArraySizeY_RBV", read_only=True)
+        array_size_z = pvproperty(value=0, name=cam+"ArraySizeZ_RBV", read_only=True)
+        color_mode = enum_pv(cam+"ColorMode_RBV", ["Mono"], read_only=True)
+        # the Pilatus cbf files, only kept as settings
+        file_path = char_pv(cam+"FilePath")
+        file_path_rbv = char_pv(cam+"FilePath_RBV", read_only=True)
+        file_name = char_pv(cam+"FileName")
+        file_name_rbv = char_pv(cam+"FileName_RBV", read_only=True)
+        file_number = pvproperty(value=0, name=cam+"FileNumber")
+        file_number_rbv = pvproperty(value=0, name=cam+"FileNumber_RBV", read_only=True)
+        full_file_name = char_pv(cam+"FullFileName_RBV", read_only=True)
+        header_string = char_pv(cam+"HeaderString")
+        threshold_energy = pvproperty(value=8., name=cam+"ThresholdEnergy")
+        threshold_apply = pvproperty(value=0, name=cam+"ThresholdApply")
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._task = None
+            self._triggers = asyncio.Queue()
+            self._frame_data = (np.arange(np.prod(frame_shape))%1000).astype(dtype).reshape(frame_shape)
+            self._frames = {}
+
+        @acquire.putter
+        async def acquire(self, instance, value):
+            if value==1 and self._task is None:
+                self._task = asyncio.get_running_loop().create_task(self._acquire())
+            elif value==0 and self._task is not None:
+                self._task.cancel()
+                self._task = None
+                await self.armed.write(0)
+                await self.detector_state.write("Idle")
+            await self.acquire_rbv.write(value)
+            return value
+
+        async def _frame(self):
+            await asyncio.sleep(self.acquire_time.value+latency["readout"])
+            await self.array_counter_rbv.write(self.array_counter_rbv.value+1)
+            if self.array_callbacks.value=="Enable":
+                dtype = self.data_type.value.lower()
+                if dtype not in self._frames:
+                    self._frames[dtype] = self._frame_data.astype(dtype)
+                await self.hdf_frame(self._frames[dtype])
+
+        async def _acquire(self):
+            mode = self.trigger_mode.value
+            n = self.num_images.value
+            await self.detector_state.write("Acquire")
+            if mode=="Internal":
+                await self.armed.write(1)
+                for i in range(1 if self.image_mode.value=="Single" else n):
+                    await self._frame()
+            else:
+                while not self._triggers.empty():
+                    self._triggers.get_nowait()
+                await asyncio.sleep(latency["arm"])
+                await self.armed.write(1)
+                i = 0
+                while i<n:
+                    await self._triggers.get()
+                    for j in range(n if mode in ext_all else 1):
+                        await self._frame()
+                        i += 1
+                    # triggers that arrived during the exposure/readout are missed
+                    while not self._triggers.empty():
+                        self._triggers.get_nowait()
+            await self.armed.write(0)
+            await self.detector_state.write("Idle")
+            self._task = None
+            await self.acquire.write(0)
+            await self.acquire_rbv.write(0)
+
+        def trigger_in(self):
+            if self.armed.value==1 and self.trigger_mode.value in ext_all+ext_one:
+                self._triggers.put_nowait(1)
+
+        @erase.putter
+        async def erase(self, instance, value):
+            await self.array_counter_rbv.write(0)
+            return 0
+
+        # the setting/_RBV pairs
+        @array_counter.putter
+        async def array_counter(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+        @array_callbacks.putter
+        async def array_callbacks(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+        @image_mode.putter
+        async def image_mode(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+        @num_images.putter
+        async def num_images(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+        @trigger_mode.putter
+        async def trigger_mode(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+        @acquire_time.putter
+        async def acquire_time(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+        @acquire_period.putter
+        async def acquire_period(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+        @data_type.putter
+        async def data_type(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+        @file_path.putter
+        async def file_path(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+        @file_name.putter
+        async def file_name(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+        @file_number.putter
+        async def file_number(self, instance, value):
+            return await write_with_rbv(self, instance, value)
+
+    return SimDetector
+
+pilatus_trigger_modes = ["Internal", "Ext. Enable", "Ext. Trigger", "Mult. Trigger", "Alignment"]
+SimPilatus1M = detector_class("cam1:", pilatus_trigger_modes, ["Ext. Trigger"], ["Mult. Trigger"],
+                              (1043, 981), "int32")
+SimPilatus900k = detector_class("cam1:", pilatus_trigger_modes, ["Ext. Trigger"], ["Mult. Trigger"],
+                                (619, 1475), "int32")
+SimXspress3 = detector_class("det1:", ["Software", "Internal", "IDC", "TTL Veto Only", "TTL Both",
+                                       "LVDS Veto Only", "LVDS Both"],
+                             [], ["TTL Veto Only", "TTL Both"], (4, 4096), "uint32")
+
+
+def plugin_class(plugin, plugin_type, port, nd_array_port):
+    """ the PVs of an areaDetector plugin that ophyd sets or checks on stage, a mixin like SimHDF5Plugin
+        e.g. image1: and the Current1-4:/SumAll: stats plugins of the QuadEM
+    """
+    attr = plugin.strip(":").lower()
+    pvs = {}
+    for name,strs in [("EnableCallbacks", ["Disable", "Enable"]), ("BlockingCallbacks", ["No", "Yes"])]:
+        k = f"{attr}_{name.lower()}"
+        pvs[k] = enum_pv(plugin+name, strs).putter(write_with_rbv)
+        pvs[k+"_rbv"] = enum_pv(plugin+name+"_RBV", strs, read_only=True)
+    pvs[f"{attr}_port_name"] = pvproperty(value=port, name=plugin+"PortName_RBV", dtype=ChannelType.STRING,
+                                          read_only=True)
+    pvs[f"{attr}_nd_array_port"] = pvproperty(value=nd_array_port, name=plugin+"NDArrayPort",
+                                              dtype=ChannelType.STRING).putter(write_with_rbv)
+    pvs[f"{attr}_nd_array_port_rbv"] = pvproperty(value=nd_array_port, name=plugin+"NDArrayPort_RBV",
+                                                  dtype=ChannelType.STRING, read_only=True)
+    pvs[f"{attr}_plugin_type"] = pvproperty(value=plugin_type, name=plugin+"PluginType_RBV",
+                                            dtype=ChannelType.STRING, read_only=True)
+    return type(f"Sim{attr.capitalize()}Plugin", (PVGroup,), pvs)
+
+
+class SimTetrAMM(plugin_class("image1:", "NDPluginStdArrays", "IMAGE1", "TetrAMM"),
+                 plugin_class("Current1:", "NDPluginStats", "STATS1", "TetrAMM"),
+                 plugin_class("Current2:", "NDPluginStats", "STATS2", "TetrAMM"),
+                 plugin_class("Current3:", "NDPluginStats", "STATS3", "TetrAMM"),
+                 plugin_class("Current4:", "NDPluginStats", "STATS4", "TetrAMM"),
+                 plugin_class("SumAll:", "NDPluginStats", "STATS5", "TetrAMM")):
+    """ the QuadEM PVs and the TS: time series, with the plugins staged by ophyd
+    """
+    acquire = pvproperty(value=0, name="Acquire")
+    acquire_mode = enum_pv("AcquireMode", ["Continuous", "Multiple", "Single"])
+    acquire_mode_rbv = enum_pv("AcquireMode_RBV", ["Continuous", "Multiple", "Single"], read_only=True)
+    num_acquired = pvproperty(value=0, name="NumAcquired", read_only=True)
+    trigger_mode = enum_pv("TriggerMode", ["Free run", "Ext. trigger", "Ext. bulb", "Ext. gate"])
+    averaging_time = pvproperty(value=0.1, name="AveragingTime")
+    averaging_time_rbv = pvproperty(value=0.1, name="AveragingTime_RBV", read_only=True)
+    integration_time = pvproperty(value=0.001, name="IntegrationTime")
+    integration_time_rbv = pvproperty(value=0.001, name="IntegrationTime_RBV", read_only=True)
+    values_per_read = pvproperty(value=10, name="ValuesPerRead")
+    values_per_read_rbv = pvproperty(value=10, name="ValuesPerRead_RBV", read_only=True)
+    num_averaged = pvproperty(value=100, name="NumAveraged_RBV", read_only=True)
+    em_range = enum_pv("Range", ["+- 120 uA", "+- 120 nA"])
+    em_range_rbv = enum_pv("Range_RBV", ["+- 120 uA", "+- 120 nA"], read_only=True)
+    sum_mean = pvproperty(value=0., name="SumAll:MeanValue_RBV", read_only=True)
+    current1_mean = pvproperty(value=0., name="Current1:MeanValue_RBV", read_only=True)
+    current2_mean = pvproperty(value=0., name="Current2:MeanValue_RBV", read_only=True)
+    current3_mean = pvproperty(value=0., name="Current3:MeanValue_RBV", read_only=True)
+    current4_mean = pvproperty(value=0., name="Current4:MeanValue_RBV", read_only=True)
+
+    ts_acquire = pvproperty(value=0, name="TS:TSAcquire")
+    ts_acquire_mode = enum_pv("TS:TSAcquireMode", ["Fixed length", "Circ. buffer"])
+    ts_acquiring = enum_pv("TS:TSAcquiring", ["Done", "Acquiring"], read_only=True)
+    ts_read = pvproperty(value=0, name="TS:TSRead")
+    ts_read_scan = enum_pv("TS:TSRead.SCAN", ["Passive", "Event", "I/O Intr", "10 second", "5 second",
+                                             "2 second", "1 second", ".5 second", ".2 second", ".1 second"])
+    ts_num_points = pvproperty(value=2048, name="TS:TSNumPoints")
+    ts_averaging_time = pvproperty(value=0.1, name="TS:TSAveragingTime")
+    ts_averaging_time_rbv = pvproperty(value=0.1, name="TS:TSAveragingTime_RBV", read_only=True)
+    ts_current_point = pvproperty(value=0, name="TS:TSCurrentPoint", read_only=True)
+    ts_time_axis = pvproperty(value=np.zeros(2048), name="TS:TSTimeAxis", dtype=float, max_length=100000, read_only=True)
+    ts_sum = pvproperty(value=np.zeros(2048), name="TS:SumAll:TimeSeries", dtype=float, max_length=100000, read_only=True)
+    ts_current1 = pvproperty(value=np.zeros(2048), name="TS:Current1:TimeSeries", dtype=float, max_length=100000, read_only=True)
+    ts_current2 = pvproperty(value=np.zeros(2048), name="TS:Current2:TimeSeries", dtype=float, max_length=100000, read_only=True)
+    ts_current3 = pvproperty(value=np.zeros(2048), name="TS:Current3:TimeSeries", dtype=float, max_length=100000, read_only=True)
+    ts_current4 = pvproperty(value=np.zeros(2048), name="TS:Current4:TimeSeries", dtype=float, max_length=100000, read_only=True)
+
+    channel_scale = np.array([1.0, 0.9, 1.1, 1.2])*1e-6
+    ts_max_points = 2048
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._task = None
+        self._triggers = asyncio.Queue()
+        self._buf = np.zeros((0, 4))
+        self._npts = 0      # points since TSAcquire=1
+
+    @acquire.putter
+    async def acquire(self, instance, value):
+        if value==1 and self._task is None:
+            await self.num_acquired.write(0)
+            self._task = asyncio.get_running_loop().create_task(self._acquire())
+        elif value==0 and self._task is not None:
+            self._task.cancel()
+            self._task = None
+        return value
+
+    async def _acquire(self):
+        while True:
+            if self.trigger_mode.value!="Free run":
+                await self._triggers.get()
+            await asyncio.sleep(self.averaging_time.value)
+            v = self.channel_scale*(1+1e-5*self.num_acquired.value)
+            await self.num_acquired.write(self.num_acquired.value+1)
+            for sig,x in zip([self.current1_mean, self.current2_mean, self.current3_mean, self.current4_mean], v):
+                await sig.write(x)
+            await self.sum_mean.write(v.sum())
+            if self.ts_acquiring.value=="Acquiring":
+                await self._ts_point(v)
+            if self.acquire_mode.value=="Single":
+                break
+        self._task = None
+        await self.acquire.write(0)
+
+    async def _ts_point(self, v):
+        N = len(self._buf)
+        i = self._npts%N
+        self._buf[i] = v
+        self._npts += 1
+        await self.ts_current_point.write(i+1)
+        if self._npts==N and self.ts_acquire_mode.value=="Fixed length":
+            await self.ts_acquiring.write("Done")
+            await self.ts_acquire.write(0)
+
+    def trigger_in(self):
+        if self._task is not None and self.trigger_mode.value!="Free run":
+            self._triggers.put_nowait(1)
+
+    @ts_acquire.putter
+    async def ts_acquire(self, instance, value):
+        if value==1:
+            self._buf = np.zeros((self.ts_num_points.value, 4))
+            self._npts = 0
+            await self.ts_current_point.write(0)
+            await self.ts_acquiring.write("Acquiring")
+        else:
+            await self.ts_acquiring.write("Done")
+        return value
+
+    @ts_num_points.putter
+    async def ts_num_points(self, instance, value):
+        return min(max(value, 1), self.ts_max_points)
+
+    @ts_read.putter
+    async def ts_read(self, instance, value):
+        await asyncio.sleep(latency["ts_read"])
+        N = len(self._buf)
+        if self._npts>N:    # wrapped, oldest first
+            i = self._npts%N
+            data = np.concatenate([self._buf[i:], self._buf[:i]])
+        else:
+            data = self._buf
+        for k,sig in enumerate([self.ts_current1, self.ts_current2, self.ts_current3, self.ts_current4]):
+            await sig.write(data[:, k])
+        await self.ts_time_axis.write(np.arange(N)*self.ts_averaging_time.value)
+        await self.ts_sum.write(data.sum(axis=1))
+        return 0
+
+    # the setting/_RBV pairs
+    @acquire_mode.putter
+    async def acquire_mode(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @averaging_time.putter
+    async def averaging_time(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @integration_time.putter
+    async def integration_time(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @values_per_read.putter
+    async def values_per_read(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @em_range.putter
+    async def em_range(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+    @ts_averaging_time.putter
+    async def ts_averaging_time(self, instance, value):
+        return await write_with_rbv(self, instance, value)
+
+
+class SimProsilica(PVGroup):
+    """ cam1:, image1:, ROI1-4: and Stats1-4: (total and centroid within the ROI of the same number)
+    """
+    size = (640, 480)
+    acquire = pvproperty(value=0, name="cam1:Acquire")
+    acquire_rbv = pvproperty(value=0, name="cam1:Acquire_RBV", read_only=True)
+    acquire_time = pvproperty(value=0.01, name="cam1:AcquireTime")
+    acquire_period = pvproperty(value=0.1, name="cam1:AcquirePeriod")
+    image_mode = enum_pv("cam1:ImageMode", ["Single", "Multiple", "Continuous"], 2)
+    array_counter_rbv = pvproperty(value=0, name="cam1:ArrayCounter_RBV", read_only=True)
+    size_x = pvproperty(value=size[0], name="cam1:SizeX_RBV", read_only=True)
+    size_y = pvproperty(value=size[1], name="cam1:SizeY_RBV", read_only=True)
+    image_enable = pvproperty(value=1, name="image1:EnableCallbacks")
+    image_data = pvproperty(value=np.zeros(size[0]*size[1], dtype=np.uint8), name="image1:ArrayData",
+                            dtype=ChannelType.CHAR, max_length=size[0]*size[1], read_only=True)
+    image_counter = pvproperty(value=0, name="image1:ArrayCounter_RBV", read_only=True)
+    image_size0 = pvproperty(value=size[0], name="image1:ArraySize0_RBV", read_only=True)
+    image_size1 = pvproperty(value=size[1], name="image1:ArraySize1_RBV", read_only=True)
+    image_size2 = pvproperty(value=0, name="image1:ArraySize2_RBV", read_only=True)
+    sample = pvproperty(value=0, name="SIM:Sample")
+    roi1_min_x = pvproperty(value=0, name="ROI1:MinX")
+    roi1_size_x = pvproperty(value=size[0], name="ROI1:SizeX")
+    roi1_min_y = pvproperty(value=0, name="ROI1:MinY")
+    roi1_size_y = pvproperty(value=size[1], name="ROI1:SizeY")
+    roi2_min_x = pvproperty(value=0, name="ROI2:MinX")
+    roi2_size_x = pvproperty(value=size[0], name="ROI2:SizeX")
+    roi2_min_y = pvproperty(value=0, name="ROI2:MinY")
+    roi2_size_y = pvproperty(value=size[1], name="ROI2:SizeY")
+    roi3_min_x = pvproperty(value=0, name="ROI3:MinX")
+    roi3_size_x = pvproperty(value=size[0], name="ROI3:SizeX")
+    roi3_min_y = pvproperty(value=0, name="ROI3:MinY")
+    roi3_size_y = pvproperty(value=size[1], name="ROI3:SizeY")
+    roi4_min_x = pvproperty(value=0, name="ROI4:MinX")
+    roi4_size_x = pvproperty(value=size[0], name="ROI4:SizeX")
+    roi4_min_y = pvproperty(value=0, name="ROI4:MinY")
+    roi4_size_y = pvproperty(value=size[1], name="ROI4:SizeY")
+    stats1_total = pvproperty(value=0., name="Stats1:Total_RBV", read_only=True)
+    stats1_centroid_x = pvproperty(value=0., name="Stats1:CentroidX_RBV", read_only=True)
+    stats1_centroid_y = pvproperty(value=0., name="Stats1:CentroidY_RBV", read_only=True)
+    stats2_total = pvproperty(value=0., name="Stats2:Total_RBV", read_only=True)
+    stats2_centroid_x = pvproperty(value=0., name="Stats2:CentroidX_RBV", read_only=True)
+    stats2_centroid_y = pvproperty(value=0., name="Stats2:CentroidY_RBV", read_only=True)
+    stats3_total = pvproperty(value=0., name="Stats3:Total_RBV", read_only=True)
+    stats3_centroid_x = pvproperty(value=0., name="Stats3:CentroidX_RBV", read_only=True)
+    stats3_centroid_y = pvproperty(value=0., name="Stats3:CentroidY_RBV", read_only=True)
+    stats4_total = pvproperty(value=0., name="Stats4:Total_RBV", read_only=True)
+    stats4_centroid_x = pvproperty(value=0., name="Stats4:CentroidX_RBV", read_only=True)
+    stats4_centroid_y = pvproperty(value=0., name="Stats4:CentroidY_RBV", read_only=True)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._task = None
+        self._rng = np.random.default_rng()
+
+    @acquire.putter
+    async def acquire(self, instance, value):
+        if value==1 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._acquire())
+        elif value==0 and self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.acquire_rbv.write(value)
+        return value
+
+    def _image(self):
+        (w,h) = self.size
+        img = self._rng.integers(0, 20, (h, w), dtype=np.uint8)
+        if self.sample.value:
+            img[h//2-40:h//2+40, w//2-60:w//2+60] += 200
+        return img
+
+    async def _acquire(self):
+        while True:
+            await asyncio.sleep(self.acquire_period.value)
+            img = self._image()
+            await self.array_counter_rbv.write(self.array_counter_rbv.value+1)
+            if self.image_enable.value:
+                await self.image_data.write(img.flatten())
+                await self.image_counter.write(self.image_counter.value+1)
+            for i in range(1, 5):
+                x0,sx,y0,sy = [getattr(self, f"roi{i}_{k}").value for k in ["min_x", "size_x", "min_y", "size_y"]]
+                roi = img[y0:y0+sy, x0:x0+sx].astype(float)
+                total = roi.sum()
+                await getattr(self, f"stats{i}_total").write(total)
+                if total>0:
+                    await getattr(self, f"stats{i}_centroid_x").write(roi.sum(axis=0)@np.arange(roi.shape[1])/total)
+                    await getattr(self, f"stats{i}_centroid_y").write(roi.sum(axis=1)@np.arange(roi.shape[0])/total)
+            if self.image_mode.value=="Single":
+                break
+        self._task = None
+        await self.acquire.write(0)
+        await self.acquire_rbv.write(0)
+
+
+class SimZebra(PVGroup):
+    soft_in_b0 = pvproperty(value=0, name="SOFT_IN:B0")
+
+    @soft_in_b0.putter
+    async def soft_in_b0(self, instance, value):
+        if value==1 and instance.value==0:
+            for det in self.parent.triggered_detectors():
+                det.trigger_in()
+        return value
+
+
+class SimDetectorIOC(PVGroup):
+    """ prefix XF:16IDC-
+    """
+    # only one level of sub-groups, the prefix is expanded again at every level
+    pil1M = SubGroup(SimPilatus1M, prefix="DT{{Det:SAXS}}")
+    pilW2 = SubGroup(SimPilatus900k, prefix="DT{{Det:WAXS2}}")
+    xsp3 = SubGroup(SimXspress3, prefix="ES{{Xsp:1}}:")
+    em1 = SubGroup(SimTetrAMM, prefix="BI{{BPM:1}}")
+    em2 = SubGroup(SimTetrAMM, prefix="BI{{BPM:2}}")
+    camES1 = SubGroup(SimProsilica, prefix="BI{{Cam:es1}}")
+    zebra = SubGroup(SimZebra, prefix="ES{{Zeb:1}}:")
+
+    def triggered_detectors(self):
+        return [self.pil1M, self.pilW2, self.xsp3, self.em1, self.em2]
+
+
+if __name__=="__main__":
+    parser,split_args = template_arg_parser(default_prefix="XF:16IDC-", desc="simulated LiX detectors",
+                                            supported_async_libs=("asyncio",))
+    parser.add_argument("--readout", type=float, default=3, help="readout latency per frame")
+    parser.add_argument("--arm", type=float, default=50, help="time to arm the Pilatus")
+    parser.add_argument("--file-open", type=float, default=20, help="time to open a hdf file")
+    parser.add_argument("--ts-read", type=float, default=5, help="time to post the TetrAMM time series")
+    parser.add_argument("--data-dir", default=data_dir, help="the root directory of the hdf files")
+    args = parser.parse_args()
+    latency.update({"readout": args.readout*1e-3, "arm": args.arm*1e-3,
+                    "file_open": args.file_open*1e-3, "ts_read": args.ts_read*1e-3})
+    data_dir = args.data_dir
+    ioc_options,run_options = split_args(args)
+    ioc = SimDetectorIOC(**ioc_options)
+    run(ioc.pvdb, **run_options)
@@ -0,0 +1,218 @@
+# a stand-in for the databroker and the detector IOCs, for benchmarking hdf5_export()/pack_h5()
+#
+# SyntheticDB creates headers that yield start/descriptor/resource/event/stop documents similar
+# to those of the raster, "sol" and HPLC plans, and writes the AD HDF5 files that the resources
+# point to, laid out as those written by the Pilatus and Xspress3 IOCs
+
+import os,time,uuid
+import numpy as np
+import h5py
+
+pilatus_shapes = {'pil1M': (1043, 981), 'pilW2': (1475, 619)}
+
+def write_pilatus_file(fn, nframes, shape, seed=0):
+    """ /entry/data/data, timestamps in NDAttributes, as in locate_h5_resource()
+    """
+    rng = np.random.default_rng(seed)
+    bkg = rng.gamma(2., 2., size=shape)
+    t0 = time.time()-631152000.3
+    with h5py.File(fn, "w") as f:
+        dset = f.create_dataset("/entry/data/data", shape=(nframes, *shape), dtype=np.int32,
+                                chunks=(1, *shape))
+        for i in range(nframes):
+            dset[i] = rng.poisson(bkg)
+        ts = t0+0.1*np.arange(nframes)
+        grp = f.create_group("/entry/instrument/NDAttributes")
+        grp.create_dataset("NDArrayEpicsTSSec", data=np.floor(ts))
+        grp.create_dataset("NDArrayEpicsTSnSec", data=(ts-np.floor(ts))*1e9)
+    return fn
+
+def write_xspress3_file(fn, nframes, nchan=1, nbins=4096, seed=0):
+    """ /entry/instrument/detector/data, /entry/instrument/performance/timestamp
+    """
+    rng = np.random.default_rng(seed)
+    spec = np.exp(-((np.arange(nbins)-800)/50.)**2)*100+1
+    with h5py.File(fn, "w") as f:
+        f.create_dataset("/entry/instrument/detector/data",
+                         data=rng.poisson(spec, size=(nframes, nchan, nbins)).astype(np.uint32),
+                         chunks=(1, nchan, nbins))
+        f.create_dataset("/entry/instrument/performance/timestamp",
+                         data=(time.time()+0.1*np.arange(nframes)).reshape(-1, 1))
+    return fn
+
+
+class SyntheticHeader:
+    """ enough of databroker.Header for hdf5_export()
+    """
+    def __init__(self, db, start, streams, resources):
+        """ streams: {name: (data_keys, event generator function)}
+        """
+        self.db = db
+        self.start = start
+        self.resources = resources
+        self.streams = streams
+        self.descriptors = []
+        for name,(data_keys,gen) in streams.items():
+            self.descriptors.append({'uid': str(uuid.uuid4()), 'name': name, 'run_start': start['uid'],
+                                     'data_keys': data_keys, 'time': start['time']})
+        self.stop = {'uid': str(uuid.uuid4()), 'run_start': start['uid'], 'exit_status': 'success',
+                     'time': start['time']+100,
+                     'num_events': {name: gen(count_only=True) for name,(dk,gen) in streams.items()}}
+
+    # hdf5_export() saves dict(header) as attributes
+    def keys(self):
+        return ['start', 'descriptors', 'stop']
+
+    def __getitem__(self, k):
+        return getattr(self, k)
+
+    def fields(self):
+        return set([k for d in self.descriptors for k in d['data_keys'].keys()])
+
+    def documents(self):
+        yield ('start', self.start)
+        for res in self.resources:
+            yield ('resource', res)
+        for desc in self.descriptors:
+            yield ('descriptor', desc)
+        yield ('stop', self.stop)
+
+    def events(self, stream_name=None, fill=False):
+        for desc in self.descriptors:
+            if stream_name is not None and desc['name']!=stream_name:
+                continue
+            for i,(ts,data) in enumerate(self.streams[desc['name']][1]()):
+                yield {'descriptor': desc['uid'], 'time': ts, 'seq_num': i+1, 'data': data,
+                       'timestamps': {k: ts for k in data.keys()}}
+
+
+class SyntheticDB:
+    """ headers are kept by uid, db[uid] as with databroker
+        the detector files are written into data_dir
+    """
+    def __init__(self, data_dir, frame_scale=1.):
+        self.data_dir = data_dir
+        self.frame_scale = frame_scale
+        self.headers = {}
+        self.scan_id = 0
+
+    def __getitem__(self, uid):
+        return self.headers[uid]
+
+    def new_start(self, plan_name, **md):
+        self.scan_id += 1
+        start = {'uid': str(uuid.uuid4()), 'scan_id': self.scan_id, 'plan_name': plan_name,
+                 'time': time.time(), 'data_path': self.data_dir}
+        start.update(md)
+        return start
+
+    def pilatus_resource(self, start, det, nframes):
+        shape = tuple([int(d*self.frame_scale) for d in pilatus_shapes[det]])
+        fn = f"{det}_{start['uid'][:8]}.h5"
+        write_pilatus_file(os.path.join(self.data_dir, fn), nframes, shape, seed=start['scan_id'])
+        res = {'uid': str(uuid.uuid4()), 'spec': 'AD_HDF5', 'root': self.data_dir, 'resource_path': fn,
+               'resource_kwargs': {'frame_per_point': 1}, 'run_start': start['uid']}
+        dk = {'dtype': 'array', 'shape': [*shape, 0], 'source': f'PV:{det}', 'external': 'FILESTORE:'}
+        return res,dk
+
+    def xspress3_resource(self, start, nframes):
+        fn = f"xsp3_{start['uid'][:8]}.h5"
+        write_xspress3_file(os.path.join(self.data_dir, fn), nframes, seed=start['scan_id'])
+        res = {'uid': str(uuid.uuid4()), 'spec': 'AD_HDF5', 'root': self.data_dir, 'resource_path': fn,
+               'resource_kwargs': {'frame_per_point': 1}, 'run_start': start['uid']}
+        dk = {'dtype': 'array', 'shape': [1, 4096], 'source': 'PV:xsp3', 'external': 'FILESTORE:'}
+        return res,dk
+
+    def add(self, start, streams, resources):
+        h = SyntheticHeader(self, start, streams, resources)
+        self.headers[start['uid']] = h
+        return h
+
+    def raster(self, nx=50, ny=20, npts=20, use_xsp3=False):
+        """ fly scan: one event per point, Pilatus frames, TetrAMM time series, motor positions
+        """
+        n = nx*ny
+        start = self.new_start("raster", sample_name=f"raster{self.scan_id+1}",
+                               motors=['ss_x', 'ss_y'], shape=[ny, nx])
+        res,dk_pil = self.pilatus_resource(start, 'pil1M', n)
+        resources = [res]
+        data_keys = {'pil1M_image': dk_pil,
+                     'em1_ts_SumAll': {'dtype': 'array', 'shape': [npts], 'source': 'PV:em1'},
+                     'em2_ts_SumAll': {'dtype': 'array', 'shape': [npts], 'source': 'PV:em2'},
+                     'ss_x': {'dtype': 'number', 'shape': [], 'source': 'PV:ss_x'},
+                     'ss_y': {'dtype': 'number', 'shape': [], 'source': 'PV:ss_y'}}
+        if use_xsp3:
+            res_x,dk_x = self.xspress3_resource(start, n)
+            resources.append(res_x)
+            data_keys['xsp3_image'] = dk_x
+        t0 = start['time']
+
+        def gen(count_only=False):
+            if count_only:
+                return n
+            return self._raster_events(t0, nx, ny, npts, res['uid'], resources[-1]['uid'] if use_xsp3 else None)
+
+        return self.add(start, {'primary': (data_keys, gen)}, resources)
+
+    def _raster_events(self, t0, nx, ny, npts, res_uid, xsp3_uid=None):
+        rng = np.random.default_rng(0)
+        for i in range(nx*ny):
+            data = {'pil1M_image': f"{res_uid}/{i}",
+                    'em1_ts_SumAll': list(rng.random(npts)), 'em2_ts_SumAll': list(rng.random(npts)),
+                    'ss_x': 0.01*(i%nx), 'ss_y': 0.01*(i//nx)}
+            if xsp3_uid:
+                data['xsp3_image'] = f"{xsp3_uid}/{i}"
+            yield t0+0.01*i, data
+
+    def sol(self, nsamples=18, nframes=5):
+        """ solution scattering holder: one header per sample, a few frames each, several detectors
+        """
+        uids = []
+        for i in range(nsamples):
+            start = self.new_start("ct", sample_name=f"sample{i:02d}", holderName="holder",
+                                   buffer=f"buffer{i%2:02d}")
+            resources = []
+            data_keys = {}
+            for det in pilatus_shapes.keys():
+                res,dk = self.pilatus_resource(start, det, nframes)
+                resources.append(res)
+                data_keys[f"{det}_image"] = dk
+            data_keys.update({'em1_sum_all_mean_value': {'dtype': 'number', 'shape': [], 'source': 'PV:em1'},
+                              'em2_sum_all_mean_value': {'dtype': 'number', 'shape': [], 'source': 'PV:em2'},
+                              'sample': {'dtype': 'string', 'shape': [], 'source': 'PV:sample'}})
+            t0 = start['time']
+            res_uids = [r['uid'] for r in resources]
+
+            def gen(count_only=False, t0=t0, res_uids=res_uids, i=i):
+                if count_only:
+                    return nframes
+                return ((t0+j, {**{f"{det}_image": f"{ru}/{j}" for det,ru in zip(pilatus_shapes.keys(), res_uids)},
+                                'em1_sum_all_mean_value': 1.+j, 'em2_sum_all_mean_value': 0.5+j,
+                                'sample': f"sample{i:02d}"}) for j in range(nframes))
+
+            uids.append(self.add(start, {'primary': (data_keys, gen)}, resources).start['uid'])
+        return uids
+
+    def hplc(self, nframes=2000, npts=40):
+        """ long series of frames, with the beam intensity monitors in their own streams
+        """
+        start = self.new_start("ct", sample_name=f"hplc{self.scan_id+1}", experiment="HPLC")
+        res,dk = self.pilatus_resource(start, 'pil1M', nframes)
+        t0 = start['time']
+
+        def gen_primary(count_only=False):
+            if count_only:
+                return nframes
+            return ((t0+i, {'pil1M_image': f"{res['uid']}/{i}"}) for i in range(nframes))
+
+        def gen_monitor(count_only=False):
+            n = nframes*4
+            if count_only:
+                return n
+            rng = np.random.default_rng(1)
+            return ((t0+0.25*i, {'em1_ts_SumAll': list(rng.random(npts))}) for i in range(n))
+
+        streams = {'primary': ({'pil1M_image': dk}, gen_primary),
+                   'em1_ts_SumAll_monitor': ({'em1_ts_SumAll': {'dtype': 'array', 'shape': [npts],
+                                                                'source': 'PV:em1'}}, gen_monitor)}
+        return self.add(start, streams, [res])
@@ -0,0 +1,744 @@
+# an emulator of the Newport XPS-Q8 controller, for testing XPSController/XPSmotor/XPStraj
+# and measuring the timing of trajectories and rasters away from the beamline
+#
+#     python tests/xps_emulator.py [--port 5001] [--ftp-port 2121]
+#
+# or in the same process:
+#     emu = XPSEmulator()
+#     emu.start()      # emu.port and emu.ftp_port are the ports actually used
+#     ...
+#     emu.stop()
+#
+# speaks the ASCII API used by XPS_Q8_drivers3.py, "Name(arg1,arg2,...)" answered by
+# "err,ret1,ret2,...,EndOfAPI", for the functions used in 25-XPS.py and 30-traj.py:
+#     ObjectsListGet, ErrorListGet, GroupStatusGet, GroupMotionStatusGet, GroupPositionCurrentGet
+#     GroupMoveAbsolute/Relative/Abort, GroupMotionEnable/Disable, GroupKill/Initialize/HomeSearch
+#     PositionerSGammaParametersGet/Set, PositionerMaximumVelocityAndAccelerationGet
+#     MultipleAxesPVTVerification/VerificationResultGet/PulseOutputSet/Execution
+#     GatheringReset/ConfigurationSet/CurrentNumberGet/DataMultipleLinesGet/StopAndSave
+#     EventExtendedConfigurationTriggerSet/ActionSet, EventExtendedStart/AllGet/Remove
+#
+# as on the controller, motions are blocking: GroupMoveAbsolute() and MultipleAxesPVTExecution()
+# are answered once the motion is complete, or aborted by GroupMoveAbort() from another socket
+#
+# kinematic model: moves follow a trapezoidal velocity profile given by the SGamma velocity and
+# acceleration (the jerk time is ignored); PVT trajectories are cubic in each element, with the
+# displacement and velocities given in the trajectory file. Positions are calculated from the
+# time elapsed since the start of the motion, there is no following error.
+# the trajectory files are uploaded to FTPStandIn, which only knows enough of the FTP protocol
+# for ftplib.storbinary()
+
+import os,sys,time,socket,socketserver,threading,posixpath,argparse
+from collections import Counter
+import numpy as np
+
+# group states, from the programmer's manual
+NOT_INITIALIZED = 7
+READY_HOMED = 11
+READY = 12
+DISABLED = 20
+NOT_REFERENCED = 42
+MOVING = 44
+TRAJECTORY = 45
+
+error_messages = {
+    '0': 'Success',
+    '-3': 'Wrong format in the command string',
+    '-8': 'Wrong object type for this command',
+    '-17': 'Parameter out of allowed range',
+    '-18': 'Positioner name does not exist or is unknown',
+    '-19': 'GroupName does not exist or unknown',
+    '-22': 'Not allowed action',
+    '-27': 'Move Aborted',
+    '-61': 'Error when opening file',
+    '-66': 'Trajectory initialization failed',
+    '-68': 'Velocity on trajectory is too big',
+    '-69': 'Acceleration on trajectory is too big',
+    '-72': 'Error when reading gathering data',
+    '-75': 'Trajectory not verified, or verified with a different file',
+    '-83': 'Event ID not defined',
+}
+
+default_groups = {
+    "scan": ["X", "Y"],
+    "rot": ["rY"],
+}
+
+
+class Move:
+    """ point-to-point move with a trapezoidal velocity profile
+    """
+    def __init__(self, p0, p1, vel, acc, t0):
+        self.p0,self.p1,self.t0 = p0,p1,t0
+        d = abs(p1-p0)
+        self.sign = 1 if p1>=p0 else -1
+        if d<vel*vel/acc:   # never reaches vel
+            vel = np.sqrt(d*acc)
+        self.vel,self.acc = vel,acc
+        self.ta = vel/acc if vel>0 else 0
+        self.tc = (d-vel*self.ta)/vel if vel>0 else 0
+        self.t_end = t0+2*self.ta+self.tc
+
+    def position(self, t):
+        tau = min(max(t-self.t0, 0), self.t_end-self.t0)
+        if tau<self.ta:
+            d = self.acc*tau*tau/2
+        elif tau<self.ta+self.tc:
+            d = self.acc*self.ta*self.ta/2 + self.vel*(tau-self.ta)
+        else:
+            tr = self.t_end-self.t0-tau
+            d = abs(self.p1-self.p0) - self.acc*tr*tr/2
+        return self.p0+self.sign*d
+
+
+class PVTMotion:
+    """ the motion of one positioner in a PVT trajectory, cubic within each element
+        dt, disp, vel are given per element, the velocity at the start of the trajectory is zero
+    """
+    def __init__(self, p0, dt, disp, vel, t0, nexec=1):
+        dt,disp,vel = [np.tile(np.asarray(a, dtype=float), nexec) for a in (dt, disp, vel)]
+        self.p0,self.t0 = p0,t0
+        self.T = dt
+        self.d = disp
+        self.v0 = np.concatenate([[0], vel[:-1]])
+        self.v1 = vel
+        self.ts = np.concatenate([[0], np.cumsum(dt)])     # start time of each element
+        self.ps = p0+np.concatenate([[0], np.cumsum(disp)])
+        self.t_end = t0+self.ts[-1]
+
+    def position(self, t):
+        tau = np.clip(np.asarray(t, dtype=float)-self.t0, 0, self.ts[-1])
+        i = np.clip(np.searchsorted(self.ts, tau, side='right')-1, 0, len(self.T)-1)
+        s = tau-self.ts[i]
+        T,d,v0,v1 = self.T[i],self.d[i],self.v0[i],self.v1[i]
+        return self.ps[i] + v0*s + (3*d/T**2-(2*v0+v1)/T)*s**2 + ((v0+v1)/T**2-2*d/T**3)*s**3
+
+
+def pvt_limits(dt, disp, vel):
+    """ max |velocity| and |acceleration| over the elements of one positioner
+        the acceleration is linear in each element, the velocity reaches its extremum either
+        at the ends or where the acceleration is zero
+    """
+    T,d,v1 = [np.asarray(a, dtype=float) for a in (dt, disp, vel)]
+    v0 = np.concatenate([[0], v1[:-1]])
+    a0 = (6*d-4*v0*T-2*v1*T)/T**2
+    a1 = (-6*d+2*v0*T+4*v1*T)/T**2
+    vmax = np.maximum(np.abs(v0), np.abs(v1))
+    cross = (a0*a1)<0
+    if np.any(cross):
+        T_,d_,v0_,v1_ = T[cross],d[cross],v0[cross],v1[cross]
+        s = a0[cross]/(a0[cross]-a1[cross])*T_
+        vmid = v0_ + 2*(3*d_/T_**2-(2*v0_+v1_)/T_)*s + 3*((v0_+v1_)/T_**2-2*d_/T_**3)*s**2
+        vmax[cross] = np.maximum(vmax[cross], np.abs(vmid))
+    return vmax.max(),np.maximum(np.abs(a0), np.abs(a1)).max()
+
+
+class Positioner:
+    def __init__(self, name, pos=0., max_vel=20., max_acc=200., vel=5., acc=50.):
+        self.name = name
+        self.pos = pos
+        self.max_vel,self.max_acc = max_vel,max_acc
+        self.sgamma = [vel, acc, 0.005, 0.05]
+        self.motion = None
+        self.verification = None
+
+    def position(self, t=None):
+        if self.motion is None:
+            return self.pos
+        return float(self.motion.position(time.time() if t is None else t))
+
+    def settle(self, t=None):
+        """ end the current motion at the position reached at time t
+        """
+        self.pos = self.position(t)
+        self.motion = None
+
+
+class Group:
+    def __init__(self, name, positioners):
+        self.name = name
+        self.positioners = [Positioner(f"{name}.{p}") for p in positioners]
+        self.state = READY
+        self.t_end = 0
+        self.abort = threading.Event()
+        self.verified = None        # (file name, contents) of the last verification
+        self.pulses = None          # (start element, end element, interval)
+
+
+class XPSEmulator:
+    """ the controller state is shared by all connections and protected by self.lock
+        each connection is served by its own thread, as the controller does for its sockets
+        latency is added to each reply; ncommands counts the commands received, by name
+    """
+    def __init__(self, host="localhost", port=0, ftp_port=0, groups=default_groups, latency=0.0005):
+        self.host = host
+        self.port = port
+        self.ftp_port = ftp_port
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.groups = {g: Group(g, p) for g,p in groups.items()}
+        self.positioners = {p.name: p for g in self.groups.values() for p in g.positioners}
+        self.files = {}             # FTP path -> bytes, shared with FTPStandIn
+        self.gathering_types = []
+        self.gathering = []         # (time, values)
+        self.gathering_stopped = False
+        self.trigger_config = []
+        self.action_config = []
+        self.events = {}
+        self.next_event_id = 0
+        self.ncommands = Counter()
+        self.server = None
+        self.ftp = None
+
+    def start(self):
+        emu = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                emu.serve_connection(self.request)
+        self.server = ThreadedTCPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.ftp = FTPStandIn(self.files, self.host, self.ftp_port)
+        self.ftp.start()
+        self.ftp_port = self.ftp.port
+        return self
+
+    def stop(self):
+        for grp in self.groups.values():
+            grp.abort.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.ftp is not None:
+            self.ftp.stop()
+
+    def serve_connection(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = b''
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            # the driver may pipeline commands, none of the arguments contains ')'
+            while b')' in buf:
+                cmd,buf = buf.split(b')', 1)
+                ret = self.execute(cmd.decode().strip()+')')
+                if self.latency>0:
+                    time.sleep(self.latency)
+                sock.sendall((ret+',EndOfAPI').encode())
+
+    def execute(self, command):
+        """ returns the reply to command, without EndOfAPI
+        """
+        if '(' not in command:
+            return '-3'
+        name,args = command[:-1].split('(', 1)
+        args = [a.strip() for a in args.split(',')] if args.strip() else []
+        # output parameters, e.g. "double *", are placeholders for the returned values
+        args = [a for a in args if not a.endswith('*')]
+        self.ncommands[name] += 1
+        func = getattr(self, f"cmd_{name}", None)
+        if func is None:
+            return '-3'
+        try:
+            ret = func(*args)
+        except (ValueError, TypeError, IndexError):
+            return '-3'
+        if isinstance(ret, tuple):
+            return ','.join([str(r) for r in ret])
+        return str(ret)
+
+    def find(self, name):
+        """ returns the group and the positioners referred to by name (group or positioner)
+        """
+        if name in self.groups.keys():
+            grp = self.groups[name]
+            return grp,grp.positioners
+        if name in self.positioners.keys():
+            return self.groups[name.split('.')[0]],[self.positioners[name]]
+        return None,[]
+
+    def update_state(self, grp):
+        """ motions end on their own, without the blocking command having to return first
+        """
+        if grp.state in (MOVING, TRAJECTORY) and time.time()>=grp.t_end:
+            for p in grp.positioners:
+                p.settle(grp.t_end)
+            grp.state = READY
+
+    def wait_for_motion(self, grp):
+        """ blocks the calling connection until the motion ends or is aborted
+        """
+        aborted = grp.abort.wait(max(0, grp.t_end-time.time()))
+        with self.lock:
+            if aborted:
+                return -27
+            self.update_state(grp)
+        return 0
+
+    # ---------- general
+    def cmd_ErrorListGet(self):
+        return 0,';'.join([f"Error {k}: {v}" for k,v in error_messages.items()])
+
+    def cmd_ErrorStringGet(self, code):
+        return 0,error_messages.get(code, "Unknown error")
+
+    def cmd_ObjectsListGet(self):
+        objs = []
+        for g in self.groups.values():
+            objs += [g.name]+[p.name for p in g.positioners]
+        return 0,';'.join(objs)+';;'
+
+    def cmd_HardwareDateAndTimeGet(self):
+        return 0,time.asctime()
+
+    def cmd_HardwareDateAndTimeSet(self, ts):
+        return 0
+
+    def cmd_ElapsedTimeGet(self):
+        return 0,f"{time.monotonic():.6f}"
+
+    # ---------- groups
+    def cmd_GroupStatusGet(self, name):
+        grp,pp = self.find(name)
+        if grp is None:
+            return -19
+        with self.lock:
+            self.update_state(grp)
+            return 0,grp.state
+
+    def cmd_GroupMotionStatusGet(self, name):
+        grp,pp = self.find(name)
+        if grp is None:
+            return -19
+        with self.lock:
+            self.update_state(grp)
+            moving = 1 if grp.state in (MOVING, TRAJECTORY) else 0
+            return (0, *[moving]*len(pp))
+
+    def cmd_GroupPositionCurrentGet(self, name):
+        grp,pp = self.find(name)
+        if grp is None:
+            return -19
+        t = time.time()
+        with self.lock:
+            return (0, *[f"{p.position(t):.6f}" for p in pp])
+
+    cmd_GroupPositionSetpointGet = cmd_GroupPositionCurrentGet
+
+    def cmd_GroupMoveAbsolute(self, name, *targets):
+        return self.move(name, [float(t) for t in targets], relative=False)
+
+    def cmd_GroupMoveRelative(self, name, *targets):
+        return self.move(name, [float(t) for t in targets], relative=True)
+
+    def move(self, name, targets, relative):
+        grp,pp = self.find(name)
+        if grp is None:
+            return -19
+        if len(targets)!=len(pp):
+            return -3
+        with self.lock:
+            self.update_state(grp)
+            if grp.state not in (READY, READY_HOMED):
+                return -22
+            t0 = time.time()
+            for p,target in zip(pp, targets):
+                p1 = p.pos+target if relative else target
+                p.motion = Move(p.pos, p1, p.sgamma[0], p.sgamma[1], t0)
+            for p in grp.positioners:
+                if p not in pp:
+                    p.motion = None
+            grp.t_end = max([p.motion.t_end for p in pp])
+            grp.abort.clear()
+            grp.state = MOVING
+        return self.wait_for_motion(grp)
+
+    def cmd_GroupMoveAbort(self, name):
+        grp,pp = self.find(name)
+        if grp is None:
+            return -19
+        with self.lock:
+            if grp.state not in (MOVING, TRAJECTORY):
+                return -22
+            t = time.time()
+            for p in grp.positioners:
+                p.settle(t)
+            grp.state = READY
+            grp.abort.set()
+        return 0
+
+    def cmd_GroupMotionEnable(self, name):
+        grp,pp = self.find(name)
+        if grp is None:
+            return -19
+        with self.lock:
+            if grp.state==DISABLED:
+                grp.state = READY
+        return 0
+
+    def cmd_GroupMotionDisable(self, name):
+        grp,pp = self.find(name)
+        if grp is None:
+            return -19
+        with self.lock:
+            self.update_state(grp)
+            if grp.state!=READY:
+                return -22
+            grp.state = DISABLED
+        return 0
+
+    def cmd_GroupKill(self, name):
+        grp,pp = self.find(name)
+        if grp is None:
+            return -19
+        with self.lock:
+            for p in grp.positioners:
+                p.settle()
+            grp.abort.set()
+            grp.state = NOT_INITIALIZED
+        return 0
+
+    def cmd_GroupInitialize(self, name):
+        grp,pp = self.find(name)
+        if grp is None:
+            return -19
+        with self.lock:
+            if grp.state!=NOT_INITIALIZED:
+                return -22
+            grp.state = NOT_REFERENCED
+        return 0
+
+    def cmd_GroupHomeSearch(self, name):
+        grp,pp = self.find(name)
+        if grp is None:
+            return -19
+        with self.lock:
+            if grp.state!=NOT_REFERENCED:
+                return -22
+            for p in grp.positioners:
+                p.pos = 0.
+            grp.state = READY_HOMED
+        return 0
+
+    # ---------- positioners
+    def cmd_PositionerSGammaParametersGet(self, name):
+        if name not in self.positioners.keys():
+            return -18
+        return (0, *self.positioners[name].sgamma)
+
+    def cmd_PositionerSGammaParametersSet(self, name, vel, acc, tmin, tmax):
+        if name not in self.positioners.keys():
+            return -18
+        p = self.positioners[name]
+        vel,acc,tmin,tmax = float(vel),float(acc),float(tmin),float(tmax)
+        if not (0<vel<=p.max_vel and 0<acc<=p.max_acc and 0<tmin<=tmax):
+            return -17
+        p.sgamma = [vel, acc, tmin, tmax]
+        return 0
+
+    def cmd_PositionerMaximumVelocityAndAccelerationGet(self, name):
+        if name not in self.positioners.keys():
+            return -18
+        p = self.positioners[name]
+        return 0,p.max_vel,p.max_acc
+
+    # ---------- PVT trajectories
+    def read_trajectory(self, grp, fn):
+        """ returns the array of elements, each row is dt, (displacement, velocity out) per positioner
+        """
+        data = self.files.get(posixpath.join("Public/Trajectories", fn))
+        if data is None:
+            return None
+        rows = [l for l in data.decode().splitlines() if l.strip() and not l.startswith('#')]
+        traj = np.array([[float(v) for v in l.split(',')] for l in rows])
+        if traj.ndim!=2 or traj.shape[1]!=1+2*len(grp.positioners) or np.any(traj[:, 0]<=0):
+            return None
+        return traj
+
+    def cmd_MultipleAxesPVTVerification(self, name, fn):
+        grp = self.groups.get(name)
+        if grp is None:
+            return -19
+        with self.lock:
+            traj = self.read_trajectory(grp, fn)
+            if traj is None:
+                return -61
+            grp.verified = None
+            err = 0
+            for i,p in enumerate(grp.positioners):
+                disp,vel = traj[:, 2*i+1],traj[:, 2*i+2]
+                vmax,amax = pvt_limits(traj[:, 0], disp, vel)
+                travel = np.concatenate([[0], np.cumsum(disp)])
+                p.verification = (fn, travel.min(), travel.max(), vmax, amax)
+                if vmax>p.max_vel:
+                    err = -68
+                elif amax>p.max_acc and err==0:
+                    err = -69
+            if err==0:
+                grp.verified = (fn, self.files[posixpath.join("Public/Trajectories", fn)])
+            return err
+
+    def cmd_MultipleAxesPVTVerificationResultGet(self, name):
+        if name not in self.positioners.keys():
+            return -18
+        res = self.positioners[name].verification
+        if res is None:
+            return -75
+        return (0, *[f"{v:.6f}" if isinstance(v, float) else v for v in res])
+
+    def cmd_MultipleAxesPVTPulseOutputSet(self, name, start, end, interval):
+        grp = self.groups.get(name)
+        if grp is None:
+            return -19
+        grp.pulses = (int(start), int(end), float(interval))
+        return 0
+
+    def cmd_MultipleAxesPVTPulseOutputGet(self, name):
+        grp = self.groups.get(name)
+        if grp is None:
+            return -19
+        if grp.pulses is None:
+            return -22
+        return (0, *grp.pulses)
+
+    def pulse_times(self, grp, traj):
+        """ pulses every interval between the start of the first and the start of the last element
+        """
+        if grp.pulses is None:
+            return []
+        start,end,interval = grp.pulses
+        ts = np.concatenate([[0], np.cumsum(traj[:, 0])])
+        t1,t2 = ts[min(start, len(ts))-1],ts[min(end, len(ts))-1]
+        return t1+interval*np.arange(int(np.floor((t2-t1)/interval+1e-6))+1)
+
+    def gathering_armed(self, grp):
+        for triggers,actions in self.events.values():
+            if f"{grp.name}.PVT.TrajectoryPulse" in triggers and "GatheringOneData" in actions:
+                return True
+        return False
+
+    def cmd_MultipleAxesPVTExecution(self, name, fn, nexec):
+        grp = self.groups.get(name)
+        if grp is None:
+            return -19
+        with self.lock:
+            self.update_state(grp)
+            if grp.state!=READY:
+                return -22
+            data = self.files.get(posixpath.join("Public/Trajectories", fn))
+            if grp.verified is None or grp.verified!=(fn, data):
+                return -75
+            traj = self.read_trajectory(grp, fn)
+            t0 = time.time()
+            for i,p in enumerate(grp.positioners):
+                p.motion = PVTMotion(p.pos, traj[:, 0], traj[:, 2*i+1], traj[:, 2*i+2], t0, int(nexec))
+            grp.t_end = grp.positioners[0].motion.t_end
+            if self.gathering_armed(grp) and not self.gathering_stopped:
+                # the data are calculated now, but only become available as time goes on
+                tp = t0+self.pulse_times(grp, traj)
+                cols = [self.gathering_column(t) for t in self.gathering_types]
+                self.gathering += [(t, [c(t) for c in cols]) for t in tp]
+            grp.abort.clear()
+            grp.state = TRAJECTORY
+        return self.wait_for_motion(grp)
+
+    # ---------- gathering
+    def gathering_column(self, typ):
+        pname,quantity = typ.rsplit('.', 1)
+        p = self.positioners[pname]
+        if quantity in ("CurrentPosition", "SetpointPosition"):
+            return lambda t: p.position(t)
+        if quantity in ("CurrentVelocity", "SetpointVelocity"):
+            return lambda t: (p.position(t+1e-4)-p.position(t-1e-4))/2e-4
+        raise ValueError(typ)
+
+    def cmd_GatheringReset(self):
+        with self.lock:
+            self.gathering = []
+            self.gathering_stopped = False
+        return 0
+
+    def cmd_GatheringConfigurationSet(self, *types):
+        for typ in types:
+            if typ.rsplit('.', 1)[0] not in self.positioners.keys():
+                return -18
+        with self.lock:
+            self.gathering_types = list(types)
+        return 0
+
+    def cmd_GatheringConfigurationGet(self):
+        return 0,';'.join(self.gathering_types)
+
+    def gathered(self):
+        t = time.time()
+        return [g for g in self.gathering if g[0]<=t]
+
+    def cmd_GatheringCurrentNumberGet(self):
+        with self.lock:
+            return 0,len(self.gathered()),1000000
+
+    def cmd_GatheringStopAndSave(self):
+        with self.lock:
+            self.gathering = self.gathered()
+            self.gathering_stopped = True
+        return 0
+
+    cmd_GatheringStop = cmd_GatheringStopAndSave
+
+    def cmd_GatheringDataMultipleLinesGet(self, start, nlines):
+        start,nlines = int(start),int(nlines)
+        with self.lock:
+            data = self.gathered()
+        if start<0 or nlines<=0 or start+nlines>len(data):
+            return -72
+        return 0,'\n'.join([';'.join([f"{v:.6f}" for v in vals]) for t,vals in data[start:start+nlines]])+'\n'
+
+    # ---------- events
+    def cmd_EventExtendedConfigurationTriggerSet(self, *args):
+        if len(args)%5:
+            return -3
+        self.trigger_config = list(args[::5])
+        return 0
+
+    def cmd_EventExtendedConfigurationActionSet(self, *args):
+        if len(args)%5:
+            return -3
+        self.action_config = list(args[::5])
+        return 0
+
+    def cmd_EventExtendedStart(self):
+        with self.lock:
+            if len(self.trigger_config)==0 or len(self.action_config)==0:
+                return -22
+            self.next_event_id += 1
+            self.events[self.next_event_id] = (self.trigger_config, self.action_config)
+            return 0,self.next_event_id
+
+    def cmd_EventExtendedAllGet(self):
+        with self.lock:
+            if len(self.events)==0:
+                return -83
+            return 0,';'.join([str(i) for i in self.events.keys()])
+
+    def cmd_EventExtendedRemove(self, eid):
+        with self.lock:
+            if int(eid) not in self.events.keys():
+                return -83
+            del self.events[int(eid)]
+        return 0
+
+
+class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FTPStandIn:
+    """ enough of an FTP server for ftplib.storbinary()/retrbinary() in passive mode
+        any user name and password are accepted, files are kept in memory
+    """
+    def __init__(self, files, host="localhost", port=0):
+        self.files = files
+        stand_in = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                stand_in.serve_connection(self.request, self.rfile)
+        self.server = ThreadedTCPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_connection(self, sock, rfile):
+        def reply(msg):
+            sock.sendall((msg+"\r\n").encode())
+        cwd = "/"
+        pasv = None
+        reply("220 XPS FTP stand-in")
+        for line in rfile:
+            cmd,_,arg = line.decode().strip().partition(' ')
+            cmd = cmd.upper()
+            if cmd=="USER":
+                reply("331 password required")
+            elif cmd=="PASS":
+                reply("230 logged in")
+            elif cmd in ("TYPE", "NOOP", "MODE", "STRU"):
+                reply("200 OK")
+            elif cmd=="SYST":
+                reply("215 UNIX Type: L8")
+            elif cmd=="PWD":
+                reply(f'257 "{cwd}"')
+            elif cmd=="CWD":
+                cwd = posixpath.normpath(posixpath.join(cwd, arg))
+                reply("250 OK")
+            elif cmd in ("PASV", "EPSV"):
+                if pasv is not None:
+                    pasv.close()
+                pasv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                pasv.bind((sock.getsockname()[0], 0))
+                pasv.listen(1)
+                h,p = pasv.getsockname()
+                if cmd=="PASV":
+                    reply(f"227 Entering Passive Mode ({h.replace('.', ',')},{p>>8},{p&0xff})")
+                else:
+                    reply(f"229 Entering Extended Passive Mode (|||{p}|)")
+            elif cmd in ("STOR", "RETR"):
+                path = posixpath.normpath(posixpath.join(cwd, arg)).lstrip('/')
+                if pasv is None:
+                    reply("425 use PASV first")
+                    continue
+                if cmd=="RETR" and path not in self.files.keys():
+                    reply("550 file not found")
+                    continue
+                reply("150 opening data connection")
+                conn,addr = pasv.accept()
+                with conn:
+                    if cmd=="STOR":
+                        chunks = []
+                        while True:
+                            data = conn.recv(65536)
+                            if not data:
+                                break
+                            chunks.append(data)
+                        self.files[path] = b''.join(chunks)
+                    else:
+                        conn.sendall(self.files[path])
+                pasv.close()
+                pasv = None
+                reply("226 transfer complete")
+            elif cmd=="DELE":
+                self.files.pop(posixpath.normpath(posixpath.join(cwd, arg)).lstrip('/'), None)
+                reply("250 OK")
+            elif cmd=="QUIT":
+                reply("221 bye")
+                break
+            else:
+                reply("502 command not implemented")
+        if pasv is not None:
+            pasv.close()
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--ftp-port", type=int, default=2121)
+    parser.add_argument("--latency", type=float, default=0.5, help="reply latency in ms")
+    args = parser.parse_args()
+    emu = XPSEmulator(args.host, args.port, args.ftp_port, latency=args.latency*1e-3).start()
+    print(f"XPS emulator on {args.host}:{emu.port}, FTP on port {emu.ftp_port}, ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"{sum(emu.ncommands.values())} commands received")
+    except KeyboardInterrupt:
+        emu.stop()